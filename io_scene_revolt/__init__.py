@@ -12,11 +12,14 @@ bl_info = {
     "category": "Import-Export"}
 
 import bpy
+import math
 
 from bpy.props import (
         BoolProperty,
         EnumProperty,
         FloatProperty,
+        FloatVectorProperty,
+        IntProperty,
         StringProperty,
         CollectionProperty,
         PointerProperty
@@ -28,6 +31,7 @@ from bpy_extras.io_utils import (
 
 from io_scene_revolt.bakehelper import RVBakeHelper
 from io_scene_revolt.ncpsetup import NCPSetupOperator
+from io_scene_revolt.worldproxy import RVWorldProxyLoad, RVWorldProxyUnload
 import io_scene_revolt.animtex as animtex
 import io_scene_revolt.animtex_ui as animtex_ui
 import io_scene_revolt.bl_preferences as bl_preferences
@@ -64,6 +68,96 @@ class ExportWorld(bpy.types.Operator, ExportHelper):
         min=16        
         )
         
+    split_mode: EnumProperty(
+        name="Split Mode",
+        items=(('SIZE', "Fixed Size", "Split into tiles of Split Size"),
+               ('ADAPTIVE', "Polygon Budget", "Subdivide until each mesh fits the polygon and vertex budget, then merge small neighbours")),
+        default='SIZE',
+        )
+        
+    split_max_polys: IntProperty(
+        name="Max Polygons",
+        default=8192,
+        min=1,
+        max=65535,
+        )
+        
+    split_max_verts: IntProperty(
+        name="Max Vertices",
+        default=8192,
+        min=3,
+        max=65535,
+        )
+        
+    split_min_polys: IntProperty(
+        name="Min Polygons",
+        default=512,
+        min=0,
+        max=65535,
+        description="Meshes with fewer polygons are merged into a neighbour when the budget allows"
+        )
+        
+    split_by_mesh_index: BoolProperty(
+        name="Split By Mesh Index",
+        default=True,
+        description="Split objects from a merged world import back into their original meshes"
+        )
+        
+    bigcube_mode: EnumProperty(
+        name="Bigcubes",
+        items=(('GRID', "Grid", "Fixed size tiles over the whole scene"),
+               ('ADAPTIVE', "Adaptive", "Subdivide dense areas until each bigcube fits the polygon and radius targets")),
+        default='GRID',
+        description="How split meshes are grouped into bigcubes for culling"
+        )
+        
+    bigcube_polys: IntProperty(
+        name="Bigcube Polygons",
+        default=4000,
+        min=1,
+        description="Target polygon count per bigcube"
+        )
+        
+    bigcube_radius: FloatProperty(
+        name="Bigcube Radius",
+        default=8000,
+        min=16,
+        description="Target radius per bigcube"
+        )
+        
+    sort_polys: BoolProperty(
+        name="Sort Polygons",
+        default=False,
+        description="Group polygons by texture, blending and double sided state to cut render state changes in game"
+        )
+        
+    optimize_vcache: BoolProperty(
+        name="Optimize Vertex Cache",
+        default=False,
+        description="Reorder polygons and vertices for better vertex cache use in game"
+        )
+        
+    merge_quads: BoolProperty(
+        name="Merge Triangles To Quads",
+        default=False,
+        description="Join neighbouring triangles that continue each other into quads"
+        )
+        
+    quad_tolerance: FloatProperty(
+        name="Quad Tolerance",
+        default=math.radians(1),
+        min=0,
+        max=math.pi,
+        subtype='ANGLE',
+        description="Largest angle between the two triangles of a merged quad"
+        )
+        
+    use_cache: BoolProperty(
+        name="Use Export Cache",
+        default=False,
+        description="Keep serialized meshes next to the exported file and reuse them for objects that didn't change"
+        )
+        
     def draw(self, context):
         layout = self.layout
         sub = layout.row()
@@ -75,7 +169,39 @@ class ExportWorld(bpy.types.Operator, ExportHelper):
         sub.prop(self, "split")
         sub = layout.row()
         sub.enabled = self.split
+        sub.prop(self, "split_mode")
+        sub = layout.row()
+        sub.enabled = self.split and self.split_mode == 'SIZE'
         sub.prop(self, "split_size")
+        for prop in ("split_max_polys", "split_max_verts", "split_min_polys"):
+            sub = layout.row()
+            sub.enabled = self.split and self.split_mode == 'ADAPTIVE'
+            sub.prop(self, prop)
+        sub = layout.row()
+        sub.prop(self, "split_by_mesh_index")
+        layout.separator()
+        sub = layout.row()
+        sub.enabled = self.split
+        sub.prop(self, "bigcube_mode")
+        sub = layout.row()
+        sub.enabled = self.split and self.bigcube_mode == 'ADAPTIVE'
+        sub.prop(self, "bigcube_polys")
+        sub = layout.row()
+        sub.enabled = self.split and self.bigcube_mode == 'ADAPTIVE'
+        sub.prop(self, "bigcube_radius")
+        layout.separator()
+        sub = layout.row()
+        sub.prop(self, "sort_polys")
+        sub = layout.row()
+        sub.prop(self, "optimize_vcache")
+        sub = layout.row()
+        sub.prop(self, "merge_quads")
+        sub = layout.row()
+        sub.enabled = self.merge_quads
+        sub.prop(self, "quad_tolerance")
+        layout.separator()
+        sub = layout.row()
+        sub.prop(self, "use_cache")
         
     def execute(self, context):
         from . import export_world
@@ -112,12 +238,48 @@ class ExportMesh(bpy.types.Operator, ExportHelper):
         default=False,
         )
         
+    sort_polys: BoolProperty(
+        name="Sort Polygons",
+        default=False,
+        description="Group polygons by texture, blending and double sided state to cut render state changes in game"
+        )
+        
+    optimize_vcache: BoolProperty(
+        name="Optimize Vertex Cache",
+        default=False,
+        description="Reorder polygons and vertices for better vertex cache use in game"
+        )
+        
+    merge_quads: BoolProperty(
+        name="Merge Triangles To Quads",
+        default=False,
+        description="Join neighbouring triangles that continue each other into quads"
+        )
+        
+    quad_tolerance: FloatProperty(
+        name="Quad Tolerance",
+        default=math.radians(1),
+        min=0,
+        max=math.pi,
+        subtype='ANGLE',
+        description="Largest angle between the two triangles of a merged quad"
+        )
+        
     def draw(self, context):
         layout = self.layout
         sub = layout.row()
         sub.prop(self, "apply_modifiers")
         sub = layout.row()
         sub.prop(self, "apply_transform")
+        sub = layout.row()
+        sub.prop(self, "sort_polys")
+        sub = layout.row()
+        sub.prop(self, "optimize_vcache")
+        sub = layout.row()
+        sub.prop(self, "merge_quads")
+        sub = layout.row()
+        sub.enabled = self.merge_quads
+        sub.prop(self, "quad_tolerance")
         
     def execute(self, context):
         from . import export_mesh
@@ -168,6 +330,29 @@ class ExportCollision(bpy.types.Operator, ExportHelper):
         min=128        
         )
         
+    grid_size_mode: EnumProperty(
+        name="Grid Size Mode",
+        items=(('FIXED', "Fixed", "Use the grid size above"),
+               ('AUTO', "Automatic", "Try a range of sizes and keep the one with the lowest estimated query cost")),
+        default='FIXED',
+        description="How the grid cell size is chosen"
+        )
+        
+    merge_quads: BoolProperty(
+        name="Merge Triangles To Quads",
+        default=False,
+        description="Join neighbouring triangles that continue each other into quads"
+        )
+        
+    quad_tolerance: FloatProperty(
+        name="Quad Tolerance",
+        default=math.radians(1),
+        min=0,
+        max=math.pi,
+        subtype='ANGLE',
+        description="Largest angle between the two triangles of a merged quad"
+        )
+        
     def draw(self, context):
         layout = self.layout
         sub = layout.row()
@@ -180,7 +365,15 @@ class ExportCollision(bpy.types.Operator, ExportHelper):
         sub.prop(self, "generate_grid", text="Generate Grid (Required for levels)")
         sub = layout.row()
         sub.enabled = self.generate_grid
+        sub.prop(self, "grid_size_mode")
+        sub = layout.row()
+        sub.enabled = self.generate_grid and self.grid_size_mode == 'FIXED'
         sub.prop(self, "grid_size")
+        sub = layout.row()
+        sub.prop(self, "merge_quads")
+        sub = layout.row()
+        sub.enabled = self.merge_quads
+        sub.prop(self, "quad_tolerance")
         
     def execute(self, context):
         from . import export_ncp
@@ -285,6 +478,80 @@ class ImportWorld(bpy.types.Operator, ImportHelper):
             options={'HIDDEN'},
             )
 
+    worker_count: IntProperty(
+        name="Decode Workers",
+        default=1,
+        min=1,
+        max=64,
+        description="Number of processes used to decode meshes. 1 decodes inside Blender"
+        )
+        
+    merge_mode: EnumProperty(
+        name="Objects",
+        items=(('NONE', "One Per Mesh", "Create an object for every mesh in the file"),
+               ('BIGCUBE', "One Per Bigcube", "Merge the meshes of each bigcube into one object"),
+               ('SINGLE', "Single Object", "Merge every mesh into one object"),
+               ('PROXY', "Proxies", "Create bounding box proxies only, geometry is loaded on demand with Load World Proxies")),
+        default='NONE',
+        description="Merged objects keep the original mesh index as a face attribute, so the world can be re-exported with the same meshes"
+        )
+        
+    region_mode: EnumProperty(
+        name="Region",
+        items=(('ALL', "Everything", "Import every mesh"),
+               ('BOX', "Box", "Import meshes of bigcubes touching a box"),
+               ('SPHERE', "Sphere", "Import meshes of bigcubes touching a sphere"),
+               ('BIGCUBES', "Bigcube Indices", "Import meshes of the listed bigcubes")),
+        default='ALL',
+        )
+        
+    region_min: FloatVectorProperty(
+        name="Min",
+        size=3,
+        subtype='XYZ'
+        )
+        
+    region_max: FloatVectorProperty(
+        name="Max",
+        size=3,
+        subtype='XYZ'
+        )
+        
+    region_center: FloatVectorProperty(
+        name="Center",
+        size=3,
+        subtype='XYZ'
+        )
+        
+    region_radius: FloatProperty(
+        name="Radius",
+        default=10,
+        min=0
+        )
+        
+    region_bigcubes: StringProperty(
+        name="Bigcubes",
+        default="",
+        description="Comma separated list of bigcube indices"
+        )
+        
+    def draw(self, context):
+        layout = self.layout
+        sub = layout.row()
+        sub.prop(self, "merge_mode")
+        sub = layout.row()
+        sub.prop(self, "worker_count")
+        layout.separator()
+        sub = layout.row()
+        sub.prop(self, "region_mode")
+        if self.region_mode == 'BOX':
+            layout.prop(self, "region_min")
+            layout.prop(self, "region_max")
+        elif self.region_mode == 'SPHERE':
+            layout.prop(self, "region_center")
+            layout.prop(self, "region_radius")
+        elif self.region_mode == 'BIGCUBES':
+            layout.prop(self, "region_bigcubes")
        
     def execute(self, context):
         from . import import_world
@@ -441,6 +708,8 @@ def menu_func_import(self, context):
 def menu_func_ops(self, context):
     self.layout.operator(RVBakeHelper.bl_idname)
     self.layout.operator(NCPSetupOperator.bl_idname)
+    self.layout.operator(RVWorldProxyLoad.bl_idname)
+    self.layout.operator(RVWorldProxyUnload.bl_idname)
 
 # Register factories
 classes = (
@@ -455,7 +724,9 @@ classes = (
     ImportHull,
     ImportMirrors,
     RVBakeHelper,
-    NCPSetupOperator
+    NCPSetupOperator,
+    RVWorldProxyLoad,
+    RVWorldProxyUnload
 )
 
 def register():
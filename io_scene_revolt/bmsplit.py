@@ -1,124 +1,263 @@
 import bmesh, bpy, mathutils
-import math
+import math, heapq
+import numpy as np
+
+import io_scene_revolt.meshbuilder as meshbuilder
+
+# export_mesh writes polygon and vertex counts as 16 bit values
+MAX_MESH_ELEMENTS = 65535
 
 class BMeshSplitter:
-    def __init__(self, split_size):
+    def __init__(self, split_size, max_polys = MAX_MESH_ELEMENTS, max_verts = MAX_MESH_ELEMENTS, min_polys = 0):
         self.meshes = []
         self.split_size = split_size
+        
+        # adaptive splitting budget
+        self.max_polys = min(max_polys, MAX_MESH_ELEMENTS)
+        self.max_verts = min(max_verts, MAX_MESH_ELEMENTS)
+        self.min_polys = min_polys
+
+    def get_mesh_arrays(self, bm):
+        """Fetch geometry, face and loop layer data out of a bmesh in bulk"""
+        me = bpy.data.meshes.new("split_temp")
+        bm.to_mesh(me)
+
+        vert_count = len(me.vertices)
+        loop_count = len(me.loops)
+        face_count = len(me.polygons)
+
+        arrays = {}
+        arrays["co"] = np.empty(vert_count * 3, dtype=np.float32)
+        me.vertices.foreach_get("co", arrays["co"])
+        arrays["co"] = arrays["co"].reshape(-1, 3)
+
+        # Mesh normals are stored at lower precision, take them from the bmesh
+        arrays["normals"] = np.fromiter((x for vert in bm.verts for x in vert.normal), dtype=np.float32, count=vert_count * 3).reshape(-1, 3)
+
+        arrays["loop_verts"] = np.empty(loop_count, dtype=np.int32)
+        me.loops.foreach_get("vertex_index", arrays["loop_verts"])
+
+        for key, dtype in (("loop_start", np.int32), ("loop_total", np.int32), ("material_index", np.int32), ("use_smooth", bool)):
+            arrays[key] = np.empty(face_count, dtype=dtype)
+            me.polygons.foreach_get(key, arrays[key])
+
+        # layers, looked up once here instead of per loop
+        arrays["uv_layers"] = []
+        for uv_layer in me.uv_layers:
+            uvs = np.empty(loop_count * 2, dtype=np.float32)
+            uv_layer.data.foreach_get("uv", uvs)
+            arrays["uv_layers"].append((uv_layer.name, uvs.reshape(-1, 2)))
+
+        arrays["color_layers"] = []
+        for vc_layer in me.vertex_colors:
+            colors = np.empty(loop_count * 4, dtype=np.float32)
+            vc_layer.data.foreach_get("color", colors)
+            arrays["color_layers"].append((vc_layer.name, colors.reshape(-1, 4)))
+
+        bpy.data.meshes.remove(me)
+        return arrays
+
+    def get_face_centers(self, arrays):
+        """Median centers of every face"""
+        loop_co = arrays["co"][arrays["loop_verts"]].astype(np.float64)
+        if len(loop_co) == 0:
+            return np.zeros((0, 3))
+        return np.add.reduceat(loop_co, arrays["loop_start"], axis=0) / arrays["loop_total"][:, None]
 
     def split(self, bm):
         """Return a list of bmeshes, may return the original if bounds are smaller than split size"""
-        
-        # find mesh bounds
-        bnds_min = [float('inf'),float('inf'),float('inf')]
-        bnds_max = [float('-inf'),float('-inf'),float('-inf')]
-        
-        for vert in bm.verts:
-            vco = vert.co
-            for x in range(3):
-                bnds_min[x] = min(vco[x], bnds_min[x])
-                bnds_max[x] = max(vco[x], bnds_max[x])
-
-        # slightly inflate bounds (otherwise verts right on the edge will overflow)
-        for x in range(3):
-            bnds_min[x] -= 0.1
-            bnds_max[x] += 0.1
-         
+        self.meshes = list(self.iter_split(bm))
+        return self.meshes
+
+    def iter_split(self, bm):
+        """Yield split bmeshes one at a time, may yield the original if bounds are smaller than split size"""
+        arrays = self.get_mesh_arrays(bm)
+        if len(arrays["co"]) == 0:
+            yield bm
+            return
+
+        # find mesh bounds, slightly inflated (otherwise verts right on the edge will overflow)
+        bnds_min = arrays["co"].min(axis=0).astype(np.float64) - 0.1
+        bnds_max = arrays["co"].max(axis=0).astype(np.float64) + 0.1
+
         # init buckets
         x_size = bnds_max[0] - bnds_min[0]
         y_size = bnds_max[1] - bnds_min[1]
-        
+
         if x_size < self.split_size and y_size < self.split_size:
-            self.meshes = [bm]
-            return self.meshes
-        
+            yield bm
+            return
+
         buckets_x = max(1, math.ceil(x_size / self.split_size))
         buckets_y = max(1, math.ceil(y_size / self.split_size))
-            
-        buckets_size_x = x_size / buckets_x
-        buckets_size_y = y_size / buckets_y
+
+        # fill buckets
+        centers = self.get_face_centers(arrays)
+        x_bucket = np.clip(np.floor((centers[:, 0] - bnds_min[0]) / x_size * buckets_x), 0, buckets_x - 1).astype(np.int64)
+        y_bucket = np.clip(np.floor((centers[:, 1] - bnds_min[1]) / y_size * buckets_y), 0, buckets_y - 1).astype(np.int64)
+
+        yield from self.iter_bucket_meshes(arrays, (y_bucket * buckets_x) + x_bucket)
+
+    def split_adaptive(self, bm):
+        """Return a list of bmeshes that each fit the polygon and vertex budget, may return the original"""
+        self.meshes = list(self.iter_split_adaptive(bm))
+        return self.meshes
+
+    def iter_split_adaptive(self, bm):
+        """Yield bmeshes that each fit the polygon and vertex budget, may yield the original if it already fits.
+           split_size isn't used here, mesh size follows the geometry density instead"""
+        arrays = self.get_mesh_arrays(bm)
+        if len(arrays["co"]) == 0:
+            yield bm
+            return
+
+        centers = self.get_face_centers(arrays)
+        buckets = self.merge_small_buckets(arrays, self.get_budget_buckets(arrays, centers))
+        if len(buckets) == 1:
+            yield bm
+            return
+
+        face_buckets = np.empty(len(centers), dtype=np.int64)
+        for x, faces in enumerate(buckets):
+            face_buckets[faces] = x
+        yield from self.iter_bucket_meshes(arrays, face_buckets)
+
+    def get_bucket_stats(self, arrays, faces):
+        """Return (exported polygon count, vertex count, xy bounds min, xy bounds max) for a set of faces"""
+        loop_totals = arrays["loop_total"][faces]
         
-        buckets_total = buckets_x *  buckets_y
-        buckets = []
-        for x in range(buckets_total):
-            buckets.append([])
+        # ngons are triangulated on export
+        poly_count = int(np.where(loop_totals > 4, loop_totals - 2, 1).sum())
         
-        # fill buckets
-        for face in bm.faces:
-            center = face.calc_center_median()
-            x_normalized_pos = (center[0] - bnds_min[0]) / x_size
-            y_normalized_pos = (center[1] - bnds_min[1]) / y_size
+        verts = np.unique(arrays["loop_verts"][self.get_bucket_loops(arrays, faces)])
+        co = arrays["co"][verts, :2]
+        return (poly_count, len(verts), co.min(axis=0), co.max(axis=0))
+
+    def fits_budget(self, stats):
+        poly_count, vert_count, bnds_min, bnds_max = stats
+        return poly_count <= self.max_polys and vert_count <= self.max_verts
+
+    def get_budget_buckets(self, arrays, centers):
+        """Split faces k-d tree style at the median face center until every bucket fits the budget"""
+        buckets = []
+        stack = [np.arange(len(centers))]
+        while len(stack) > 0:
+            faces = stack.pop()
+            stats = self.get_bucket_stats(arrays, faces)
+            if len(faces) == 1 or self.fits_budget(stats):
+                buckets.append(faces)
+                continue
             
-            x_bucket = math.floor(x_normalized_pos * buckets_x)
-            y_bucket = math.floor(y_normalized_pos * buckets_y)
+            # cut the longest side
+            axis = int(np.argmax(stats[3] - stats[2]))
+            faces = faces[np.argsort(centers[faces, axis], kind='stable')]
+            half = len(faces) // 2
+            stack.append(faces[half:])
+            stack.append(faces[:half])
             
-            bucket_index = (y_bucket * buckets_x) + x_bucket
-            buckets[bucket_index].append(face)
-        
-        # prepare bmeshes from buckets
-        self.meshes = []
-        bm.verts.ensure_lookup_table()
+        return buckets
+
+    def merge_small_buckets(self, arrays, buckets):
+        """Merge buckets under min_polys into their closest neighbour, as long as the result still fits the budget"""
+        if self.min_polys <= 0:
+            return buckets
+            
+        buckets = list(buckets)
+        stats = [self.get_bucket_stats(arrays, faces) for faces in buckets]
+        poly_counts = np.array([x[0] for x in stats], dtype=np.int64)
+        centers = np.array([(x[2] + x[3]) / 2 for x in stats], dtype=np.float64).reshape(-1, 2)
+        alive = np.ones(len(buckets), dtype=bool)
         
-        bm_colors = bm.loops.layers.color.items()
-        bm_uvs = bm.loops.layers.uv.items()
+        # smallest first. merging only grows buckets, so one that fits nowhere now never will
+        small = [(poly_counts[x], x) for x in range(len(buckets)) if poly_counts[x] < self.min_polys]
+        heapq.heapify(small)
         
-        for bucket in buckets:
-            bucket_verts = []
-            bucket_vert_remap = {}
-            
-            # empty
-            if len(bucket) == 0:
+        while len(small) > 0 and np.count_nonzero(alive) > 1:
+            poly_count, x = heapq.heappop(small)
+            if not alive[x] or poly_count != poly_counts[x]:
                 continue
             
-            # remap verts
-            for face in bucket:
-                for vert in face.verts:
-                    if not vert.index in bucket_vert_remap:
-                        bucket_vert_remap[vert.index] = len(bucket_verts)
-                        bucket_verts.append(vert)
-                        
-            # create new bmesh
-            bm2 = bmesh.new()
-            self.meshes.append(bm2)
-            
-            # copy layers
-            for color_layer in bm_colors:
-                bm2.loops.layers.color.new(color_layer[0])
-            for uv_layer in bm_uvs:
-                bm2.loops.layers.uv.new(uv_layer[0])
+            distances = np.linalg.norm(centers - centers[x], axis=1)
+            distances[~alive] = np.inf
+            distances[x] = np.inf
             
-            # copy verts
-            for vert in bucket_verts:
-                newvert = bm2.verts.new(vert.co)
-                newvert.normal = vert.normal
-
-            bm2.verts.ensure_lookup_table()
-            bm2.verts.index_update()
-            
-            # copy faces
-            for face in bucket:
-                verts = [bm2.verts[bucket_vert_remap[l.vert.index]] for l in face.loops]
-                newface = bm2.faces.new(verts)
+            # polygon counts add up, so most candidates are ruled out without building their stats
+            candidates = np.flatnonzero(alive & (poly_counts + poly_count <= self.max_polys))
+            for y in candidates[np.argsort(distances[candidates], kind='stable')].tolist():
+                if y == x:
+                    continue
                 
-                # copy properties
-                newface.material_index = face.material_index
-                newface.smooth = face.smooth
+                faces = np.sort(np.concatenate((buckets[x], buckets[y])))
+                merged_stats = self.get_bucket_stats(arrays, faces)
+                if not self.fits_budget(merged_stats):
+                    continue
                 
-                # copy layers
-                loop_count = len(face.loops)
-                for x in range(loop_count):
-                    loop_new = newface.loops[x]
-                    loop_old = face.loops[x]
-                    
-                    for color_layer in bm_colors:
-                        color_layer_old = bm.loops.layers.color[color_layer[0]]
-                        color_layer_new = bm2.loops.layers.color[color_layer[0]]
-                        loop_new[color_layer_new] = loop_old[color_layer_old]
-                    for uv_layer in bm_uvs:
-                        uv_layer_old = bm.loops.layers.uv[uv_layer[0]]
-                        uv_layer_new = bm2.loops.layers.uv[uv_layer[0]]
-                        loop_new[uv_layer_new].uv = loop_old[uv_layer_old].uv
+                buckets[y] = faces
+                buckets[x] = None
+                alive[x] = False
+                poly_counts[y] = merged_stats[0]
+                centers[y] = (merged_stats[2] + merged_stats[3]) / 2
+                if poly_counts[y] < self.min_polys:
+                    heapq.heappush(small, (poly_counts[y], y))
+                break
             
-            bm2.faces.ensure_lookup_table()        
-        
-        return self.meshes
\ No newline at end of file
+        return [buckets[x] for x in np.flatnonzero(alive).tolist()]
+
+    def split_by_layer(self, bm, layer):
+        """Return a list of bmeshes, one per distinct value of an int face layer, in ascending order"""
+        self.meshes = list(self.iter_split_by_layer(bm, layer))
+        return self.meshes
+
+    def iter_split_by_layer(self, bm, layer):
+        """Yield one bmesh per distinct value of an int face layer, in ascending order"""
+        values = np.fromiter((face[layer] for face in bm.faces), dtype=np.int64, count=len(bm.faces))
+        yield from self.iter_bucket_meshes(self.get_mesh_arrays(bm), values)
+
+    def iter_bucket_meshes(self, arrays, face_buckets):
+        """Copy the faces of each bucket out into a new bmesh, in ascending bucket order.
+           Meshes are made one at a time so the caller can free them as it goes"""
+        face_order = np.argsort(face_buckets, kind='stable')
+        bucket_starts = np.unique(face_buckets[face_order], return_index=True)[1]
+        bucket_ends = np.append(bucket_starts[1:], len(face_order))
+
+        for start, end in zip(bucket_starts.tolist(), bucket_ends.tolist()):
+            yield self.make_bucket_mesh(arrays, face_order[start:end])
+
+    def get_bucket_loops(self, arrays, faces):
+        """Return the loops of each face, in order"""
+        loop_totals = arrays["loop_total"][faces]
+        bucket_loop_starts = np.cumsum(loop_totals) - loop_totals
+        return np.repeat(arrays["loop_start"][faces] - bucket_loop_starts, loop_totals) + np.arange(int(loop_totals.sum()))
+
+    def make_bucket_mesh(self, arrays, faces):
+        """Build a bmesh out of a subset of faces"""
+        loop_totals = arrays["loop_total"][faces]
+        loops = self.get_bucket_loops(arrays, faces)
+
+        # remap verts, in order of first use
+        used_verts, first_use, inverse = np.unique(arrays["loop_verts"][loops], return_index=True, return_inverse=True)
+        order = np.argsort(first_use, kind='stable')
+        remap = np.empty(len(used_verts), dtype=np.int64)
+        remap[order] = np.arange(len(used_verts))
+        bucket_verts = used_verts[order]
+
+        # create new bmesh
+        me = bpy.data.meshes.new("split_temp")
+        meshbuilder.mesh_from_arrays(me, arrays["co"][bucket_verts], remap[inverse], loop_totals,
+                                     material_indices = arrays["material_index"][faces],
+                                     smooth = arrays["use_smooth"][faces],
+                                     uv_layers = [(name, uvs[loops]) for name, uvs in arrays["uv_layers"]],
+                                     color_layers = [(name, colors[loops]) for name, colors in arrays["color_layers"]])
+
+        bm2 = bmesh.new()
+        bm2.from_mesh(me)
+        bpy.data.meshes.remove(me)
+
+        # restore full precision normals
+        for vert, normal in zip(bm2.verts, arrays["normals"][bucket_verts].tolist()):
+            vert.normal = normal
+
+        bm2.verts.ensure_lookup_table()
+        bm2.verts.index_update()
+        bm2.faces.ensure_lookup_table()
+        return bm2
@@ -1,6 +1,24 @@
 import math
 import bmesh
+import numpy as np
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
+
+# face / cell pairs tested at once, keeps memory use flat on big meshes
+PAIR_CHUNK_SIZE = 262144
+
+# how far sections reach into their neighbours
+BOUNDS_INFLATION = 1
+
+# cell sizes tried by the automatic grid size
+GRID_SIZE_CANDIDATES = (128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 3072, 4096)
+
+# candidates with more cells than this are skipped
+GRID_MAX_CELLS = 512 * 512
+
+# query cost weights, see get_grid_cost
+GRID_COST_MAX_WEIGHT = 0.1
+GRID_COST_INDEX_WEIGHT = 1.0
 
 ######################################################
 # HELPERS
@@ -48,6 +66,96 @@ def point_in_polygon(p, vertices):
         p1x, p1y = p2x, p2y
 
     return inside
+
+
+def points_in_polygons(px, py, poly_x, poly_y, sizes):
+    """point_in_polygon over arrays, (P, K) points against (P, 4) padded polygons with sizes corners"""
+    inside = np.zeros(px.shape, dtype=bool)
+    rows = np.arange(len(sizes))
+    
+    # edge i goes from corner i - 1 to corner i, wrapping back to corner 0
+    for i in range(1, 5):
+        valid = i <= sizes
+        p2_index = np.where(i == sizes, 0, np.minimum(i, 3))
+        p1x = poly_x[:, i - 1, None]
+        p1y = poly_y[:, i - 1, None]
+        p2x = poly_x[rows, p2_index][:, None]
+        p2y = poly_y[rows, p2_index][:, None]
+        
+        crosses = valid[:, None] & (py > np.minimum(p1y, p2y)) & (py <= np.maximum(p1y, p2y)) & (px <= np.maximum(p1x, p2x))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xinters = (py - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+        inside ^= crosses & ((p1x == p2x) | (px <= xinters))
+        
+    return inside
+    
+
+def edges_intersect_arrays(p1, p2, p3, p4):
+    """edges_intersect over arrays of (..., 2) points"""
+    a, b = p1[..., 0], p1[..., 1]
+    c, d = p2[..., 0], p2[..., 1]
+    p, q = p3[..., 0], p3[..., 1]
+    r, s = p4[..., 0], p4[..., 1]
+
+    det = (c - a) * (s - q) - (r - p) * (d - b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lmbda = ((s - q) * (r - a) + (p - r) * (s - b)) / det
+        gamma = ((b - d) * (r - a) + (c - a) * (s - b)) / det
+    return (np.abs(det) >= 0.001) & (0 < lmbda) & (lmbda < 1) & (0 < gamma) & (gamma < 1)
+
+
+def points_in_bounds(bmin, bmax, p):
+    """point_in_bounds over arrays"""
+    return (p[..., 0] >= bmin[..., 0]) & (p[..., 1] >= bmin[..., 1]) & (p[..., 0] <= bmax[..., 0]) & (p[..., 1] <= bmax[..., 1])
+
+
+def get_grid_stats(grid):
+    """Return (cell count, average faces per non empty merged cell, max faces per merged cell, total indices written)"""
+    counts = np.diff(grid.final_offsets)
+    used = counts[counts > 0]
+    average = float(used.mean()) if len(used) > 0 else 0.0
+    maximum = int(counts.max()) if len(counts) > 0 else 0
+    return (len(counts), average, maximum, len(counts) + len(grid.final_faces))
+
+
+def get_grid_cost(stats, face_count):
+    """Estimated cost of a grid for the game. Faces tested by a typical query, plus
+       a share of the worst cell and the index count relative to the face count"""
+    cell_count, average, maximum, total_indices = stats
+    return average + GRID_COST_MAX_WEIGHT * maximum + GRID_COST_INDEX_WEIGHT * total_indices / max(face_count, 1)
+
+
+def get_grid_cell_count(corners, size):
+    corners = np.asarray(corners)
+    extent = corners.max(axis=(0, 1)) - corners.min(axis=(0, 1))
+    
+    # Blender x and y are the grid width and depth
+    return max(1, math.ceil(extent[0] / size)) * max(1, math.ceil(extent[1] / size))
+
+
+def make_auto_grid(corners, face_sizes, edge_flips = None, candidates = GRID_SIZE_CANDIDATES):
+    """Build a merged grid for each candidate size and keep the cheapest.
+       Returns (grid, [(size, stats, cost)]) with a row per tried size"""
+    sizes = [size for size in candidates if get_grid_cell_count(corners, size) <= GRID_MAX_CELLS]
+    if len(sizes) == 0:
+        sizes = [max(candidates)]
+    
+    best_grid = None
+    best_cost = float('inf')
+    table = []
+    for size in sizes:
+        grid = CollisionGrid(size)
+        grid.make_from_arrays(corners, face_sizes, edge_flips)
+        grid.merge_neighbouring_buckets()
+        
+        stats = get_grid_stats(grid)
+        cost = get_grid_cost(stats, len(corners))
+        table.append((size, stats, cost))
+        if cost < best_cost:
+            best_grid = grid
+            best_cost = cost
+            
+    return (best_grid, table)
   
 ######################################################
 # CLASSES
@@ -62,135 +170,206 @@ class CollisionBucket:
         
 class CollisionGrid:
     def make_from_bmesh(self, bm):
+        """Fill buckets with the faces of a bmesh"""
         faces_count = len(bm.faces)
-        face_bounds = []
+        corners = np.zeros((faces_count, 4, 3), dtype=np.float64)
+        face_sizes = np.zeros(faces_count, dtype=np.int64)
+        edge_flips = np.zeros((faces_count, 4), dtype=bool)
+        
+        for facenum, face in enumerate(bm.faces):
+            loops = face.loops
+            face_sizes[facenum] = len(loops)
+            corners[facenum] = loops[0].vert.co
+            for x, loop in enumerate(loops):
+                corners[facenum, x] = loop.vert.co
+                edge_flips[facenum, x] = loop.edge.verts[0] != loop.vert
+                
+        self.make_from_arrays(corners, face_sizes, edge_flips)
+        self.make_buckets()
+        
+    def make_cells(self):
+        """Per cell (x, z) section bounds, cell index is depth * width + width"""
+        section_width = (1 / self.width_sections) * (self.bnds_max[0] - self.bnds_min[0])
+        section_depth = (1 / self.depth_sections) * (self.bnds_max[2] - self.bnds_min[2])
+        
+        w = np.arange(self.width_sections)
+        d = np.arange(self.depth_sections)
+        self.section_min_x = (self.bnds_min[0] + (w * section_width)) - BOUNDS_INFLATION
+        self.section_max_x = (self.bnds_min[0] + ((w + 1) * section_width)) + BOUNDS_INFLATION
+        self.section_min_z = (self.bnds_min[2] + (d * section_depth)) - BOUNDS_INFLATION
+        self.section_max_z = (self.bnds_min[2] + ((d + 1) * section_depth)) + BOUNDS_INFLATION
     
+    def get_candidate_pairs(self, face_min, face_max):
+        """Return (faces, cells) for every cell whose section bounds overlap a face's bounds, in face order"""
+        # section bounds only grow along each axis, so the overlapping sections of a face are a contiguous range
+        w_start = np.searchsorted(self.section_max_x, face_min[:, 0], side='left')
+        w_end = np.searchsorted(self.section_min_x, face_max[:, 0], side='right')
+        d_start = np.searchsorted(self.section_max_z, face_min[:, 2], side='left')
+        d_end = np.searchsorted(self.section_min_z, face_max[:, 2], side='right')
+        
+        w_count = np.maximum(w_end - w_start, 0)
+        d_count = np.maximum(d_end - d_start, 0)
+        pair_counts = w_count * d_count
+        
+        faces = np.repeat(np.arange(len(face_min)), pair_counts)
+        local = np.arange(len(faces)) - np.repeat(np.cumsum(pair_counts) - pair_counts, pair_counts)
+        w = w_start[faces] + local % np.maximum(w_count[faces], 1)
+        d = d_start[faces] + local // np.maximum(w_count[faces], 1)
+        return (faces, d * self.width_sections + w)
+        
+    def test_pairs(self, faces, cells, face_min, face_max, face_2d, face_sizes, edges_2d):
+        """The face / section overlap test, for arrays of face and cell pairs"""
+        w = cells % self.width_sections
+        d = cells // self.width_sections
+        sec_min = np.stack((self.section_min_x[w], self.section_min_z[d]), axis=-1)
+        sec_max = np.stack((self.section_max_x[w], self.section_max_z[d]), axis=-1)
+        
+        hit = ((face_min[faces, 0] <= sec_max[:, 0]) & (face_max[faces, 0] >= sec_min[:, 0]) &
+               (face_min[faces, 2] <= sec_max[:, 1]) & (face_max[faces, 2] >= sec_min[:, 1]))
+        
+        # face checks, does the polygon surround a corner of the section
+        sec_poly_x = np.stack((sec_min[:, 0], sec_max[:, 0], sec_max[:, 0], sec_min[:, 0]), axis=-1)
+        sec_poly_y = np.stack((sec_min[:, 1], sec_min[:, 1], sec_max[:, 1], sec_max[:, 1]), axis=-1)
+        isect = points_in_polygons(sec_poly_x, sec_poly_y, face_2d[faces, :, 0], face_2d[faces, :, 1], face_sizes[faces]).any(axis=1)
+        
+        # edge checks, an end inside the section or crossing one of its edges
+        v0 = edges_2d[faces, :, 0]
+        v1 = edges_2d[faces, :, 1]
+        edge_valid = np.arange(4) < face_sizes[faces, None]
+        bmin = sec_min[:, None]
+        bmax = sec_max[:, None]
+        edge_isect = points_in_bounds(bmin, bmax, v0) | points_in_bounds(bmin, bmax, v1)
+        
+        edge_is_vertical = (v0[..., 0] == v1[..., 0]) & (v0[..., 1] == v1[..., 1])
+        sec_corners = np.stack((sec_min, np.stack((sec_max[:, 0], sec_min[:, 1]), axis=-1), sec_max, np.stack((sec_min[:, 0], sec_max[:, 1]), axis=-1)), axis=1)
+        for start, end in ((0, 1), (1, 2), (3, 2), (0, 3)):
+            edge_isect |= ~edge_is_vertical & edges_intersect_arrays(sec_corners[:, None, start], sec_corners[:, None, end], v0, v1)
+        isect |= (edge_isect & edge_valid).any(axis=1)
+        
+        return hit & isect
+        
+    def make_from_arrays(self, corners, face_sizes, edge_flips = None):
+        """Fill buckets from (N, 4, 3) Blender space face corners. Edges run from corner x to x + 1,
+           edge_flips swaps the ends of an edge to match the vertex order of the mesh edge"""
+        corners = rvcodec.vec3_array_to_revolt(np.asarray(corners, dtype=np.float64))
+        face_sizes = np.asarray(face_sizes, dtype=np.int64)
+        faces_count = len(corners)
+        if edge_flips is None:
+            edge_flips = np.zeros((faces_count, 4), dtype=bool)
+        
+        # triangles repeat their first corner so the padding doesn't change bounds
+        slots = np.where(np.arange(4) < face_sizes[:, None], np.arange(4), 0)
+        corners = corners[np.arange(faces_count)[:, None], slots]
+        face_min = corners.min(axis=1)
+        face_max = corners.max(axis=1)
+        
         # get min and max bounds
-        bnds_min = [float('inf'),float('inf'),float('inf')]
-        bnds_max = [float('-inf'),float('-inf'),float('-inf')]
-        for face in bm.faces:
-            face_bnd = common.face_bounds_rv(face)
-            face_bnd_min, face_bnd_max = face_bnd
-            face_bounds.append(face_bnd)
-            
-            for x in range(3):
-                bnds_min[x] = min(bnds_min[x], face_bnd_min[x])
-                bnds_max[x] = max(bnds_max[x], face_bnd_max[x])
+        self.bnds_min = face_min.min(axis=0).tolist()
+        self.bnds_max = face_max.max(axis=0).tolist()
+        self.depth_sections = max(1, math.ceil((self.bnds_max[2] - self.bnds_min[2]) / self.size))
+        self.width_sections = max(1, math.ceil((self.bnds_max[0] - self.bnds_min[0]) / self.size))
+        self.make_cells()
         
-        self.bnds_min = bnds_min
-        self.bnds_max = bnds_max        
+        # 2d representation of the faces, and their edges
+        face_2d = corners[..., [0, 2]]
+        edge_starts = np.broadcast_to(np.arange(4), (faces_count, 4))
+        edge_ends = np.stack((edge_starts, np.where(edge_starts + 1 < face_sizes[:, None], edge_starts + 1, 0)), axis=-1)
+        edge_ends = np.where(edge_flips[..., None], edge_ends[..., ::-1], edge_ends)
+        edges_2d = face_2d[np.arange(faces_count)[:, None, None], edge_ends]
         
-        depth_sections = math.ceil((bnds_max[2] - bnds_min[2]) / self.size)
-        width_sections = math.ceil((bnds_max[0] - bnds_min[0]) / self.size)
-        self.depth_sections = depth_sections
-        self.width_sections = width_sections
+        # only test the cells a face's bounds reach
+        pair_faces, pair_cells = self.get_candidate_pairs(face_min, face_max)
+        keep = np.zeros(len(pair_faces), dtype=bool)
+        for start in range(0, len(pair_faces), PAIR_CHUNK_SIZE):
+            end = start + PAIR_CHUNK_SIZE
+            keep[start:end] = self.test_pairs(pair_faces[start:end], pair_cells[start:end], face_min, face_max, face_2d, face_sizes, edges_2d)
         
-        individual_section_depth = (1 / depth_sections) * (bnds_max[2] - bnds_min[2])
-        individual_section_width = (1 / width_sections) * (bnds_max[0] - bnds_min[0])
+        # faces per cell, in face order
+        pair_faces = pair_faces[keep]
+        pair_cells = pair_cells[keep]
+        order = np.argsort(pair_cells, kind='stable')
+        self.cell_faces = pair_faces[order]
+        self.cell_offsets = np.zeros(self.depth_sections * self.width_sections + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_cells, minlength=self.depth_sections * self.width_sections), out=self.cell_offsets[1:])
         
-        # create sections structures
-        for d in range(depth_sections):
-          for w in range(width_sections):
-            BOUNDS_INFLATION = 1
-            section_bnds_min = ((bnds_min[0] + (w * individual_section_width)) - BOUNDS_INFLATION, (bnds_min[2] + (d * individual_section_depth)) - BOUNDS_INFLATION)
-            section_bnds_max = ((bnds_min[0] + ((w + 1) * individual_section_width)) + BOUNDS_INFLATION, (bnds_min[2] + ((d + 1) * individual_section_depth)) + BOUNDS_INFLATION)
+    def make_buckets(self):
+        """Create section structures from the cell arrays. Big grids are better read from the arrays directly"""
+        self.buckets = []
+        cell_faces = self.cell_faces.tolist()
+        cell_offsets = self.cell_offsets.tolist()
+        for d in range(self.depth_sections):
+          for w in range(self.width_sections):
+            section_bnds_min = (float(self.section_min_x[w]), float(self.section_min_z[d]))
+            section_bnds_max = (float(self.section_max_x[w]), float(self.section_max_z[d]))
 
             section_edges = (((section_bnds_min[0], section_bnds_min[1]), (section_bnds_max[0], section_bnds_min[1])), ((section_bnds_max[0], section_bnds_min[1]), (section_bnds_max[0], section_bnds_max[1])),
                              ((section_bnds_min[0], section_bnds_max[1]), (section_bnds_max[0], section_bnds_max[1])), ((section_bnds_min[0], section_bnds_min[1]), (section_bnds_min[0], section_bnds_max[1])))
             section_poly = ((section_bnds_min[0], section_bnds_min[1]), (section_bnds_max[0], section_bnds_min[1]), (section_bnds_max[0], section_bnds_max[1]), (section_bnds_min[0], section_bnds_max[1]))
            
             # (self, bounds_min, bounds_max, edges, polygon):
-            self.buckets.append(CollisionBucket(section_bnds_min, section_bnds_max, section_edges, section_poly))
-        
-        # loop through faces and find faces in each section
-        for face, facenum in zip(bm.faces, range(faces_count)):
-          # make a 2d representation of this face
-          face_2d = []
-          for loop in face.loops:
-            vert_revolt = common.vec3_to_revolt(loop.vert.co)
-            face_2d.append((vert_revolt[0], vert_revolt[2]))
-            
-          # get bounds
-          face_min, face_max = face_bounds[facenum]
-          
-          # check each section to see if the face is contained
-          for bucket in self.buckets:
-            section_bnds_min, section_bnds_max = bucket.bounds
-            face_list = bucket.indices
-            
-            if not bounds_intersect_3d2d(face_min, face_max, section_bnds_min, section_bnds_max):
-              continue
-              
-            isect = False
-            
-            # face checks
-            # check if this polygon surrounds this section
-            section_poly = bucket.polygon
-            for p in section_poly:
-              isect |= point_in_polygon(p, face_2d)
-              if isect:
-                break
-                  
-            # edge checks
-            if not isect:
-              for edge in face.edges:
-                if isect:
-                    break
-                    
-                v0_3d = common.vec3_to_revolt(edge.verts[0].co)
-                v1_3d = common.vec3_to_revolt(edge.verts[1].co)
-                v0 = (v0_3d[0], v0_3d[2])
-                v1 = (v1_3d[0], v1_3d[2])
-                
-                isect |= point_in_bounds(section_bnds_min, section_bnds_max, v0)
-                if not isect:
-                    isect |= point_in_bounds(section_bnds_min, section_bnds_max, v1)
-                
-                # more expensive edge-edge intersect testing (only if edge is not vertical)
-                edge_is_vertical = v0[0] == v1[0] and v0[1] == v1[1]
-                if not isect and not edge_is_vertical:
-                    section_edges = bucket.edges
-                    for se in section_edges:
-                        isect |= edges_intersect(se[0], se[1], v0, v1)
-                        if isect:
-                            break
-                
-            if isect:
-              face_list.append(facenum)
+            bucket = CollisionBucket(section_bnds_min, section_bnds_max, section_edges, section_poly)
+            cell = (d * self.width_sections) + w
+            bucket.indices = cell_faces[cell_offsets[cell]:cell_offsets[cell + 1]]
+            self.buckets.append(bucket)
 
     def merge_neighbouring_buckets(self):
-        # merge neighbouring buckets
-        total_sections = self.depth_sections * self.width_sections
-        for d in range(self.depth_sections):
-          for w in range(self.width_sections):
-            bucket = self.buckets[(d * self.width_sections) + w]
-            face_list = bucket.indices
-            final_face_list = bucket.final_indices
-            final_face_list += face_list
-            
-            for d2 in range(-1, 2):
-                for w2 in range(-1, 2):
-                    if d2 == 0 and w2 == 0:
-                        continue
-                
-                    other_bucket_index = ((d + d2) * self.width_sections) + (w+w2)
-                    if other_bucket_index >= 0 and other_bucket_index < total_sections:
-                        other_bucket = self.buckets[other_bucket_index]
-                        other_bucket_face_list = other_bucket.indices
-                        final_face_list += other_bucket_face_list
-
-            # finally, keep only distinct values
-            bucket.final_indices = list(set(final_face_list))
+        """Each cell also gets the faces of the 8 cells around it, sorted and without duplicates"""
+        cell_count = self.depth_sections * self.width_sections
+        face_count = int(self.cell_faces.max()) + 1 if len(self.cell_faces) > 0 else 1
+        
+        cells = np.repeat(np.arange(cell_count), np.diff(self.cell_offsets))
+        d = cells // self.width_sections
+        w = cells % self.width_sections
+        
+        # spread every (cell, face) pair to its neighbours, dropping the ones past the grid edges
+        keys = []
+        for d2 in range(-1, 2):
+            for w2 in range(-1, 2):
+                valid = (d + d2 >= 0) & (d + d2 < self.depth_sections) & (w + w2 >= 0) & (w + w2 < self.width_sections)
+                other_cells = (d[valid] + d2) * self.width_sections + (w[valid] + w2)
+                keys.append(other_cells * face_count + self.cell_faces[valid])
+        
+        # sorting by cell then face puts duplicates next to each other
+        keys = np.sort(np.concatenate(keys))
+        keys = keys[np.append(True, keys[1:] != keys[:-1])] if len(keys) > 0 else keys
+        self.set_final(keys // face_count, keys % face_count, cell_count)
+        
+    def set_final(self, cells, faces, cell_count):
+        """Store the final faces of each cell from cell ordered (cell, face) pairs"""
+        self.final_faces = faces
+        self.final_offsets = np.zeros(cell_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=cell_count), out=self.final_offsets[1:])
+        if len(self.buckets) == 0:
+            return
+        
+        final_faces = self.final_faces.tolist()
+        final_offsets = self.final_offsets.tolist()
+        for cell, bucket in enumerate(self.buckets):
+            bucket.final_indices = final_faces[final_offsets[cell]:final_offsets[cell + 1]]
 
     def finalize(self):
-        for bucket in self.buckets:
-            bucket.final_indices = []
-            bucket.final_indices += bucket.indices
+        cell_count = self.depth_sections * self.width_sections
+        self.set_final(np.repeat(np.arange(cell_count), np.diff(self.cell_offsets)), self.cell_faces, cell_count)
+        
+    def get_final_buffer(self):
+        """The grid cells as written to file, each a face count followed by the face indices"""
+        counts = np.diff(self.final_offsets)
+        buffer = np.empty(len(counts) + len(self.final_faces), dtype="<u4")
+        count_positions = self.final_offsets[:-1] + np.arange(len(counts))
+        is_face = np.ones(len(buffer), dtype=bool)
+        is_face[count_positions] = False
+        buffer[count_positions] = counts
+        buffer[is_face] = self.final_faces
+        return buffer.tobytes()
     
     def __init__(self, size):
         self.bnds_min = [0, 0, 0]
         self.bnds_max = [0, 0, 0]
         self.buckets = []
+        self.cell_offsets = np.zeros(1, dtype=np.int64)
+        self.cell_faces = np.zeros(0, dtype=np.int64)
+        self.final_offsets = np.zeros(1, dtype=np.int64)
+        self.final_faces = np.zeros(0, dtype=np.int64)
         self.size = size
         self.size_squared = size * size
         self.width_sections = 0
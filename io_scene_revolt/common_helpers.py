@@ -25,10 +25,17 @@ COLL_FLAG_CAMERA_ONLY = 0x08
 RV_SCALE = 10
 BCUBE_SIZE = 12500
 
+# how far from rectangular joined quads may be, Blender's own default
+QUAD_SHAPE_THRESHOLD = math.radians(40)
+
 PSX_VERTEX_DIVISOR = 8.0
 PSX_NORMAL_DIVISOR = 4096.0
 PSX_VERTEX_DIVISOR_32 = 4096.0
 
+# merged world imports tag faces with their original mesh index
+MESH_INDEX_LAYER = "rv_mesh_index"
+MESH_BOUNDS_PROP = "rv_mesh_bounds"
+
 def get_undupe_name(name):
     nidx = name.find('.')
     return name[:nidx] if nidx != -1 else name
@@ -117,6 +124,19 @@ def prepare_bmesh(bm, max_sides=4):
         bmesh.ops.triangulate(bm, faces=tria_faces, quad_method='BEAUTY', ngon_method='BEAUTY')
 
 
+def join_triangles(bm, tolerance, faces=None, compare_loop_data=True):
+    """Merge neighbouring triangles into quads when their normals are within tolerance. Returns the number of quads formed"""
+    tria_faces = [face for face in (bm.faces if faces is None else faces) if len(face.loops) == 3]
+    if len(tria_faces) < 2:
+        return 0
+    
+    face_count = len(bm.faces)
+    bmesh.ops.join_triangles(bm, faces=tria_faces, cmp_seam=False, cmp_sharp=False,
+                             cmp_uvs=compare_loop_data, cmp_vcols=compare_loop_data, cmp_materials=True,
+                             angle_face_threshold=tolerance, angle_shape_threshold=QUAD_SHAPE_THRESHOLD)
+    return face_count - len(bm.faces)
+
+
 def bounds(obj, local=False):
     local_coords = obj.bound_box[:]
     if not local:    
@@ -359,7 +379,10 @@ def get_texnum_from_material(material):
     if material is None:
         return -1
         
-    texture = get_material_texture(material)
+    return get_texnum_from_image(get_material_texture(material))
+    
+    
+def get_texnum_from_image(texture):
     if texture is None or texture.filepath == "": # default
         return -1
         
@@ -1,8 +1,9 @@
-import time, struct, sys, math
+import time, sys, math
 import bpy, bmesh, mathutils
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
 
 
 ######################################################
@@ -30,7 +31,7 @@ def save(operator,
     file = open(filepath, 'wb')
     
     # write chulls
-    file.write(struct.pack("<H", len(hull_objs)))
+    file.write(rvcodec.U16_STRUCT.pack(len(hull_objs)))
     for ob in hull_objs:
         # get bmesh
         bm = common.get_bmesh(ob, apply_modifiers = apply_modifiers)
@@ -56,44 +57,44 @@ def save(operator,
         bnds_min, bnds_max = common.bounds_scaled_rv(ob, common.RV_SCALE, not apply_transform)
         
         # write hull
-        file.write(struct.pack("<HHH", len(verts), len(bm.edges), len(bm.faces)))
-        
-        file.write(struct.pack("<ff", bnds_min[0], bnds_max[0]))
-        file.write(struct.pack("<ff", bnds_min[1], bnds_max[1]))
-        file.write(struct.pack("<ff", bnds_min[2], bnds_max[2]))
-        
+        edges = [edge for edge in bm.edges if not edge.is_wire]
         center = ((bnds_min[0] + bnds_max[0]) / 2, (bnds_min[1] + bnds_max[1]) / 2, (bnds_min[2] + bnds_max[2]) / 2)
-        file.write(struct.pack("<fff", *center))
         
+        buffer = rvcodec.new_buffer(rvcodec.HULL_HEADER_STRUCT)
+        buffer += rvcodec.new_buffer(rvcodec.VEC3_STRUCT, len(verts))
+        buffer += rvcodec.new_buffer(rvcodec.HULL_EDGE_STRUCT, len(edges))
+        buffer += rvcodec.new_buffer(rvcodec.HULL_PLANE_STRUCT, len(bm.faces))
+        
+        offset = rvcodec.pack_into(rvcodec.HULL_HEADER_STRUCT, buffer, 0, len(verts), len(bm.edges), len(bm.faces),
+                                   bnds_min[0], bnds_max[0], bnds_min[1], bnds_max[1], bnds_min[2], bnds_max[2], *center)
         
         for vert in verts:
-            file.write(struct.pack("<fff", *common.vec3_to_revolt(vert.co)))
+            offset = rvcodec.pack_into(rvcodec.VEC3_STRUCT, buffer, offset, *common.vec3_to_revolt(vert.co))
             
-        for edge in bm.edges:
-            if not edge.is_wire:
-                i0 = vert_remap[edge.verts[0].index]
-                i1 = vert_remap[edge.verts[1].index]
-                
-                file.write(struct.pack("<HH", i0, i1))
+        for edge in edges:
+            i0 = vert_remap[edge.verts[0].index]
+            i1 = vert_remap[edge.verts[1].index]
+            
+            offset = rvcodec.pack_into(rvcodec.HULL_EDGE_STRUCT, buffer, offset, i0, i1)
                 
         for face in bm.faces:
             normal = face.normal
             dist = -normal.dot(face.verts[0].co)
             
-            file.write(struct.pack("<fff", *common.vec3_to_revolt(normal)))
-            file.write(struct.pack("<f", dist))
+            offset = rvcodec.pack_into(rvcodec.HULL_PLANE_STRUCT, buffer, offset, *common.vec3_to_revolt(normal), dist)
+        
+        file.write(buffer)
                 
         # cleanup
         bm.free()
         
     # write spheres
-    file.write(struct.pack("<H", len(sphere_objs)))
+    file.write(rvcodec.U16_STRUCT.pack(len(sphere_objs)))
     for sph in sphere_objs:
         location = common.vec3_to_revolt(sph.location)
         radius = ((sph.scale[0] + sph.scale[1] + sph.scale[2]) / 3) * common.RV_SCALE
         
-        file.write(struct.pack("<fff", location[0] * common.RV_SCALE, location[1] * common.RV_SCALE, location[2] * common.RV_SCALE))
-        file.write(struct.pack("<f", radius))
+        file.write(rvcodec.HULL_SPHERE_STRUCT.pack(location[0] * common.RV_SCALE, location[1] * common.RV_SCALE, location[2] * common.RV_SCALE, radius))
     
     # cleanup
     file.close()
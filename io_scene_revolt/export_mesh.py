@@ -1,98 +1,232 @@
-import time, struct, sys
+import time, sys, math, itertools
+import numpy as np
 import bpy, bmesh, mathutils
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
-from io_scene_revolt.rvexportmaterialinfo import RVExportMaterialInfo
+import io_scene_revolt.rvcodec as rvcodec
+import io_scene_revolt.vcacheopt as vcacheopt
+import io_scene_revolt.materialcache as materialcache
+from io_scene_revolt.materialcache import get_material_info
+
+######################################################
+# HELPERS
+######################################################
+def get_material_info_arrays(ob, is_world):
+    """Returns per slot (flags, texnum, alpha, alpha override mask, env mask) arrays, with the default material last"""
+    default_material_info = get_material_info(None, is_world)
+    material_info = []
+    for x in range(len(ob.material_slots)):
+        mat = ob.material_slots[x].material
+        info = get_material_info(mat, is_world)
+        material_info.append(info)
+    material_info.append(default_material_info)
+    
+    flags = np.array([info.flags for info in material_info], dtype=np.uint16)
+    texnums = np.array([info.texnum for info in material_info], dtype=np.int16)
+    alphas = np.array([info.alpha for info in material_info], dtype=np.float64)
+    alpha_override = np.array([not info.mul_vertex_color for info in material_info], dtype=bool)
+    env = np.array([info.is_env for info in material_info], dtype=bool)
+    
+    return (material_info, flags, texnums, alphas, alpha_override, env)
+
+
+def get_bmesh_arrays(bm, uv_layer, vc_layer):
+    """Pull vertex and loop data out of a bmesh in single passes"""
+    faces = bm.faces
+    vert_count = len(bm.verts)
+    
+    face_sizes = np.fromiter((len(face.loops) for face in faces), dtype=np.int64, count=len(faces))
+    loop_count = int(face_sizes.sum())
+    material_indices = np.fromiter((face.material_index for face in faces), dtype=np.int64, count=len(faces))
+    
+    loops = [loop for face in faces for loop in face.loops]
+    loop_verts = np.fromiter((loop.vert.index for loop in loops), dtype=np.int64, count=loop_count)
+    loop_colors = np.fromiter(itertools.chain.from_iterable(loop[vc_layer] for loop in loops), dtype=np.float64, count=loop_count * 4).reshape(-1, 4)
+    loop_uvs = np.fromiter(itertools.chain.from_iterable(loop[uv_layer].uv for loop in loops), dtype=np.float64, count=loop_count * 2).reshape(-1, 2)
+    
+    coords = np.fromiter(itertools.chain.from_iterable(vert.co for vert in bm.verts), dtype=np.float32, count=vert_count * 3).reshape(-1, 3)
+    normals = np.fromiter(itertools.chain.from_iterable(vert.normal for vert in bm.verts), dtype=np.float32, count=vert_count * 3).reshape(-1, 3)
+    
+    return (face_sizes, material_indices, loop_verts, loop_colors, loop_uvs, coords, normals)
+    
+    
+def get_render_state_keys(polys):
+    """(texnum, blending, double sided) per face"""
+    texnums = polys["texnum"].astype(np.int64)
+    blending = polys["type"] & (common.POLY_FLAG_TRANSLUCENT | common.POLY_FLAG_ADDITIVE)
+    double_sided = polys["type"] & common.POLY_FLAG_DOUBLESIDED
+    return np.stack((texnums, blending, double_sided), axis=-1)
+    
+    
+def get_render_state_changes(keys):
+    """Index of every face starting a new render state"""
+    return np.flatnonzero((keys[1:] != keys[:-1]).any(axis=1)) + 1
+    
+
+def get_render_state_order(polys):
+    """Return a stable order grouping faces by (texnum, blending, double sided), and the state changes before and after"""
+    keys = get_render_state_keys(polys)
+    order = np.lexsort((keys[:, 2], keys[:, 1], keys[:, 0]))
+    return (order, len(get_render_state_changes(keys)), len(get_render_state_changes(keys[order])))
+    
+    
+def optimize_vertex_cache(polys, vertex_count, keep_render_states, stats):
+    """Reorder faces for the vertex cache, then renumber vertices in first use order.
+       Returns (polys, face order, vertex order)"""
+    face_sizes = np.where(polys["type"] & common.POLY_FLAG_QUAD, 4, 3)
+    indices = polys["indices"].astype(np.int64)
+    
+    # optimize each run of faces sharing a render state on its own, so sorting is kept
+    breaks = get_render_state_changes(get_render_state_keys(polys)) if keep_render_states else np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], breaks)).tolist()
+    ends = np.concatenate((breaks, [len(polys)])).tolist()
+    face_order = np.concatenate([start + vcacheopt.tipsify(indices[start:end], face_sizes[start:end], vertex_count) for start, end in zip(starts, ends)])
+    
+    vertex_order, remap = vcacheopt.get_first_use_order(indices[face_order], face_sizes[face_order], vertex_count)
+    
+    if stats is not None:
+        misses_before, triangles = vcacheopt.get_cache_misses(indices, face_sizes)
+        misses_after, triangles = vcacheopt.get_cache_misses(indices[face_order], face_sizes[face_order])
+        stats["vcache_triangles"] = stats.get("vcache_triangles", 0) + triangles
+        stats["vcache_misses"] = stats.get("vcache_misses", 0) + misses_before
+        stats["vcache_misses_optimized"] = stats.get("vcache_misses_optimized", 0) + misses_after
+    
+    polys = polys[face_order]
+    slot_mask = np.arange(4) < face_sizes[face_order][:, None]
+    polys["indices"] = np.where(slot_mask, remap[polys["indices"]], 0)
+    return (polys, face_order, vertex_order)
+    
+    
+def to_rv_color_array(colors):
+    # same truncation as common.to_rv_color, BGRA order
+    rvcolors = (np.clip(colors, 0, 1) * 255).astype(np.uint8)
+    return rvcolors[..., [2, 1, 0, 3]]
 
 ######################################################
 # EXPORT MAIN FILES
 ######################################################
-def export_mesh(file, ob, bm, env_list, is_world):
+def export_mesh(file, ob, bm, env_list, is_world, sort_polys=False, optimize_vcache=False, merge_quads=False, quad_tolerance=math.radians(1), stats=None):
+    """Write a mesh, returns its scaled bounds in Blender space. stats collects quad, sorting and vertex cache figures"""
     # layers
     uv_layer = bm.loops.layers.uv.verify()
     vc_layer = bm.loops.layers.color.verify()
     
+    # join triangles that continue each other into quads
+    if merge_quads:
+        quads_formed = common.join_triangles(bm, quad_tolerance)
+        if stats is not None:
+            stats["quads_formed"] = stats.get("quads_formed", 0) + quads_formed
+    
     common.prepare_bmesh(bm)
     bm.verts.ensure_lookup_table()
+    bm.verts.index_update()
+    
+    face_sizes, material_indices, loop_verts, loop_colors, loop_uvs, coords, normals = get_bmesh_arrays(bm, uv_layer, vc_layer)
+    face_count = len(face_sizes)
+    buffer = []
+
+    # scaled bounds
+    scaled_min = (coords.min(axis=0).astype(np.float64) * common.RV_SCALE).tolist() if len(coords) > 0 else [float('inf')] * 3
+    scaled_max = (coords.max(axis=0).astype(np.float64) * common.RV_SCALE).tolist() if len(coords) > 0 else [float('-inf')] * 3
 
     if is_world:
         # write bounding info for world
-        me_bounds_min, me_bounds_max = common.bmesh_bounds_scaled_rv(bm, common.RV_SCALE)
+        bnds_min = common.vec3_to_revolt(scaled_min)
+        bnds_max = common.vec3_to_revolt(scaled_max)
+        me_bounds_min = (bnds_min[0], bnds_max[1], bnds_min[2])
+        me_bounds_max = (bnds_max[0], bnds_min[1], bnds_max[2])
+        
         me_center = ((me_bounds_max[0] + me_bounds_min[0]) / 2, (me_bounds_max[1] + me_bounds_min[1]) / 2, (me_bounds_max[2] + me_bounds_min[2]) / 2)
         me_radius = common.bounds_radius(me_bounds_min, me_bounds_max)
         
-        # center and radius
-        file.write(struct.pack("<fff", *me_center))
-        file.write(struct.pack("<f", me_radius))
-        
-        # bounds
-        file.write(struct.pack("<ff", me_bounds_min[0], me_bounds_max[0]))
-        file.write(struct.pack("<ff", me_bounds_min[1], me_bounds_max[1]))
-        file.write(struct.pack("<ff", me_bounds_min[2], me_bounds_max[2]))
+        # center, radius and bounds
+        buffer.append(rvcodec.WORLD_BOUNDS_STRUCT.pack(*me_center, me_radius,
+                                                       me_bounds_min[0], me_bounds_max[0],
+                                                       me_bounds_min[1], me_bounds_max[1],
+                                                       me_bounds_min[2], me_bounds_max[2]))
         
     # polygon and vertex counts
-    file.write(struct.pack("<HH", len(bm.faces), len(bm.verts)))
+    buffer.append(rvcodec.MESH_COUNTS_STRUCT.pack(face_count, len(coords)))
 
     # cache material info for faster export
-    # list of (material, principled, texnum)
-    default_material_info = RVExportMaterialInfo(None, is_world)
-    material_info = []
-    for x in range(len(ob.material_slots)):
-        mat = ob.material_slots[x].material
-        info = RVExportMaterialInfo(mat, is_world)
-        material_info.append(info)
-
-    # write faces
-    for face in bm.faces:        
-        # get flags
-        face_type = 1 if len(face.loops) == 4 else 0
-        
-        # get mat info
-        matinfo = material_info[face.material_index] if face.material_index >= 0 else default_material_info
-        face_type |= matinfo.flags
+    material_info, mat_flags, mat_texnums, mat_alphas, mat_alpha_override, mat_env = get_material_info_arrays(ob, is_world)
+    
+    # faces using a missing slot get the default material
+    material_indices = np.where((material_indices >= 0) & (material_indices < len(material_info) - 1), material_indices, len(material_info) - 1)
+    
+    # flags
+    is_quad = face_sizes == 4
+    face_types = np.where(is_quad, common.POLY_FLAG_QUAD, 0).astype(np.uint16) | mat_flags[material_indices]
+    
+    # loops are written in reverse, triangles leave the 4th slot zeroed
+    loop_slots = np.arange(4)
+    loop_mask = loop_slots < face_sizes[:, None]
+    loop_starts = np.cumsum(face_sizes) - face_sizes
+    loop_order = np.where(loop_mask, loop_starts[:, None] + face_sizes[:, None] - 1 - loop_slots, 0)
+    
+    # colors, translucent faces may take their alpha from the material
+    colors = loop_colors[loop_order]
+    alpha_override = ((face_types & common.POLY_FLAG_TRANSLUCENT) != 0) & mat_alpha_override[material_indices]
+    colors[..., 3] = np.where(alpha_override[:, None], mat_alphas[material_indices][:, None], colors[..., 3])
+    
+    polys = np.zeros(face_count, dtype=rvcodec.PRM_POLY_DTYPE)
+    polys["type"] = face_types
+    polys["texnum"] = mat_texnums[material_indices]
+    polys["indices"] = np.where(loop_mask, loop_verts[loop_order], 0)
+    polys["colors"] = np.where(loop_mask[..., None], to_rv_color_array(colors), 0)
+    polys["uvs"] = np.where(loop_mask[..., None], rvcodec.vec2_array_to_revolt(loop_uvs[loop_order]), 0)
+    
+    # group faces sharing a texture and render state
+    if sort_polys:
+        order, changes_before, changes_after = get_render_state_order(polys)
+        polys = polys[order]
+        material_indices = material_indices[order]
         
-        # write
-        file.write(struct.pack("<Hh", face_type, matinfo.texnum)) # Face Type, Tex Num
+        if stats is not None:
+            stats["state_changes"] = stats.get("state_changes", 0) + changes_before
+            stats["state_changes_removed"] = stats.get("state_changes_removed", 0) + changes_before - changes_after
+    
+    # reorder for the vertex cache
+    if optimize_vcache and face_count > 0:
+        polys, face_order, vertex_order = optimize_vertex_cache(polys, len(coords), sort_polys, stats)
+        material_indices = material_indices[face_order]
+        coords = coords[vertex_order]
+        normals = normals[vertex_order]
         
-        # Indices
-        for loop in reversed(face.loops):
-            index = loop.vert.index
-            file.write(struct.pack("<H", index))
-        if not (face_type & common.POLY_FLAG_QUAD):
-            file.write(struct.pack("<H", 0)) # index 4
+    buffer.append(polys.tobytes())
+    
+    # Env List
+    if is_world and env_list is not None:
+        env_faces = material_indices[mat_env[material_indices]]
+        env_list.extend(material_info[x].env_color for x in env_faces.tolist())
         
-        # Colors
-        for loop in reversed(face.loops):
-            color = list(loop[vc_layer])
+    # vertices
+    verts = np.zeros(len(coords), dtype=rvcodec.PRM_VERTEX_DTYPE)
+    verts["position"] = rvcodec.vec3_array_to_revolt(coords) * np.float32(common.RV_SCALE)
+    verts["normal"] = rvcodec.vec3_array_to_revolt(normals)
+    buffer.append(verts.tobytes())
+    
+    file.write(b"".join(buffer))
+    return (scaled_min, scaled_max)
+    
 
-            if face_type & common.POLY_FLAG_TRANSLUCENT:
-                if not matinfo.mul_vertex_color:
-                    color[3] = matinfo.alpha
-            
-            rvcolor = common.to_rv_color(color) 
-            file.write(struct.pack("<BBBB", *rvcolor))
-        if not (face_type & common.POLY_FLAG_QUAD):
-            file.write(struct.pack("<L", 0)) # color 4
-            
-        # UVs
-        for loop in reversed(face.loops):
-            uv = loop[uv_layer].uv
-            file.write(struct.pack("<ff", *common.vec2_to_revolt(uv)))
-        if not (face_type & common.POLY_FLAG_QUAD):
-            file.write(struct.pack("<ff", 0, 0)) # uv 4
-            
-        # Env List
-        if is_world and matinfo.is_env and env_list is not None:
-            env_list.append(matinfo.env_color)
-        
-    # write vertices
-    for vert in bm.verts:
-        vert_revolt = mathutils.Vector((common.vec3_to_revolt(vert.co))) * common.RV_SCALE
-        
-        file.write(struct.pack("<fff", vert_revolt[0], vert_revolt[1], vert_revolt[2]))
-        file.write(struct.pack("<fff", *common.vec3_to_revolt(vert.normal)))
+def report_stats(operator, stats):
+    messages = []
+    if "quads_formed" in stats:
+        messages.append("%d quads formed" % stats["quads_formed"])
+    if "state_changes" in stats:
+        messages.append("sorting removed %d of %d render state changes" % (stats["state_changes_removed"], stats["state_changes"]))
+    if stats.get("vcache_triangles", 0) > 0:
+        triangles = stats["vcache_triangles"]
+        messages.append("ACMR %.3f -> %.3f" % (stats["vcache_misses"] / triangles, stats["vcache_misses_optimized"] / triangles))
     
+    if len(messages) == 0:
+        return
+    message = ", ".join(messages)
+    print(" " + message)
+    if operator is not None:
+        operator.report({'INFO'}, message)
 
 ######################################################
 # EXPORT
@@ -101,31 +235,41 @@ def save(operator,
          context,
          filepath="",
          apply_modifiers=False,
-         apply_transform=True
+         apply_transform=True,
+         sort_polys=False,
+         optimize_vcache=False,
+         merge_quads=False,
+         quad_tolerance=math.radians(1)
          ):
     
     print("exporting Mesh: %r..." % (filepath))
     time1 = time.perf_counter()
-    
-    # get obj
-    obj = context.active_object
-    if not obj:
-        raise Exception("An object was not selected for exporting")
+    materialcache.begin()
+    try:
+        # get obj
+        obj = context.active_object
+        if not obj:
+            raise Exception("An object was not selected for exporting")
 
-    # export mesh
-    file = open(filepath, 'wb')
+        # export mesh
+        file = open(filepath, 'wb')
     
-    # get bmesh
-    bm = common.get_bmesh(obj, apply_modifiers = apply_modifiers)
+        # get bmesh
+        bm = common.get_bmesh(obj, apply_modifiers = apply_modifiers)
     
-    if apply_transform:
-        common.bm_to_world(bm, obj)
+        if apply_transform:
+            common.bm_to_world(bm, obj)
         
-    export_mesh(file, obj, bm, None, False)
+        stats = {}
+        export_mesh(file, obj, bm, None, False, sort_polys = sort_polys, optimize_vcache = optimize_vcache,
+                    merge_quads = merge_quads, quad_tolerance = quad_tolerance, stats = stats)
+        report_stats(operator, stats)
     
-    # cleanup
-    bm.free()
-    file.close()
+        # cleanup
+        bm.free()
+        file.close()
+    finally:
+        materialcache.end()
 
     # export complete
     print(" done in %.4f sec." % (time.perf_counter() - time1))
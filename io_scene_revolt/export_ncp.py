@@ -1,11 +1,110 @@
-import time, struct, sys, math
+import time, sys, math
+import numpy as np
 import bpy, bmesh, mathutils
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
 import io_scene_revolt.common_ncp as ncpcommon
-from io_scene_revolt.collisiongrid import CollisionGrid, CollisionBucket
+import io_scene_revolt.rvcodec as rvcodec
+import io_scene_revolt.collisiongrid as collisiongrid
+from io_scene_revolt.collisiongrid import CollisionGrid
 
+######################################################
+# HELPERS
+######################################################
+def get_mesh_face_arrays(me):
+    """Returns (vertex positions, loop vertex indices, loop edge flips, loop totals, material indices, face map indices) of a mesh.
+       A loop's edge is flipped when the edge starts at the next loop's vertex"""
+    co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+    me.vertices.foreach_get("co", co)
+    
+    loop_verts = np.empty(len(me.loops), dtype=np.int64)
+    me.loops.foreach_get("vertex_index", loop_verts)
+    loop_edges = np.empty(len(me.loops), dtype=np.int64)
+    me.loops.foreach_get("edge_index", loop_edges)
+    edge_verts = np.empty(len(me.edges) * 2, dtype=np.int64)
+    me.edges.foreach_get("vertices", edge_verts)
+    loop_flips = edge_verts[loop_edges * 2] != loop_verts
+    
+    loop_totals = np.empty(len(me.polygons), dtype=np.int64)
+    me.polygons.foreach_get("loop_total", loop_totals)
+    material_indices = np.empty(len(me.polygons), dtype=np.int64)
+    me.polygons.foreach_get("material_index", material_indices)
+    
+    face_maps = np.full(len(me.polygons), -1, dtype=np.int64)
+    if len(me.face_maps) > 0:
+        me.face_maps[0].data.foreach_get("value", face_maps)
+    
+    return (co.reshape(-1, 3), loop_verts, loop_flips, loop_totals, material_indices, face_maps)
+    
+
+def get_face_loops(loop_totals):
+    """Padded (N, 4) loop indices of triangles and quads, triangles repeat their first loop"""
+    loop_starts = np.cumsum(loop_totals) - loop_totals
+    slots = np.where(np.arange(4) < loop_totals[:, None], np.arange(4), 0)
+    return loop_starts[:, None] + slots
+    
+
+def normalize_rows(vectors):
+    length = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, length, out=np.zeros_like(vectors), where=length > 0)
+    
+
+def make_ncp_polys(corners, face_sizes, types, materials):
+    """Build the polyhedron table for faces given as Blender space (N, 4, 3) corners"""
+    corners = corners.astype(np.float64)
+    is_quad = face_sizes == 4
+    
+    # main plane, normals are calculated the same way bmesh does
+    normals = np.where(is_quad[:, None],
+                       np.cross(corners[:, 2] - corners[:, 0], corners[:, 3] - corners[:, 1]),
+                       np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]))
+    normals = normalize_rows(normals)
+    distances = -np.einsum("ij,ij->i", normals, corners[:, 0])
+    
+    # edge planes, walking the corners backwards
+    steps = np.arange(1, 5)
+    rows = np.arange(len(corners))[:, None]
+    sizes = face_sizes[:, None]
+    edge_a = corners[rows, (sizes - steps) % sizes]
+    edge_b = corners[rows, (sizes - steps - 1) % sizes]
+    
+    edge_normals = normalize_rows(np.cross(normals[:, None], edge_b - edge_a))
+    edge_distances = -np.einsum("ijk,ijk->ij", edge_normals, edge_a)
+    
+    polys = np.zeros(len(corners), dtype=rvcodec.NCP_POLY_DTYPE)
+    polys["type"] = types | is_quad
+    polys["material"] = materials
+    
+    planes = polys["planes"]
+    planes[:, 0, :3] = rvcodec.vec3_array_to_revolt(normals)
+    planes[:, 0, 3] = distances
+    planes[:, 1:, :3] = rvcodec.vec3_array_to_revolt(edge_normals)
+    planes[:, 1:, 3] = edge_distances
+    
+    # triangles have no 5th plane
+    planes[~is_quad, 4] = 0
+    
+    # bounds, Blender z becomes -y
+    bnds_min = corners.min(axis=1)
+    bnds_max = corners.max(axis=1)
+    polys["bounds"] = np.stack((bnds_min[:, 0], bnds_max[:, 0], -bnds_max[:, 2], -bnds_min[:, 2], bnds_min[:, 1], bnds_max[:, 1]), axis=-1)
+    return polys
+    
+
+def report_grid_sizes(operator, grid, table):
+    """Print the cost of every grid size tried, the chosen one is marked"""
+    print(" %8s %8s %8s %8s %10s %8s" % ("size", "cells", "avg", "max", "indices", "cost"))
+    for size, stats, cost in table:
+        cell_count, average, maximum, total_indices = stats
+        mark = " *" if size == grid.size else ""
+        print(" %8d %8d %8.1f %8d %10d %8.2f%s" % (size, cell_count, average, maximum, total_indices, cost, mark))
+        
+    message = "grid size %d chosen out of %d candidates" % (grid.size, len(table))
+    print(" " + message)
+    if operator is not None:
+        operator.report({'INFO'}, message)
+    
 ######################################################
 # EXPORT
 ######################################################
@@ -16,7 +115,10 @@ def save(operator,
          apply_transform=False,
          selected_only=False,
          generate_grid=False,
-         grid_size = 1024
+         grid_size = 1024,
+         grid_size_mode='FIXED',
+         merge_quads=False,
+         quad_tolerance=math.radians(1)
          ):
     
     print("exporting Collision: %r..." % (filepath))
@@ -29,15 +131,14 @@ def save(operator,
     if len(objs) == 0:
         raise Exception("Didn't find any valid objects to export")
     
-    # create a joined mesh of all of these
-    bm = bmesh.new()
-    bm_material_map = []           
-    bm_typebits_map = []
-    valid_face_count = 0
+    # join all of these as face arrays
+    mesh_arrays = []
+    vert_count = 0
+    quads_formed = 0
     
     for ob in objs:
         tempmesh = bpy.data.meshes.new("temp") # create a temporary mesh
-        bmtemp = common.get_bmesh(ob, apply_modifiers = apply_modifiers) # temporary mesh to add to the bm
+        bmtemp = common.get_bmesh(ob, apply_modifiers = apply_modifiers) # temporary mesh to read faces from
         common.prepare_bmesh(bmtemp)
 
         if apply_transform:
@@ -45,22 +146,15 @@ def save(operator,
         
         # copy out things to the maps
         fm_layer = bmtemp.faces.layers.face_map.verify()
-        for face in bmtemp.faces:
-            material = common.get_material_from_material_slot(ob, face.material_index)
-            ncp_id = ncpcommon.get_ncp_id_from_material(material)
-            bm_material_map.append(ncp_id)
-            if ncp_id is not None:
-                valid_face_count += 1
-            
-            fm_index = face[fm_layer]
-            ncp_type = 0
-            if fm_index >= 0:
-                fm_name = ob.face_maps[fm_index].name
-                if fm_name == ncpcommon.FACEMAP_CAMERA_ONLY:
-                    ncp_type |= common.COLL_FLAG_CAMERA_ONLY
-                elif fm_name == ncpcommon.FACEMAP_OBJECT_ONLY:
-                    ncp_type |= common.COLL_FLAG_OBJECT_ONLY
-            bm_typebits_map.append(ncp_type)
+        
+        # join triangles into quads, only within the same material and face map
+        if merge_quads:
+            face_groups = {}
+            for face in bmtemp.faces:
+                if len(face.loops) == 3:
+                    face_groups.setdefault((face.material_index, face[fm_layer]), []).append(face)
+            for faces in face_groups.values():
+                quads_formed += common.join_triangles(bmtemp, quad_tolerance, faces, compare_loop_data = False)
             
         # apply RV_SCALE
         for vert in bmtemp.verts:
@@ -68,88 +162,68 @@ def save(operator,
         
         bmtemp.to_mesh(tempmesh) # save temp bmesh into mesh
         bmtemp.free()
-        bm.from_mesh(tempmesh) # add temp mesh to the big mesh
+        co, loop_verts, loop_flips, loop_totals, material_indices, face_maps = get_mesh_face_arrays(tempmesh)
         bpy.data.meshes.remove(tempmesh) # delete tempmesh from scene
         
-    bm.faces.ensure_lookup_table()
+        # per slot ncp materials, faces without one aren't exported
+        slot_ids = [ncpcommon.get_ncp_id_from_material(slot.material) for slot in ob.material_slots]
+        slot_valid = np.array([x is not None for x in slot_ids] + [False], dtype=bool)
+        slot_ids = np.array([x if x is not None else 0 for x in slot_ids] + [0], dtype=np.int64)
+        slot_indices = np.where((material_indices >= 0) & (material_indices < len(ob.material_slots)), material_indices, len(ob.material_slots))
+        
+        # per face map type bits
+        fm_types = []
+        for face_map in ob.face_maps:
+            if face_map.name == ncpcommon.FACEMAP_CAMERA_ONLY:
+                fm_types.append(common.COLL_FLAG_CAMERA_ONLY)
+            elif face_map.name == ncpcommon.FACEMAP_OBJECT_ONLY:
+                fm_types.append(common.COLL_FLAG_OBJECT_ONLY)
+            else:
+                fm_types.append(0)
+        fm_types = np.array(fm_types + [0], dtype=np.int64)
+        fm_indices = np.where((face_maps >= 0) & (face_maps < len(ob.face_maps)), face_maps, len(ob.face_maps))
+        
+        mesh_arrays.append((co, loop_verts + vert_count, loop_flips, loop_totals, slot_ids[slot_indices], slot_valid[slot_indices], fm_types[fm_indices]))
+        vert_count += len(co)
+    
+    co, loop_verts, loop_flips, loop_totals, materials, valid, types = (np.concatenate(x) for x in zip(*mesh_arrays))
+    valid_face_count = int(valid.sum())
     
     if valid_face_count == 0:
-        bm.free()
         raise Exception("Found no faces with NCP materials")
         
     # export collision
     file = open(filepath, 'wb')
     
     # write polys
-    file.write(struct.pack("<H", valid_face_count))
-    for face in bm.faces:
-        # material and flags
-        ncp_material = bm_material_map[face.index]
-        if ncp_material is None:
-            continue
-        
-        vertex_count = len(face.verts)
-        ncp_type = 1 if vertex_count >= 4 else 0
-        ncp_type |= bm_typebits_map[face.index]
-        
-        # write type and surface
-        file.write(struct.pack("<Ll", ncp_type, ncp_material))
-        
-        # main plane
-        main_normal = face.normal.normalized()
-        main_pos = face.verts[0].co
-        main_distance = -main_normal.dot(main_pos)
-        
-        file.write(struct.pack("<4f", *common.vec3_to_revolt(main_normal), main_distance))
-        
-        # other planes
-        for x in range(vertex_count - 1, -1, -1):
-            x2 = (x - 1) % vertex_count
-        
-            vert_a = face.verts[x].co
-            vert_b = face.verts[x2].co
-            vert_delta = vert_b - vert_a
-            
-            plane_normal = main_normal.cross(vert_delta).normalized()
-            plane_distance = -plane_normal.dot(vert_a)
-            
-            file.write(struct.pack("<4f", *common.vec3_to_revolt(plane_normal), plane_distance))
-        
-        # plane 5
-        if vertex_count < 4:
-            file.write(struct.pack("<4f", 0, 0, 0, 0))
-        
-        # bounds
-        poly_min, poly_max = common.face_bounds_rv(face)
-
-        file.write(struct.pack("<ff", poly_min[0], poly_max[0]))
-        file.write(struct.pack("<ff", poly_min[1], poly_max[1]))
-        file.write(struct.pack("<ff", poly_min[2], poly_max[2]))
+    face_loops = get_face_loops(loop_totals)
+    corners = co[loop_verts[face_loops]]
+    polys = make_ncp_polys(corners[valid], loop_totals[valid], types[valid], materials[valid])
+    file.write(rvcodec.U16_STRUCT.pack(valid_face_count))
+    file.write(polys.tobytes())
             
-    # create and write grid
+    # create and write grid, indices point into the written polys
     if generate_grid:
-        grid = CollisionGrid(grid_size)
-        grid.make_from_bmesh(bm)
-        grid.merge_neighbouring_buckets()
+        if grid_size_mode == 'AUTO':
+            grid, table = collisiongrid.make_auto_grid(corners[valid], loop_totals[valid], loop_flips[face_loops][valid])
+            report_grid_sizes(operator, grid, table)
+        else:
+            grid = CollisionGrid(grid_size)
+            grid.make_from_arrays(corners[valid], loop_totals[valid], loop_flips[face_loops][valid])
+            grid.merge_neighbouring_buckets()
         
         # finally, write it
-        file.write(struct.pack("<ff", grid.bnds_min[0], grid.bnds_min[2]))
-        file.write(struct.pack("<ff", grid.width_sections, grid.depth_sections))
-        file.write(struct.pack("<f", grid.size))
-        
-        for bucket in grid.buckets:
-            face_list = bucket.final_indices
-            bucket_size = len(face_list)
-            
-            file.write(struct.pack("<L", bucket_size))
-            for idx in face_list:
-                file.write(struct.pack("<L", idx))
+        file.write(rvcodec.NCP_GRID_HEADER_STRUCT.pack(grid.bnds_min[0], grid.bnds_min[2], grid.width_sections, grid.depth_sections, grid.size))
+        file.write(grid.get_final_buffer())
         
     # cleanup
-    bm.free()
     file.close()
 
     # export complete
+    if merge_quads:
+        print(" %d quads formed" % quads_formed)
+        if operator is not None:
+            operator.report({'INFO'}, "%d quads formed" % quads_formed)
     print(" exported " + str(valid_face_count) + " faces")
     print(" done in %.4f sec." % (time.perf_counter() - time1))
 
@@ -1,8 +1,9 @@
-import time, struct, sys, math
+import time, sys, math
 import bpy, bmesh, mathutils
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
 
 ######################################################
 # EXPORT
@@ -55,36 +56,33 @@ def save(operator,
         raise Exception("Didn't find any valid faces to export")
         
     # write mirror planes
-    file.write(struct.pack("<H", plane_count))
+    buffer = rvcodec.new_buffer(rvcodec.U16_STRUCT)
+    buffer += rvcodec.new_buffer(rvcodec.MIRROR_PLANE_STRUCT, plane_count)
+    offset = rvcodec.pack_into(rvcodec.U16_STRUCT, buffer, 0, plane_count)
     for bm in plane_meshes:
         for face in bm.faces:
             if len(face.loops) != 4:
                 continue
 
-            # flags
-            file.write(struct.pack("<L", 1))
-            
             # plane
             main_normal = face.normal.normalized()
             main_pos = face.verts[0].co
             main_distance = -main_normal.dot(main_pos)
             
-            file.write(struct.pack("<4f", *common.vec3_to_revolt(main_normal), main_distance))
-            
             # bounds
             poly_min, poly_max = common.face_bounds_rv(face)
-
-            file.write(struct.pack("<ff", poly_min[0], poly_max[0]))
-            file.write(struct.pack("<ff", poly_min[1], poly_max[1]))
-            file.write(struct.pack("<ff", poly_min[2], poly_max[2]))
             
             # verts
+            verts = []
             for loop in face.loops:
-                vert = common.vec3_to_revolt(loop.vert.co)
-                file.write(struct.pack("<fff", *vert))
-                
+                verts += common.vec3_to_revolt(loop.vert.co)
+            
+            # flags, plane, bounds and verts
+            offset = rvcodec.pack_into(rvcodec.MIRROR_PLANE_STRUCT, buffer, offset, 1, *common.vec3_to_revolt(main_normal), main_distance,
+                                       poly_min[0], poly_max[0], poly_min[1], poly_max[1], poly_min[2], poly_max[2], *verts)
             
         bm.free()
+    file.write(buffer)
         
     # cleanup
     file.close()
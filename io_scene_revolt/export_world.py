@@ -1,17 +1,17 @@
-import time, struct, sys, math
+import time, sys, math, io
+import numpy as np
 import bpy, bmesh, mathutils
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
+import io_scene_revolt.materialcache as materialcache
+import io_scene_revolt.worldcache as worldcache
 from io_scene_revolt.bmsplit import BMeshSplitter
 
 ######################################################
 # HELPERS
 ######################################################
-def bounds_intersect(amin, amax, bmin, bmax):
-    return amin[0] <= bmax[0] and amax[0] >= bmin[0] and amin[1] <= bmax[1] and amax[1] >= bmin[1]
-
- 
 def prep_bigcube_data(mesh_list):
     scene_min = [float('inf'),float('inf'),float('inf')]
     scene_max = [float('-inf'),float('-inf'),float('-inf')]
@@ -31,8 +31,8 @@ def prep_bigcube_data(mesh_list):
     
     print("scene size " + str(scene_size_x) + "/" + str(scene_size_y))
     
-    bcubes_x = math.ceil(scene_size_x  / common.BCUBE_SIZE)
-    bcubes_y = math.ceil(scene_size_y / common.BCUBE_SIZE)
+    bcubes_x = max(1, math.ceil(scene_size_x  / common.BCUBE_SIZE))
+    bcubes_y = max(1, math.ceil(scene_size_y / common.BCUBE_SIZE))
     print("bcubes " + str(bcubes_x) + "/" + str(bcubes_y))
     
     bcube_size_x = scene_size_x / bcubes_x
@@ -58,116 +58,183 @@ def make_single_bigcube(mesh_list):
     return [(total_indices, scene_bounds, scene_center, scene_radius)]
 
 
-def make_multi_bigcube(mesh_list):
-    bcubes = []
+def get_mesh_bounds_arrays(mesh_list):
+    """Return (mesh indices, bounds min, bounds max, poly counts) arrays for every written mesh"""
+    mesh_indices = []
+    bounds_min = []
+    bounds_max = []
+    poly_counts = []
+    for ob, mesh_info_list, indices in mesh_list:
+        for mesh_info, index in zip(mesh_info_list, indices):
+            mesh_indices.append(index)
+            bounds_min.append(mesh_info[0])
+            bounds_max.append(mesh_info[1])
+            poly_counts.append(mesh_info[2])
+    
+    return (np.array(mesh_indices, dtype=np.int64),
+            np.array(bounds_min, dtype=np.float64).reshape(-1, 3),
+            np.array(bounds_max, dtype=np.float64).reshape(-1, 3),
+            np.array(poly_counts, dtype=np.int64))
+
+
+def make_bigcube_entry(me_indices, bcube_bounds_min, bcube_bounds_max):
+    bcube_center = ((bcube_bounds_max[0] + bcube_bounds_min[0]) / 2, 
+                    (bcube_bounds_max[1] + bcube_bounds_min[1]) / 2, 
+                    (bcube_bounds_max[2] + bcube_bounds_min[2]) / 2)
+    bcube_radius = common.bounds_radius(bcube_bounds_min, bcube_bounds_max)
+    
+    return (me_indices, (bcube_bounds_min, bcube_bounds_max), bcube_center, bcube_radius)
+    
 
+def make_multi_bigcube(mesh_list):
     scene_bounds, ob_bounds_all, bcubes_dim, bcubes_size = prep_bigcube_data(mesh_list)
     scene_min, scene_max = scene_bounds
     bcubes_x, bcubes_y = bcubes_dim
     bcube_size_x, bcube_size_y = bcubes_size
+    bcube_count = bcubes_x * bcubes_y
+    
+    # grid cell bounds
+    cell_x = np.arange(bcube_count) % bcubes_x
+    cell_y = np.arange(bcube_count) // bcubes_x
+    cell_min = np.stack((scene_min[0] + bcube_size_x * cell_x, scene_min[1] + bcube_size_y * cell_y), axis=-1)
+    cell_max = np.stack((scene_min[0] + bcube_size_x * (cell_x + 1), scene_min[1] + bcube_size_y * (cell_y + 1)), axis=-1)
     
-    # create bcube structures
-    for y in range(bcubes_y):
-        for x in range(bcubes_x):
-            bcube_bounds_min = [scene_min[0] + (bcube_size_x * x),       scene_min[1] + (bcube_size_y * y),       float('inf')]
-            bcube_bounds_max = [scene_min[0] + (bcube_size_x * (x + 1)), scene_min[1] + (bcube_size_y * (y + 1)), float('-inf')]
-        
-            bcube_center = ((bcube_bounds_max[0] + bcube_bounds_min[0]) / 2, 
-                            (bcube_bounds_max[1] + bcube_bounds_min[1]) / 2, 
-                            (bcube_bounds_max[2] + bcube_bounds_min[2]) / 2)
-                            
-            bcube_radius = common.bounds_radius(bcube_bounds_min, bcube_bounds_max)
-            
-            bcubes.append(([], (bcube_bounds_min, bcube_bounds_max), bcube_center, bcube_radius))
-            
     # Re-Volt stores game data in the cube structures
     # using the same index twice will result in crashing due to deallocation stuff
     # So the next step is to find the *best* bigcube for each mesh
-    bcube_mesh_data = []
-    for ob, meshes, indices in mesh_list:
-        for mesh, index in zip(meshes, indices):
-            # mesh, mesh_bounds, mesh_index, [possible_bcubes]
-            bm_bounds_min, bm_bounds_max = common.bmesh_bounds_scaled(mesh, common.RV_SCALE)
-            bcube_mesh_data.append((mesh, (bm_bounds_min, bm_bounds_max), index, []))
+    mesh_indices, bm_bounds_min, bm_bounds_max, poly_counts = get_mesh_bounds_arrays(mesh_list)
+    mesh_count = len(mesh_indices)
     
-    for mesh, mesh_bounds, mesh_index, possible_bcubes in bcube_mesh_data:
-        bm_bounds_min, bm_bounds_max = mesh_bounds
-        
-        for y in range(bcubes_y):
-            for x in range(bcubes_x):
-                bcube = bcubes[(y * bcubes_x) + x]
-                bcube_bounds_min, bcube_bounds_max = bcube[1]
-                
-                if not bounds_intersect(bm_bounds_min, bm_bounds_max, bcube_bounds_min, bcube_bounds_max):
-                    continue
-                    
-                possible_bcubes.append(bcube)
-                
-    # now find the best bcube for each mesh
-    for mesh, mesh_bounds, mesh_index, possible_bcubes in bcube_mesh_data:
-        max_overlap = float('-inf')
-        max_overlap_index = -1
-        bm_bounds_min, bm_bounds_max = mesh_bounds
-        
-        for bcube_index in range(len(possible_bcubes)):
-            bcube = possible_bcubes[bcube_index]
-            bcube_bounds_min, bcube_bounds_max = bcube[1]
-                
-            # check the amount of intersect
-            x_overlap = max(0, min(bm_bounds_max[0], bm_bounds_max[0]) - max(bm_bounds_min[0], bcube_bounds_min[0]))
-            y_overlap = max(0, min(bm_bounds_max[1], bm_bounds_max[1]) - max(bm_bounds_min[1], bcube_bounds_min[1]))
-            overlap_area = x_overlap * y_overlap
-            
-            if overlap_area <= max_overlap:
-                continue
-            
-            max_overlap = overlap_area
-            max_overlap_index = bcube_index
-        
-        # add to best bcube 
-        if max_overlap_index >= 0:
-            best_bcube = possible_bcubes[max_overlap_index]
-            bcube_bounds_min, bcube_bounds_max = best_bcube[1]
+    # range of cells each mesh covers, widened by one so touching cells are tested too
+    cell_size = np.array((bcube_size_x, bcube_size_y))
+    cell_size[cell_size <= 0] = 1
+    with np.errstate(invalid='ignore'):
+        range_min = np.floor((bm_bounds_min[:, :2] - scene_min[:2]) / cell_size) - 1
+        range_max = np.floor((bm_bounds_max[:, :2] - scene_min[:2]) / cell_size) + 1
+    finite = np.isfinite(range_min).all(axis=1) & np.isfinite(range_max).all(axis=1)
+    range_min = np.where(finite[:, None], np.clip(range_min, 0, (bcubes_x - 1, bcubes_y - 1)), 0).astype(np.int64)
+    range_max = np.where(finite[:, None], np.clip(range_max, 0, (bcubes_x - 1, bcubes_y - 1)), -1).astype(np.int64)
+    span = (range_max - range_min + 1).max(axis=0, initial=0)
+    
+    # walk candidates in grid order, so ties keep going to the first cube
+    best_overlap = np.full(mesh_count, -np.inf)
+    best_bcube = np.full(mesh_count, -1, dtype=np.int64)
+    for oy in range(span[1]):
+        for ox in range(span[0]):
+            x = range_min[:, 0] + ox
+            y = range_min[:, 1] + oy
+            in_range = (x <= range_max[:, 0]) & (y <= range_max[:, 1])
+            bcube_index = np.where(in_range, y * bcubes_x + x, 0)
             
-            # add to index list, this intersects
-            best_bcube[0].append(mesh_index)
+            bc_min = cell_min[bcube_index]
+            bc_max = cell_max[bcube_index]
+            intersects = in_range & (bm_bounds_min[:, :2] <= bc_max).all(axis=1) & (bm_bounds_max[:, :2] >= bc_min).all(axis=1)
             
-            # adjust the bounds of the bcube
-            bcube_bounds_min[2] = min(bm_bounds_min[2], bcube_bounds_min[2])
-            bcube_bounds_max[2] = max(bm_bounds_max[2], bcube_bounds_max[2])
+            # amount of intersect
+            overlap = np.maximum(0, np.minimum(bm_bounds_max[:, :2], bc_max) - np.maximum(bm_bounds_min[:, :2], bc_min)).prod(axis=1)
+            better = intersects & (overlap > best_overlap)
             
-            bcube_bounds_min[0] = min(bm_bounds_min[0], bcube_bounds_min[0])
-            bcube_bounds_min[1] = min(bm_bounds_min[1], bcube_bounds_min[1])
-            bcube_bounds_max[0] = max(bm_bounds_max[0], bcube_bounds_max[0])
-            bcube_bounds_max[1] = max(bm_bounds_max[1], bcube_bounds_max[1])
+            best_overlap = np.where(better, overlap, best_overlap)
+            best_bcube = np.where(better, bcube_index, best_bcube)
     
+    # grow each cube to the meshes it holds
+    assigned = best_bcube >= 0
+    bcube_min = np.concatenate((cell_min, np.full((bcube_count, 1), np.inf)), axis=1)
+    bcube_max = np.concatenate((cell_max, np.full((bcube_count, 1), -np.inf)), axis=1)
+    np.minimum.at(bcube_min, best_bcube[assigned], bm_bounds_min[assigned])
+    np.maximum.at(bcube_max, best_bcube[assigned], bm_bounds_max[assigned])
     
-    # return only bcubes with indices
-    bcubes = [x for x in bcubes if len(x[0]) > 0]
+    order = np.argsort(best_bcube, kind='stable')
+    counts = np.bincount(best_bcube[assigned], minlength=bcube_count)
+    starts = np.cumsum(counts) - counts + np.count_nonzero(~assigned)
+    
+    # return only bcubes with indices, center and radius come from their final bounds
+    bcubes = []
+    for bcube_index in np.flatnonzero(counts).tolist():
+        me_indices = mesh_indices[order[starts[bcube_index]:starts[bcube_index] + counts[bcube_index]]].tolist()
+        bcubes.append(make_bigcube_entry(me_indices, bcube_min[bcube_index].tolist(), bcube_max[bcube_index].tolist()))
+        
     return bcubes    
 
 
+def make_adaptive_bigcube(mesh_list, target_polys, target_radius):
+    """Split the meshes k-d tree style until each bigcube fits the poly count and radius targets"""
+    mesh_indices, bm_bounds_min, bm_bounds_max, poly_counts = get_mesh_bounds_arrays(mesh_list)
+    
+    # empty meshes have no bounds, and aren't placed in any cube
+    valid = np.isfinite(bm_bounds_min).all(axis=1) & np.isfinite(bm_bounds_max).all(axis=1)
+    centers = np.where(valid[:, None], (np.where(valid[:, None], bm_bounds_min, 0) + np.where(valid[:, None], bm_bounds_max, 0)) / 2, 0)
+    
+    bcubes = []
+    stack = [np.flatnonzero(valid)] if valid.any() else []
+    while len(stack) > 0:
+        node = stack.pop()
+        bcube_bounds_min = bm_bounds_min[node].min(axis=0).tolist()
+        bcube_bounds_max = bm_bounds_max[node].max(axis=0).tolist()
+        
+        # leaf when it fits, or when the meshes can't be told apart by their centers
+        spread = centers[node, :2].max(axis=0) - centers[node, :2].min(axis=0)
+        fits = poly_counts[node].sum() <= target_polys and common.bounds_radius(bcube_bounds_min, bcube_bounds_max) <= target_radius
+        if len(node) == 1 or fits or spread.max() <= 0:
+            bcubes.append(make_bigcube_entry(mesh_indices[np.sort(node)].tolist(), bcube_bounds_min, bcube_bounds_max))
+            continue
+        
+        # split the widest axis at the poly weighted median
+        axis = int(np.argmax(spread))
+        node = node[np.argsort(centers[node, axis], kind='stable')]
+        weights = np.cumsum(np.maximum(poly_counts[node], 1))
+        split = int(np.clip(np.searchsorted(weights, weights[-1] / 2) + 1, 1, len(node) - 1))
+        
+        # visit the low side first
+        stack.append(node[split:])
+        stack.append(node[:split])
+    
+    return bcubes
+
+
+def report_bigcubes(operator, bigcubes, mesh_list):
+    """Print per cube statistics, and report a summary through the operator"""
+    mesh_indices, bm_bounds_min, bm_bounds_max, poly_counts = get_mesh_bounds_arrays(mesh_list)
+    mesh_polys = dict(zip(mesh_indices.tolist(), poly_counts.tolist()))
+    
+    print(" bigcube  meshes   polys     radius")
+    cube_polys = []
+    for x, (me_indices, bounds, center, radius) in enumerate(bigcubes):
+        polys = sum(mesh_polys[i] for i in me_indices)
+        cube_polys.append(polys)
+        print(" %7d %7d %7d %10.1f" % (x, len(me_indices), polys, radius))
+    
+    if len(bigcubes) == 0:
+        return
+    
+    summary = "%d bigcubes, polys min %d / avg %d / max %d, max radius %.1f" % (len(bigcubes), min(cube_polys), sum(cube_polys) / len(cube_polys),
+                                                                               max(cube_polys), max(x[3] for x in bigcubes))
+    print(" " + summary)
+    if operator is not None:
+        operator.report({'INFO'}, summary)
+
+
 def export_texanims(file):
     scene = bpy.context.scene
     animtex = scene.rv_animtex
     anims = animtex.slots
     
     num_anims = len(anims)
-    file.write(struct.pack('<L', num_anims)) 
+    file.write(rvcodec.U32_STRUCT.pack(num_anims))
     
     for x in range(num_anims):
         frames = anims[x].frames
         num_frames = len(frames)
         
-        file.write(struct.pack('<L', num_frames))
+        buffer = rvcodec.new_buffer(rvcodec.U32_STRUCT)
+        buffer += rvcodec.new_buffer(rvcodec.TEXANIM_FRAME_STRUCT, num_frames)
+        offset = rvcodec.pack_into(rvcodec.U32_STRUCT, buffer, 0, num_frames)
         for y in range(num_frames):
             frame = frames[y]
-            
-            file.write(struct.pack('<lf', frame.texture_number, frame.delay))
-            file.write(struct.pack('<ff', *tuple(frame.get_uv(0))))
-            file.write(struct.pack('<ff', *tuple(frame.get_uv(1))))
-            file.write(struct.pack('<ff', *tuple(frame.get_uv(2))))
-            file.write(struct.pack('<ff', *tuple(frame.get_uv(3))))
+            offset = rvcodec.pack_into(rvcodec.TEXANIM_FRAME_STRUCT, buffer, offset,
+                                       frame.texture_number, frame.delay,
+                                       *frame.get_uv(0), *frame.get_uv(1), *frame.get_uv(2), *frame.get_uv(3))
+        file.write(buffer)
 
 ######################################################
 # EXPORT
@@ -178,7 +245,20 @@ def save(operator,
          apply_modifiers=False,
          selected_only=False,
          split=False,
-         split_size=4096
+         split_size=4096,
+         split_mode='SIZE',
+         split_max_polys=8192,
+         split_max_verts=8192,
+         split_min_polys=512,
+         split_by_mesh_index=True,
+         bigcube_mode='GRID',
+         bigcube_polys=4000,
+         bigcube_radius=8000,
+         sort_polys=False,
+         optimize_vcache=False,
+         merge_quads=False,
+         quad_tolerance=math.radians(1),
+         use_cache=False
          ):
     
     import io_scene_revolt.export_mesh as export_mesh
@@ -187,93 +267,159 @@ def save(operator,
     time1 = time.perf_counter()
     wm = bpy.context.window_manager
     wm.progress_begin(0, 1)
-
-    # get objs
-    objs = bpy.context.selected_objects if selected_only else bpy.data.objects
-    objs = [x for x in objs if x.type == 'MESH']
-    ob_count = len(objs)
+    materialcache.begin()
+    try:
+        # get objs
+        objs = bpy.context.selected_objects if selected_only else bpy.data.objects
+        objs = [x for x in objs if x.type == 'MESH']
+        ob_count = len(objs)
     
-    if ob_count == 0:
-        raise Exception("Didn't find any valid objects to export")
+        if ob_count == 0:
+            raise Exception("Didn't find any valid objects to export")
         
-    # export world
-    file = open(filepath, 'wb')
+        # export world
+        file = open(filepath, 'wb')
     
-    # scale split_size
-    split_size /= common.RV_SCALE
+        # scale split_size
+        split_size /= common.RV_SCALE
     
-    # env list, filled by export_mesh
-    # mesh_list filled with export data
-    env_list = []
-    mesh_list = []
-    mesh_count = 0
+        # env list, filled by export_mesh
+        # mesh_list filled with (ob, [(bounds min, bounds max, poly count)], [mesh indices]), meshes are freed once written
+        env_list = []
+        mesh_list = []
+        mesh_count = 0
+        export_stats = {}
 
-    # prepare meshes
-    print(" ... preparing (%.4f)" % (time.perf_counter() - time1))
-    for ob in objs:
-        # get bmesh
-        bm = common.get_bmesh(ob, apply_modifiers = apply_modifiers)
-        common.bm_to_world(bm, ob)
+        # mesh count, patched once all meshes are written
+        mesh_count_offset = file.tell()
+        file.write(rvcodec.U32_STRUCT.pack(0))
+
+        # objects are cached by everything that changes their serialized meshes
+        cache_dir = worldcache.get_cache_dir(filepath)
+        cache_settings = (apply_modifiers, split, split_size, split_mode, split_max_polys, split_max_verts, split_min_polys,
+                          split_by_mesh_index, sort_polys, optimize_vcache, merge_quads, quad_tolerance)
+        cache_keys = set()
+        cache_hits = 0
+        cache_misses = 0
+
+        # write meshes
+        print(" ... mesh exporting (%.4f)" % (time.perf_counter() - time1))
+        export_counter = 0
+        for ob in objs:
+            # splice unchanged objects straight from the cache
+            if use_cache:
+                cache_key = worldcache.get_object_key(ob, cache_settings, apply_modifiers)
+                cache_keys.add(cache_key)
+                entry = worldcache.load_entry(cache_dir, cache_key)
+                if entry is not None:
+                    cache_hits += 1
+                    file.write(entry.data)
+                    env_list.extend(entry.env_colors)
+                
+                    mesh_indices = list(range(mesh_count, mesh_count + len(entry.mesh_info)))
+                    mesh_count += len(entry.mesh_info)
+                    mesh_list.append((ob, entry.mesh_info, mesh_indices))
+                
+                    export_counter += 1
+                    wm.progress_update((export_counter / ob_count) * 0.9)
+                    continue
+                cache_misses += 1
         
-        # split if requested
-        if split:   
-            splitter = BMeshSplitter(split_size)
-            splits = splitter.split(bm)
-        else:
-            splits = [bm]
+            # get bmesh
+            bm = common.get_bmesh(ob, apply_modifiers = apply_modifiers)
+            common.bm_to_world(bm, ob)
         
-        mesh_indices = list(range(mesh_count, mesh_count + len(splits)))
-        mesh_count += len(splits)
-        mesh_list.append((ob, splits, mesh_indices))
+            # split if requested, merged world imports split back into their original meshes
+            mesh_index_layer = bm.faces.layers.int.get(common.MESH_INDEX_LAYER)
+            if split_by_mesh_index and mesh_index_layer is not None:
+                splits = BMeshSplitter(split_size).iter_split_by_layer(bm, mesh_index_layer)
+            elif split and split_mode == 'ADAPTIVE':
+                splits = BMeshSplitter(split_size, split_max_polys, split_max_verts, split_min_polys).iter_split_adaptive(bm)
+            elif split:   
+                splits = BMeshSplitter(split_size).iter_split(bm)
+            else:
+                splits = [bm]
         
-    # mesh count
-    file.write(struct.pack('<L', mesh_count))
-
-    # write meshes
-    print(" ... mesh exporting (%.4f)" % (time.perf_counter() - time1))
-    export_counter = 0
-    for ob, meshes, indices in mesh_list:
-        for mesh in meshes:
-            #def export_mesh(file, ob, bm, env_list, is_world):
-            export_mesh.export_mesh(file, ob, mesh, env_list, True)
+            # cached objects are written to memory first so the same bytes can be stored
+            ob_file = io.BytesIO() if use_cache else file
+            env_start = len(env_list)
+        
+            mesh_info = []
+            for mesh in splits:
+                bnds_min, bnds_max = export_mesh.export_mesh(ob_file, ob, mesh, env_list, True, sort_polys = sort_polys, optimize_vcache = optimize_vcache,
+                                                             merge_quads = merge_quads, quad_tolerance = quad_tolerance, stats = export_stats)
+                mesh_info.append((tuple(bnds_min), tuple(bnds_max), len(mesh.faces)))
+                if mesh is not bm:
+                    mesh.free()
+            bm.free()
+        
+            if use_cache:
+                data = ob_file.getvalue()
+                file.write(data)
+                worldcache.save_entry(cache_dir, cache_key, data, mesh_info, env_list[env_start:])
+        
+            mesh_indices = list(range(mesh_count, mesh_count + len(mesh_info)))
+            mesh_count += len(mesh_info)
+            mesh_list.append((ob, mesh_info, mesh_indices))
             
-        export_counter += 1
-        wm.progress_update((export_counter / ob_count) * 0.9)
+            export_counter += 1
+            wm.progress_update((export_counter / ob_count) * 0.9)
+    
+        export_mesh.report_stats(operator, export_stats)
+    
+        if use_cache:
+            pruned = worldcache.prune(cache_dir, cache_keys)
+            message = "cache: %d hits, %d misses, %d stale entries removed" % (cache_hits, cache_misses, pruned)
+            print(" " + message)
+            if operator is not None:
+                operator.report({'INFO'}, message)
+    
+        end_offset = file.tell()
+        file.seek(mesh_count_offset)
+        file.write(rvcodec.U32_STRUCT.pack(mesh_count))
+        file.seek(end_offset)
 
-    # calculate bigcubes
-    # we make a single bigcube here if not splitting since we can't guarantee 
-    # the user provided meshes are small enough to work properly
-    print(" ... bigcube calculation (%.4f)" % (time.perf_counter() - time1))
-    bigcubes = make_multi_bigcube(mesh_list) if split else make_single_bigcube(mesh_list)
-    
-    # write bigcubes
-    print(" ... bigcube writing (%.4f)" % (time.perf_counter() - time1))
-    file.write(struct.pack('<L', len(bigcubes)))
-    for me_indices, bounds, center, radius in bigcubes:
-        file.write(struct.pack('<fff', *common.vec3_to_revolt(center)))
-        file.write(struct.pack('<f', radius))
-        
-        file.write(struct.pack('<L', len(me_indices))) # mesh count
-        for x in me_indices:
-            file.write(struct.pack('<L', x)) # mesh index
+        # calculate bigcubes
+        # we make a single bigcube here if not splitting since we can't guarantee 
+        # the user provided meshes are small enough to work properly
+        print(" ... bigcube calculation (%.4f)" % (time.perf_counter() - time1))
+        if not split:
+            bigcubes = make_single_bigcube(mesh_list)
+        elif bigcube_mode == 'ADAPTIVE':
+            bigcubes = make_adaptive_bigcube(mesh_list, bigcube_polys, bigcube_radius)
+        else:
+            bigcubes = make_multi_bigcube(mesh_list)
+        report_bigcubes(operator, bigcubes, mesh_list)
     
-    wm.progress_update(1.0)
+        # write bigcubes
+        print(" ... bigcube writing (%.4f)" % (time.perf_counter() - time1))
+        file.write(rvcodec.U32_STRUCT.pack(len(bigcubes)))
+        for me_indices, bounds, center, radius in bigcubes:
+            buffer = rvcodec.new_buffer(rvcodec.BIGCUBE_HEADER_STRUCT)
+            buffer += rvcodec.new_buffer(rvcodec.U32_STRUCT, len(me_indices))
+            offset = rvcodec.pack_into(rvcodec.BIGCUBE_HEADER_STRUCT, buffer, 0, *common.vec3_to_revolt(center), radius, len(me_indices))
+            for x in me_indices:
+                offset = rvcodec.pack_into(rvcodec.U32_STRUCT, buffer, offset, x) # mesh index
+            file.write(buffer)
     
-    # Texanim List
-    print(" ... texanim writing (%.4f)" % (time.perf_counter() - time1))
-    export_texanims(file)
+        wm.progress_update(1.0)
     
-    # Env List
-    for color in env_list:
-        rvcolor = common.to_rv_color(color) 
-        file.write(struct.pack("<BBBB", *rvcolor))
+        # Texanim List
+        print(" ... texanim writing (%.4f)" % (time.perf_counter() - time1))
+        export_texanims(file)
     
-    # cleanup
-    for ob, meshes, indices in mesh_list:
-        for mesh in meshes:
-            mesh.free()
-    file.close()
-    wm.progress_end()
+        # Env List
+        buffer = rvcodec.new_buffer(rvcodec.U8X4_STRUCT, len(env_list))
+        offset = 0
+        for color in env_list:
+            offset = rvcodec.pack_into(rvcodec.U8X4_STRUCT, buffer, offset, *common.to_rv_color(color))
+        file.write(buffer)
+    
+        # cleanup
+        file.close()
+        wm.progress_end()
+    finally:
+        materialcache.end()
 
     # export complete
     print(" done in %.4f sec." % (time.perf_counter() - time1))
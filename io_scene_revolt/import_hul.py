@@ -1,18 +1,22 @@
 import bpy
 import bmesh
-import struct, math, time
+import math, time
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
 
 ######################################################
 # IMPORT
 ######################################################
-def read_float(file, psx):
-    return struct.unpack("<l", file.read(4))[0] / common.PSX_VERTEX_DIVISOR_32 if psx else  struct.unpack("<f", file.read(4))[0]
+def read_values(file, record, psx):
+    values = rvcodec.read_record(file, record)
+    return [x / common.PSX_VERTEX_DIVISOR_32 for x in values] if psx else values
     
-def read_vector(file, psx):
-    return (read_float(file, psx), read_float(file, psx), read_float(file, psx))
+def read_vectors(file, psx, count):
+    record = rvcodec.VEC3_PSX_STRUCT if psx else rvcodec.VEC3_STRUCT
+    vectors = rvcodec.read_records(file, record, count)
+    return [[x / common.PSX_VERTEX_DIVISOR_32 for x in vec] for vec in vectors] if psx else vectors
 
 def load(operator,
          context,
@@ -31,18 +35,19 @@ def load(operator,
     sph_material = common.create_colored_material("HullSphere", (0.35, 0.8, 0.35, 1.0))
     
     # read convex hulls
-    chull_count = struct.unpack("<H", file.read(2))[0]
+    chull_count = rvcodec.read_record(file, rvcodec.U16_STRUCT)[0]
     for x in range(chull_count):
-        vert_count, edge_count, face_count = struct.unpack("<HHH", file.read(6))
-        file.seek(36, 1) # we don't need the rest of this data
+        # we don't need the bounds and center
+        vert_count, edge_count, face_count = rvcodec.read_record(file, rvcodec.HULL_HEADER_PSX_STRUCT if psx else rvcodec.HULL_HEADER_STRUCT)[:3]
         
         verts = []
-        for y in range(vert_count):
-            vert = common.vec3_to_blender(read_vector(file, psx))
+        for vert in read_vectors(file, psx, vert_count):
+            vert = common.vec3_to_blender(vert)
             vert = Vector(vert) / common.RV_SCALE
             verts.append(vert)
 
-        file.seek((4 * edge_count) + (16 * face_count), 1) # seek past face and edge we don't need this
+        # seek past face and edge we don't need this
+        file.seek((rvcodec.HULL_EDGE_STRUCT.size * edge_count) + (rvcodec.HULL_PLANE_STRUCT.size * face_count), 1)
             
         # create hull
         scn = bpy.context.scene
@@ -71,7 +76,7 @@ def load(operator,
         bm.free()
          
     # read spheres
-    sphere_count = struct.unpack("<H", file.read(2))[0]
+    sphere_count = rvcodec.read_record(file, rvcodec.U16_STRUCT)[0]
     
     bm = bmesh.new()
     bmesh.ops.create_uvsphere(bm, u_segments=16, v_segments=8, radius=1)
@@ -83,10 +88,11 @@ def load(operator,
     bm.free()
     
     for x in range(sphere_count):
-        center = common.vec3_to_blender(read_vector(file, psx))
+        sphere = read_values(file, rvcodec.HULL_SPHERE_PSX_STRUCT if psx else rvcodec.HULL_SPHERE_STRUCT, psx)
+        center = common.vec3_to_blender(sphere[:3])
         center = Vector(center) / common.RV_SCALE
         
-        radius = read_float(file, psx) / common.RV_SCALE
+        radius = sphere[3] / common.RV_SCALE
 
         ob = bpy.data.objects.new("HullSphere", me)
         ob.data.materials.append(sph_material)
@@ -1,8 +1,11 @@
 import bpy, bmesh
-import struct, math, time, collections, os
+import math, time, collections, os
+import numpy as np
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
+import io_scene_revolt.meshbuilder as meshbuilder
 from io_scene_revolt.rvfacehash import RV_FaceMaterialHash
 
 ######################################################
@@ -42,119 +45,18 @@ def finalize_mesh_materials_stage2(filepath, materials):
 ######################################################
 # IMPORT
 ######################################################
-def load_mesh(file, is_world = False, env_queue = None, matdict = None, psx = False, vertlist = None):
-    poly_size = 36 if psx else 60
-    
-    # create the object
-    scn = bpy.context.scene
-    
-    me = bpy.data.meshes.new("Mesh")
-    ob = bpy.data.objects.new("Mesh", me)
-    bm = bmesh.new()
-    scn.collection.objects.link(ob)
-    
-    # create layers for this object
-    uv_layer = bm.loops.layers.uv.new()
-    vc_layer = bm.loops.layers.color.new()
-    
-    # seek past bounding info if world
-    if is_world:
-        file.seek(8 if psx else 40, 1)
-    
-    # read mesh
-    face_hashes = []
-    face_materials = {} if matdict is None else matdict
-    face_materials_to_matslot = {}
-    
-    vert_remap = {} 
-    used_verts = []
-
-    poly_count, vertex_count = struct.unpack("<HH", file.read(4))
-    poly_file_location = file.tell() 
-    file.seek(poly_size * poly_count, 1)
+def get_face_materials(ob, poly_types, poly_textures, alphas, is_world, env_queue, face_materials, face_materials_to_matslot):
+    """Resolve a material slot for each polygon, adding slots to ob as needed"""
+    material_indices = np.zeros(len(poly_types), dtype=np.int32)
     
-    # read in vertices
-    if vertlist is None:
-        vertlist = []
-        if psx:
-            for x in range(vertex_count):
-                vert = Vector(struct.unpack("<hhh", file.read(6))) / common.RV_SCALE / common.PSX_VERTEX_DIVISOR
-                vert = common.vec3_to_blender(vert)
-                
-                normal = Vector(struct.unpack("<hhh", file.read(6))) / common.PSX_NORMAL_DIVISOR
-                normal = common.vec3_to_blender(normal)
-                
-                vertlist.append(vert)
-        else:
-            for x in range(vertex_count):
-                vert = Vector(struct.unpack("<fff", file.read(12))) / common.RV_SCALE
-                vert = common.vec3_to_blender(vert)
-                
-                normal = struct.unpack("<fff", file.read(12))
-                normal = common.vec3_to_blender(normal)
-                
-                vertlist.append(vert)
-        
-    bm.verts.ensure_lookup_table()
-    mesh_end_file_location = file.tell()    
-    
-    # read in polygons
-    file.seek(poly_file_location)
-    for x in range(poly_count):
-        poly_type, poly_texture = struct.unpack("<Hh", file.read(4))
-        vertex_indices = list(struct.unpack("<HHHH", file.read(8)))
-        loop_count = 4 if poly_type & common.POLY_FLAG_QUAD else 3
-        
-        vertex_colors = []
-        uvs = []
-        
-        # remap (not typically needed, but PSW has a global vertex list, so we do this)
-        for x in range(loop_count):
-            index = vertex_indices[x]
-            new_index = -1
-            if not index in vert_remap:
-                new_index = len(used_verts)
-                vert_remap[index] = new_index
-                
-                vert = vertlist[index]
-                bmvert = bm.verts.new(vert)
-                used_verts.append(bmvert)
-            else:
-                new_index = vert_remap[index]
-
-            vertex_indices[x] = new_index
-            
-        # colors
-        for y in range(4):
-            color = struct.unpack("<BBBB", file.read(4))
-            color = common.from_rv_color_psx(color) if psx else common.from_rv_color(color)
-            vertex_colors.append(color)
-
-        # uvs
-        if psx:
-            for y in range(4):
-                uv = list(struct.unpack("<BB", file.read(2)))
-                uv[0] /= 255.0
-                uv[1] /= 255.0
-                uvs.append(common.vec2_to_blender(uv))
-        else:
-            for y in range(4):
-                uv = struct.unpack("<ff", file.read(8))
-                uvs.append(common.vec2_to_blender(uv))
-           
+    for x, (poly_type, poly_texture, avg_alpha) in enumerate(zip(poly_types.tolist(), poly_textures.tolist(), alphas.tolist())):
         # hash, and get material
         poly_hash = RV_FaceMaterialHash(poly_texture, poly_type, is_world)
         if is_world and poly_type & common.POLY_FLAG_ENABLEENV and env_queue is not None and len(env_queue) > 0:
             poly_hash.set_env_color(env_queue.popleft())
           
         if poly_type & common.POLY_FLAG_TRANSLUCENT:
-            avg_alpha = 0
-            for y in range(loop_count):
-                avg_alpha += vertex_colors[y][3]
-            avg_alpha /= loop_count
             poly_hash.set_alpha(avg_alpha)
-            
-        face_hashes.append(poly_hash)    
         
         mat = None
         if not poly_hash in face_materials:
@@ -170,35 +72,88 @@ def load_mesh(file, is_world = False, env_queue = None, matdict = None, psx = Fa
             face_materials_to_matslot[poly_hash] = mat_index
         else:
             mat_index = face_materials_to_matslot[poly_hash]
-       
-        # create in bmesh
-        indices = reversed(vertex_indices[:loop_count])
-        bmverts = [used_verts[y] for y in indices]
-        
-        try:
-            face = bm.faces.new(bmverts)
-            face.smooth = True
             
-            # layers
-            for y, inv_y in zip(range(loop_count), reversed(range(loop_count))):
-                face.loops[y][vc_layer] = vertex_colors[inv_y]
-                face.loops[y][uv_layer].uv = uvs[inv_y]
-            
-            # set material
-            face.material_index = mat_index
-
-        except Exception as e:
-            print(e)
+        material_indices[x] = mat_index
         
-        
-    # finish off
-    bm.normal_update()
-    bm.to_mesh(me)
-    file.seek(mesh_end_file_location)
+    return material_indices
+    
+
+def get_vertex_divisor(psx = False):
+    return common.RV_SCALE * common.PSX_VERTEX_DIVISOR if psx else common.RV_SCALE
+    
+
+def load_mesh(file, is_world = False, env_queue = None, matdict = None, psx = False, vertlist = None):
+    mesh_data = rvcodec.read_mesh(file, psx = psx, is_world = is_world, read_vertices = vertlist is None, vertex_divisor = get_vertex_divisor(psx))
+    return create_mesh(mesh_data, is_world = is_world, env_queue = env_queue, matdict = matdict, vertlist = vertlist)
     
-    # cleanup
-    bm.free()
     
+def new_mesh_object(name = "Mesh"):
+    scn = bpy.context.scene
+    
+    me = bpy.data.meshes.new(name)
+    ob = bpy.data.objects.new(name, me)
+    scn.collection.objects.link(ob)
+    return ob
+    
+    
+def get_mesh_arrays(mesh_data, ob, is_world = False, env_queue = None, face_materials = None, face_materials_to_matslot = None, vertlist = None):
+    """Turn decoded mesh data into flat arrays for meshbuilder, adding material slots to ob"""
+    face_materials = {} if face_materials is None else face_materials
+    face_materials_to_matslot = {} if face_materials_to_matslot is None else face_materials_to_matslot
+    if vertlist is None:
+        vertlist = mesh_data["vertices"]
+    
+    poly_types = mesh_data["types"]
+    loop_counts = np.where(poly_types & common.POLY_FLAG_QUAD, 4, 3)
+    
+    # average alpha for translucent polygons
+    loop_mask = np.arange(4) < loop_counts[:, None]
+    alphas = (mesh_data["colors"][:, :, 3] * loop_mask).sum(axis=1) / loop_counts
+    
+    # materials are resolved for every polygon, so the env queue stays in sync
+    material_indices = get_face_materials(ob, poly_types, mesh_data["texnums"], alphas, is_world, env_queue, face_materials, face_materials_to_matslot)
+    
+    # drop faces bmesh would have refused
+    valid = meshbuilder.get_valid_faces(mesh_data["indices"], loop_counts)
+    if not valid.all():
+        print("skipped %d degenerate or duplicate faces" % (len(valid) - np.count_nonzero(valid)))
+    loop_counts = loop_counts[valid]
+    
+    # remap (not typically needed, but PSW has a global vertex list, so we do this)
+    used_verts, vertex_indices = meshbuilder.compact_vertices(mesh_data["indices"][valid], loop_counts)
+    
+    # faces are stored with reversed winding
+    loop_slots = meshbuilder.get_loop_slots(loop_counts, reverse = True)
+    
+    return {"vertices": vertlist[used_verts],
+            "loop_vertices": vertex_indices.ravel()[loop_slots],
+            "loop_totals": loop_counts,
+            "material_indices": material_indices[valid],
+            "loop_colors": mesh_data["colors"][valid].reshape(-1, 4)[loop_slots],
+            "loop_uvs": mesh_data["uvs"][valid].reshape(-1, 2)[loop_slots]}
+    
+    
+def build_mesh(me, mesh_arrays, mesh_ids = None):
+    """Build one Mesh from a list of get_mesh_arrays results, optionally tagging faces with their mesh id"""
+    vertex_offsets = np.cumsum([0] + [len(arrays["vertices"]) for arrays in mesh_arrays])
+    face_int_layers = []
+    if mesh_ids is not None:
+        face_ids = [np.full(len(arrays["loop_totals"]), mesh_id) for arrays, mesh_id in zip(mesh_arrays, mesh_ids)]
+        face_int_layers.append((common.MESH_INDEX_LAYER, np.concatenate(face_ids)))
+    
+    meshbuilder.mesh_from_arrays(me, np.concatenate([arrays["vertices"] for arrays in mesh_arrays]).reshape(-1, 3),
+                                 np.concatenate([arrays["loop_vertices"] + offset for arrays, offset in zip(mesh_arrays, vertex_offsets)]),
+                                 np.concatenate([arrays["loop_totals"] for arrays in mesh_arrays]),
+                                 material_indices = np.concatenate([arrays["material_indices"] for arrays in mesh_arrays]), 
+                                 uv_layers = [("UVMap", np.concatenate([arrays["loop_uvs"] for arrays in mesh_arrays]))], 
+                                 color_layers = [("Col", np.concatenate([arrays["loop_colors"] for arrays in mesh_arrays]))],
+                                 face_int_layers = face_int_layers)
+    
+    
+def create_mesh(mesh_data, is_world = False, env_queue = None, matdict = None, vertlist = None):
+    ob = new_mesh_object()
+    mesh_arrays = get_mesh_arrays(mesh_data, ob, is_world, env_queue, matdict, None, vertlist)
+    build_mesh(ob.data, [mesh_arrays])
     return ob
     
     
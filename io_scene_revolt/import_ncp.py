@@ -1,32 +1,87 @@
 import bpy
-import bmesh
-import struct, math, time
-from mathutils import Vector
+import time
+import numpy as np
 
 import io_scene_revolt.common_helpers as common
 import io_scene_revolt.common_ncp as ncpcommon
+import io_scene_revolt.meshbuilder as meshbuilder
+import io_scene_revolt.rvcodec as rvcodec
 
 ######################################################
 # HELPERS
 ######################################################
-# From Huki's Addon: https://gitlab.com/re-volt/re-volt-addon/-/blob/master/io_revolt/ncp_in.py#L27
-def intersect(d1, n1, d2, n2, d3, n3):
-    """ Intersection of three planes
-    "If three planes are each specified by a point x and a unit normal vec n":
-    http://mathworld.wolfram.com/Plane-PlaneIntersection.html """
-    det = n1.dot(n2.cross(n3))
+# distance corners are welded within, in Blender units
+MERGE_DISTANCE = 0.01
+
+# planes meeting at each corner, the main plane and two edge planes
+# From Huki's Addon: https://gitlab.com/re-volt/re-volt-addon/-/blob/master/io_revolt/ncp_in.py#L69
+QUAD_CORNER_PLANES = np.array(((0, 1, 2), (0, 2, 3), (0, 3, 4), (0, 4, 1)))
+TRI_CORNER_PLANES = np.array(((0, 1, 2), (0, 2, 3), (0, 3, 1), (0, 3, 1)))
 
-    # If det is too small, there is no intersection
-    if abs(det) < 1e-100:
-        return None
+# corner order of the created faces
+QUAD_FACE_ORDER = np.array((0, 3, 2, 1))
+TRI_FACE_ORDER = np.array((0, 2, 1, 0))
 
-    # Returns intersection point
-    return (d1 * n2.cross(n3) +
-            d2 * n3.cross(n1) +
-            d3 * n1.cross(n2)
-            ) / det
 
+def intersect_planes(normals, distances):
+    """ Intersection of three planes, for (..., 3, 3) normals and (..., 3) distances
+    "If three planes are each specified by a point x and a unit normal vec n":
+    http://mathworld.wolfram.com/Plane-PlaneIntersection.html 
+    Returns (points, valid), planes without a single intersection aren't valid"""
+    n1, n2, n3 = normals[..., 0, :], normals[..., 1, :], normals[..., 2, :]
+    d1, d2, d3 = distances[..., 0, None], distances[..., 1, None], distances[..., 2, None]
+    
+    n23 = np.cross(n2, n3)
+    det = np.einsum("...i,...i->...", n1, n23)
+    valid = np.abs(det) >= 1e-100
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        points = (d1 * n23 + d2 * np.cross(n3, n1) + d3 * np.cross(n1, n2)) / det[..., None]
+    return (points, valid)
+    
+
+def get_poly_corners(polys):
+    """Rebuild the corners of every polyhedron, returns (N, 4, 3) Re-Volt space corners in face order, face sizes and a valid mask"""
+    planes = polys["planes"].astype(np.float64)
+    is_quad = (polys["type"] & common.COLL_FLAG_QUAD) != 0
+    
+    corner_planes = np.where(is_quad[:, None, None], QUAD_CORNER_PLANES, TRI_CORNER_PLANES)
+    corner_planes = planes[np.arange(len(planes))[:, None, None], corner_planes]
+    corners, valid = intersect_planes(corner_planes[..., :3], -corner_planes[..., 3])
+    
+    face_order = np.where(is_quad[:, None], QUAD_FACE_ORDER, TRI_FACE_ORDER)
+    corners = corners[np.arange(len(corners))[:, None], face_order]
+    face_sizes = np.where(is_quad, 4, 3)
+    
+    # no intersection
+    valid = (valid | (np.arange(4) >= face_sizes[:, None])).all(axis=1)
+    return (corners, face_sizes, valid)
+    
 
+def weld_corners(corners, face_sizes, distance):
+    """Merge corners closer than about distance by snapping them to a grid.
+       Returns (vertices, (N, 4) face vertex indices, face sizes, valid faces), faces that collapse aren't valid"""
+    slots = np.arange(4) < face_sizes[:, None]
+    keys = np.round(corners[slots] / distance).astype(np.int64)
+    unique_keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    vertices = corners[slots][first]
+    
+    face_verts = np.full(corners.shape[:2], -1, dtype=np.int64)
+    face_verts[slots] = inverse.ravel()
+    
+    # drop corners welded to the one before them
+    previous = np.where(np.arange(4) == 0, np.take_along_axis(face_verts, face_sizes[:, None] - 1, axis=1), np.roll(face_verts, 1, axis=1))
+    keep = slots & (face_verts != previous)
+    face_sizes = keep.sum(axis=1)
+    order = np.argsort(~keep, axis=1, kind='stable')
+    face_verts = np.where(np.arange(4) < face_sizes[:, None], np.take_along_axis(face_verts, order, axis=1), -1)
+    
+    # what's left has to be a proper triangle or quad
+    valid = face_sizes >= 3
+    valid &= (face_sizes < 3) | (face_verts[:, 0] != face_verts[:, 2])
+    valid &= (face_sizes < 4) | (face_verts[:, 1] != face_verts[:, 3])
+    return (vertices, face_verts, face_sizes, valid)
+    
 ######################################################
 # IMPORT
 ######################################################
@@ -47,8 +102,6 @@ def load(operator,
 
     me = bpy.data.meshes.new("Collision")
     ob = bpy.data.objects.new("Collision", me)
-    bm = bmesh.new()
-    fm_layer = bm.faces.layers.face_map.new()
     
     ncpcommon.add_ncp_materials(ob)
     ncpcommon.add_ncp_facemaps(ob)
@@ -68,67 +121,42 @@ def load(operator,
     for slot, index in zip(ob.material_slots, range(len(ob.material_slots))):
         ncp_id = ncpcommon.get_ncp_id_from_material(slot.material)
         material_map[ncp_id] = index
-        
+    
     # read polyhedrons
-    poly_count = struct.unpack("<H", file.read(2))[0]
-    for x in range(poly_count):
-        ncp_type, ncp_material = struct.unpack("<Ll", file.read(8))
-        
-        planes = []
-        for y in range(5):
-            nx, ny, nz, dist = struct.unpack("<ffff", file.read(16))
-            planes.append(((nx, ny, nz), dist))
-            
-        # seek past bounding box
-        file.seek(24, 1)
-        
-        ds = [-(p[1]) for p in planes]
-        ns = [Vector((p[0][0], p[0][1], p[0][2])) for p in planes]
-        
-        verts = []
-        # From Huki's Addon: https://gitlab.com/re-volt/re-volt-addon/-/blob/master/io_revolt/ncp_in.py#L69
-        if ncp_type & common.COLL_FLAG_QUAD:
-            verts.append(intersect(ds[0], ns[0], ds[1], ns[1], ds[2], ns[2]))
-            verts.append(intersect(ds[0], ns[0], ds[2], ns[2], ds[3], ns[3]))
-            verts.append(intersect(ds[0], ns[0], ds[3], ns[3], ds[4], ns[4]))
-            verts.append(intersect(ds[0], ns[0], ds[4], ns[4], ds[1], ns[1]))
-            face = (0, 3, 2, 1)
-        else:
-            verts.append(intersect(ds[0], ns[0], ds[1], ns[1], ds[2], ns[2]))
-            verts.append(intersect(ds[0], ns[0], ds[2], ns[2], ds[3], ns[3]))
-            verts.append(intersect(ds[0], ns[0], ds[3], ns[3], ds[1], ns[1]))
-            face = (0, 2, 1)
-        
-        # no intersection
-        if None in verts:
-            continue
-        
-        # transform verts
-        for x in range(len(verts)):
-            vert = verts[x]
-            vert /= common.RV_SCALE
-            verts[x] = common.vec3_to_blender(vert)
-        
-        # creates the bmverts and face
-        bmverts = []
-        for x in face:
-            bmverts.append(bm.verts.new(verts[x]))
-        face = bm.faces.new(bmverts)
-        
-        if ncp_material in material_map:
-            face.material_index = material_map[ncp_material]
-        if ncp_type & common.COLL_FLAG_OBJECT_ONLY:
-            face[fm_layer] = object_only_facemap_index
-        elif ncp_type & common.COLL_FLAG_CAMERA_ONLY:
-            face[fm_layer] = camera_only_facemap_index
-
-    # merge
+    poly_count = rvcodec.read_record(file, rvcodec.U16_STRUCT)[0]
+    polys = rvcodec.read_array(file, rvcodec.NCP_POLY_DTYPE, poly_count)
+    
+    # corners, dropping polyhedrons without an intersection
+    corners, face_sizes, valid = get_poly_corners(polys)
+    polys = polys[valid]
+    face_sizes = face_sizes[valid]
+    corners = rvcodec.vec3_array_to_blender(corners[valid] / common.RV_SCALE)
+    
+    # materials and face maps, the bounding box isn't needed
+    ncp_ids, ncp_inverse = np.unique(polys["material"], return_inverse=True)
+    material_indices = np.array([material_map.get(int(x), 0) for x in ncp_ids], dtype=np.int64)[ncp_inverse.ravel()]
+    face_maps = np.where(polys["type"] & common.COLL_FLAG_OBJECT_ONLY, object_only_facemap_index,
+                         np.where(polys["type"] & common.COLL_FLAG_CAMERA_ONLY, camera_only_facemap_index, -1))
+    
+    # every face gets its own corners, unless they're merged
     if merge_vertices:
-        bmesh.ops.remove_doubles(bm, verts=bm.verts, dist=0.01)
+        vertices, face_verts, face_sizes, valid = weld_corners(corners, face_sizes, MERGE_DISTANCE)
+        face_verts = face_verts[valid]
+        face_sizes = face_sizes[valid]
+        material_indices = material_indices[valid]
+        face_maps = face_maps[valid]
+    else:
+        slots = np.arange(4) < face_sizes[:, None]
+        vertices = corners[slots]
+        face_verts = np.full(slots.shape, -1, dtype=np.int64)
+        face_verts[slots] = np.arange(len(vertices))
+    
+    # build
+    loop_vertices = face_verts[np.arange(4) < face_sizes[:, None]]
+    meshbuilder.mesh_from_arrays(me, vertices, loop_vertices, face_sizes,
+                                 material_indices = material_indices, smooth = False, face_maps = face_maps)
     
     # cleanup
-    bm.to_mesh(me)
-    bm.free()
     file.close()
     
     # import complete
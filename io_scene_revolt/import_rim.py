@@ -1,9 +1,10 @@
 import bpy
 import bmesh
-import struct, math, time
+import math, time
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
 
 ######################################################
 # IMPORT
@@ -21,14 +22,12 @@ def load(operator,
     file = open(filepath, 'rb')
     
     # read planes
-    num_mirrors = struct.unpack("<H", file.read(2))[0]
-    for x in range(num_mirrors):
-        # read data
-        file.seek(44, 1) # seek past flags, plane, and bbox
-        
+    num_mirrors = rvcodec.read_record(file, rvcodec.U16_STRUCT)[0]
+    for record in rvcodec.read_records(file, rvcodec.MIRROR_PLANE_STRUCT, num_mirrors):
+        # skip flags, plane, and bbox
         mirror_verts = []
         for y in range(4):
-            mirror_vert = Vector(struct.unpack("<fff", file.read(12))) / common.RV_SCALE
+            mirror_vert = Vector(record[11 + y * 3:14 + y * 3]) / common.RV_SCALE
             mirror_verts.append(common.vec3_to_blender(mirror_vert))
     
         # create object
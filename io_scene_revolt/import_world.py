@@ -1,10 +1,15 @@
 import bpy
 import bmesh
-import struct, math, time, collections, os
+import math, time, collections, os, sys
+import importlib.util, multiprocessing, site
+from concurrent.futures import ProcessPoolExecutor
 from mathutils import Vector
 
 import io_scene_revolt.common_helpers as common
+import io_scene_revolt.rvcodec as rvcodec
+import io_scene_revolt.worldproxy as worldproxy
 from io_scene_revolt.rvfacehash import RV_FaceMaterialHash
+from io_scene_revolt.worldindex import WorldIndex
 
 ######################################################
 # HELPERS
@@ -18,63 +23,22 @@ def read_texanims_from_w(file):
     animtex.clear()
     
     #
-    anim_count = struct.unpack("<L", file.read(4))[0]
+    anim_count = rvcodec.read_record(file, rvcodec.U32_STRUCT)[0]
     for x in range(anim_count):
         anim = anims.add()
-        frame_count = struct.unpack("<L", file.read(4))[0]
+        frame_count = rvcodec.read_record(file, rvcodec.U32_STRUCT)[0]
         
-        for y in range(frame_count):
+        for record in rvcodec.read_records(file, rvcodec.TEXANIM_FRAME_STRUCT, frame_count):
             frame = anim.frames.add()
             
-            frame_tex, frame_delay = struct.unpack("<lf", file.read(8))
-            uv0 = struct.unpack("<ff", file.read(8))
-            uv1 = struct.unpack("<ff", file.read(8))
-            uv2 = struct.unpack("<ff", file.read(8))
-            uv3 = struct.unpack("<ff", file.read(8))
-            
-            frame.texture_number = frame_tex
-            frame.delay = frame_delay
-            frame.set_uv(0, uv0)
-            frame.set_uv(1, uv1)
-            frame.set_uv(2, uv2)
-            frame.set_uv(3, uv3)
-    
-
-def seek_past_mesh(file, psx = False):
-    poly_size = 36 if psx else 60
-    vert_size = 12 if psx else 24
-    
-    # seek past bounding info
-    file.seek(8 if psx else 40, 1)
-    
-    poly_count, vertex_count = struct.unpack("<HH", file.read(4))
-    
-    # seek past polygons and verts
-    if psx:
-        file.seek(poly_count * poly_size, 1)
-    else:
-        file.seek((poly_count * poly_size) + (vertex_count * vert_size), 1)
-
-    
-def seek_past_bcubes(file, psx = False):
-    bcube_count = 0
-    if psx:
-        bcube_count = struct.unpack("<H", file.read(2))[0]
-    else:
-        bcube_count = struct.unpack("<L", file.read(4))[0]
+            frame.texture_number = record[0]
+            frame.delay = record[1]
+            frame.set_uv(0, record[2:4])
+            frame.set_uv(1, record[4:6])
+            frame.set_uv(2, record[6:8])
+            frame.set_uv(3, record[8:10])
     
-    for x in range(bcube_count):
-        # seek past center/radius
-        file.seek(8 if psx else 16, 1)
-        
-        if psx:
-            index_count = struct.unpack("<H", file.read(2))[0]
-            file.seek(index_count * 2, 1)
-        else:
-            index_count = struct.unpack("<L", file.read(4))[0]
-            file.seek(index_count * 4, 1)
 
-    
 def finalize_world_materials(filepath, materials):
     filepath_noext = os.path.splitext(filepath)[0]
     loaded_textures = {}
@@ -115,12 +79,183 @@ def finalize_world_materials(filepath, materials):
     for mat in materials:
         common.set_material_vertex_blend(mat)
 
+
+def get_addon_dir():
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def get_worker_codec():
+    # worker processes run a plain interpreter without bpy, so they can't import
+    # through the addon package. load the codec as a top level module instead,
+    # without putting the addon directory on sys.path of this session.
+    # tasks refer to it by module name, so the caller registers it while they're pickled
+    spec = importlib.util.spec_from_file_location("rvcodec", os.path.join(get_addon_dir(), "rvcodec.py"))
+    worker_codec = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(worker_codec)
+    return worker_codec
+
+
+def decode_meshes(filepath, file, index, mesh_indices, worker_count = 1):
+    """Yield decoded mesh arrays in the order of mesh_indices, spread over worker processes if requested"""
+    import io_scene_revolt.import_mesh as import_mesh
+    
+    read_vertices = not index.psx
+    vertex_divisor = import_mesh.get_vertex_divisor(index.psx)
+    offsets = [index.meshes[x].offset for x in mesh_indices]
+    
+    if worker_count <= 1 or len(offsets) < 2:
+        for offset in offsets:
+            file.seek(offset)
+            yield rvcodec.read_mesh(file, index.psx, True, read_vertices, vertex_divisor)
+        return
+        
+    # Blender 2.90 reports its own binary as sys.executable
+    mp_context = multiprocessing.get_context("spawn")
+    mp_context.set_executable(getattr(bpy.app, "binary_path_python", sys.executable))
+    
+    worker_codec = get_worker_codec()
+    chunk_size = max(1, len(offsets) // (worker_count * 4))
+    
+    # tasks are pickled until the pool shuts down, put back whatever rvcodec was after that
+    previous_codec = sys.modules.get("rvcodec")
+    sys.modules["rvcodec"] = worker_codec
+    try:
+        # the workers find the codec through their own sys.path, set up before any task arrives
+        with ProcessPoolExecutor(max_workers = worker_count, mp_context = mp_context, 
+                                 initializer = site.addsitedir, initargs = (get_addon_dir(),)) as executor:
+            yield from executor.map(worker_codec.read_mesh_range, 
+                                    [filepath] * len(offsets), 
+                                    offsets, 
+                                    [index.psx] * len(offsets), 
+                                    [read_vertices] * len(offsets), 
+                                    [vertex_divisor] * len(offsets),
+                                    chunksize = chunk_size)
+    finally:
+        if previous_codec is None:
+            del sys.modules["rvcodec"]
+        else:
+            sys.modules["rvcodec"] = previous_codec
+
+
+def get_env_queues(file, index, env_list, mesh_indices):
+    """Return the env queue each mesh in mesh_indices should consume"""
+    if len(mesh_indices) == len(index.meshes):
+        # every mesh is read in order, so they can share one queue
+        shared_queue = collections.deque(env_list)
+        return [shared_queue] * len(mesh_indices)
+        
+    env_offsets = index.get_env_offsets(file, common.POLY_FLAG_ENABLEENV, mesh_indices)
+    return [collections.deque(env_list[env_offsets[x]:env_offsets[x + 1]]) for x in mesh_indices]
+    
+
+def get_region_mesh_indices(index, region_mode, region_min, region_max, region_center, region_radius, region_bigcubes):
+    """Return the sorted indices of meshes referenced by bigcubes inside the region"""
+    if region_mode == 'ALL':
+        return list(range(len(index.meshes)))
+    
+    bcube_indices = []
+    if region_mode == 'BIGCUBES':
+        for token in region_bigcubes.replace(",", " ").split():
+            try:
+                bcube_index = int(token)
+            except ValueError:
+                raise Exception("\"%s\" isn't a bigcube index, expected a list of numbers like \"0, 4, 5\"" % token)
+            if bcube_index < 0 or bcube_index >= len(index.bigcubes):
+                raise Exception("Bigcube %d doesn't exist, this world has %d" % (bcube_index, len(index.bigcubes)))
+            bcube_indices.append(bcube_index)
+            
+        if len(bcube_indices) == 0:
+            raise Exception("No bigcube indices given, enter the bigcubes to import like \"0, 4, 5\"")
+    else:
+        if index.psx:
+            raise Exception("PSX worlds can only be limited by bigcube index")
+            
+        if region_mode == 'BOX':
+            corner_a = common.vec3_to_revolt(Vector(region_min) * common.RV_SCALE)
+            corner_b = common.vec3_to_revolt(Vector(region_max) * common.RV_SCALE)
+            box_min = [min(corner_a[x], corner_b[x]) for x in range(3)]
+            box_max = [max(corner_a[x], corner_b[x]) for x in range(3)]
+        else:
+            center = common.vec3_to_revolt(Vector(region_center) * common.RV_SCALE)
+            radius = region_radius * common.RV_SCALE
+        
+        for bcube_index, bcube in enumerate(index.bigcubes):
+            if region_mode == 'BOX':
+                # distance from the box to the bigcube sphere
+                closest = [max(box_min[x], min(bcube.center[x], box_max[x])) for x in range(3)]
+                distance = (Vector(closest) - Vector(bcube.center)).length
+                hit = distance <= bcube.radius
+            else:
+                distance = (Vector(center) - Vector(bcube.center)).length
+                hit = distance <= bcube.radius + radius
+            
+            if hit:
+                bcube_indices.append(bcube_index)
+        
+    mesh_indices = set()
+    for bcube_index in bcube_indices:
+        mesh_indices.update(x for x in index.bigcubes[bcube_index].mesh_indices if x < len(index.meshes))
+    return sorted(mesh_indices)
+    
+
+def get_mesh_groups(index, merge_mode):
+    """Map each mesh index to the name of the object it's imported into"""
+    if merge_mode == 'SINGLE':
+        return ["World"] * len(index.meshes)
+    
+    groups = ["World_Unsorted"] * len(index.meshes)
+    for bcube_index in reversed(range(len(index.bigcubes))):
+        for mesh_index in index.bigcubes[bcube_index].mesh_indices:
+            if mesh_index < len(groups):
+                groups[mesh_index] = "BigCube_%d" % bcube_index
+    return groups
+    
+
+def set_mesh_bounds_prop(ob, index, mesh_indices):
+    # PSX bounding info isn't decoded
+    if index.psx:
+        return
+        
+    bounds_prop = {}
+    for mesh_index in mesh_indices:
+        mesh = index.meshes[mesh_index]
+        bounds_prop[str(mesh_index)] = [*mesh.center, mesh.radius, *mesh.bounds[0], *mesh.bounds[1]]
+    ob[common.MESH_BOUNDS_PROP] = bounds_prop
+    
+    
+def load_merged(meshes, index, merge_mode, matdict, vert_list):
+    import io_scene_revolt.import_mesh as import_mesh
+    mesh_groups = get_mesh_groups(index, merge_mode)
+    
+    # group name -> (object, material slot map, mesh arrays, mesh indices)
+    merged = {}
+    for mesh_index, mesh_data, env_queue in meshes:
+        group = mesh_groups[mesh_index]
+        if not group in merged:
+            merged[group] = (import_mesh.new_mesh_object(group), {}, [], [])
+        
+        ob, matslots, mesh_arrays, mesh_indices = merged[group]
+        mesh_arrays.append(import_mesh.get_mesh_arrays(mesh_data, ob, True, env_queue, matdict, matslots, vert_list))
+        mesh_indices.append(mesh_index)
+        
+    for ob, matslots, mesh_arrays, mesh_indices in merged.values():
+        import_mesh.build_mesh(ob.data, mesh_arrays, mesh_indices)
+        set_mesh_bounds_prop(ob, index, mesh_indices)
+    
 ######################################################
 # IMPORT
 ######################################################
 def load(operator,
          context,
-         filepath=""
+         filepath="",
+         worker_count=1,
+         merge_mode='NONE',
+         region_mode='ALL',
+         region_min=(0, 0, 0),
+         region_max=(0, 0, 0),
+         region_center=(0, 0, 0),
+         region_radius=0,
+         region_bigcubes=""
          ):
     
     import io_scene_revolt.import_mesh as import_mesh
@@ -128,66 +263,46 @@ def load(operator,
     time1 = time.perf_counter()
     
     # import world
-    file = open(filepath, 'rb')
-    file.seek(0, 2)
-    file_size = file.tell()
-    file.seek(0, 0)
-    
     is_psx = filepath.lower().endswith(".psw")
-
-    env_list = collections.deque()
-    vert_list = [] if is_psx else None
-
-    # seek alllllll the way to the end to get our env list on PC
-    # otherwise we seek to the end for vert list for PSX
-    mesh_count = struct.unpack("<L", file.read(4))[0]
-    meshes_file_pos = file.tell()    
-
-    for x in range(mesh_count):
-        seek_past_mesh(file, psx = is_psx)
-            
-    seek_past_bcubes(file, psx = is_psx)
-        
-    # read texanims, and env list if pc
-    # else read vertices if psx
-    if not is_psx:
-        # some files just end here
-        if file.tell() < file_size:
-            # read texanims 
-            read_texanims_from_w(file)
-
-            # we're here
-            env_list_file_pos = file.tell()
-            file.seek(0, 2)
-            env_list_length = file.tell() - env_list_file_pos
-            env_list_count = int(env_list_length / 4)
-            file.seek(env_list_file_pos)
-            
-            for x in range(env_list_count):
-                color = struct.unpack("<BBBB", file.read(4))
-                color = common.from_rv_color(color)
-                env_list.append(color)
-
-    else:
-        # read vertices
-        vertex_count = struct.unpack("<L", file.read(4))[0]
-        for x in range(vertex_count):
-            vert = Vector(struct.unpack("<hhh", file.read(6))) / common.RV_SCALE
-            normal = struct.unpack("<hhh", file.read(6))
-            
-            vert_list.append(common.vec3_to_blender(vert))
-            
-            
-    # now go back and read meshes
-    file.seek(meshes_file_pos)
-    
-    # load_mesh(file, is_world, env_queue, matdict = None):
+    env_list = []
+    vert_list = None
     shared_matdict = {}
-    for x in range(mesh_count):
-        import_mesh.load_mesh(file, is_world = True, env_queue = env_list, matdict = shared_matdict, psx = is_psx, vertlist = vert_list)
     
-    # cleanup     
-    file.close()
+    with open(filepath, 'rb') as file:
+        # index the file in one pass
+        index = WorldIndex(is_psx).build(file)
+        mesh_indices = get_region_mesh_indices(index, region_mode, region_min, region_max, region_center, region_radius, region_bigcubes)
+        if region_mode != 'ALL':
+            print(" importing %d of %d meshes" % (len(mesh_indices), len(index.meshes)))
+            
+        # read texanims, and env list if pc
+        # else read vertices if psx
+        if not is_psx:
+            if index.texanim_offset >= 0:
+                file.seek(index.texanim_offset)
+                read_texanims_from_w(file)
+                
+            env_colors = rvcodec.colors_array_from_rv(index.read_env_colors(file))
+            env_list = [tuple(color) for color in env_colors.tolist()]
+        else:
+            vertex_records = index.read_vertices(file)
+            vert_list = rvcodec.vec3_array_to_blender(vertex_records["position"] / common.RV_SCALE)
+        
+        # proxies load their geometry later, on demand
+        if merge_mode == 'PROXY':
+            worldproxy.create_proxies(filepath, file, index, mesh_indices)
+            print(" created %d proxies in %.4f sec." % (len(mesh_indices), time.perf_counter() - time1))
+            return {'FINISHED'}
+        
+        env_queues = get_env_queues(file, index, env_list, mesh_indices)
+        meshes = zip(mesh_indices, decode_meshes(filepath, file, index, mesh_indices, worker_count), env_queues)
+                
+        # load_mesh(file, is_world, env_queue, matdict = None):
+        if merge_mode == 'NONE':
+            for mesh_index, mesh_data, env_queue in meshes:
+                import_mesh.create_mesh(mesh_data, is_world = True, env_queue = env_queue, matdict = shared_matdict, vertlist = vert_list)
+        else:
+            load_merged(meshes, index, merge_mode, shared_matdict, vert_list)
     
     # load textures
     unique_materials = set(shared_matdict.values())
@@ -196,4 +311,4 @@ def load(operator,
     # import complete
     print(" done in %.4f sec." % (time.perf_counter() - time1))
 
-    return {'FINISHED'}
\ No newline at end of file
+    return {'FINISHED'}
@@ -0,0 +1,33 @@
+# export material info shared across objects and split meshes
+# the cache only lives for one export, materials can be edited, undone or freed between exports
+from io_scene_revolt.rvexportmaterialinfo import RVExportMaterialInfo
+
+# (material, is_world) -> RVExportMaterialInfo, None outside of an export
+material_info_cache = None
+
+######################################################
+# CACHE
+######################################################
+def begin():
+    """Start a new cache, called at the start of every export"""
+    global material_info_cache
+    material_info_cache = {}
+
+
+def end():
+    """Discard the cache, called at the end of every export"""
+    global material_info_cache
+    material_info_cache = None
+
+
+def get_material_info(mat, is_world):
+    """Return the export info of a material, built once per export"""
+    if material_info_cache is None:
+        return RVExportMaterialInfo(mat, is_world)
+
+    key = (mat, is_world)
+    info = material_info_cache.get(key)
+    if info is None:
+        info = RVExportMaterialInfo(mat, is_world)
+        material_info_cache[key] = info
+    return info
@@ -0,0 +1,100 @@
+import bpy
+import numpy as np
+
+######################################################
+# HELPERS
+######################################################
+def get_loop_slots(loop_counts, slot_count = 4, reverse = False):
+    """Return flat indices into a padded (N, slot_count) array, in loop order"""
+    slots = np.arange(slot_count)
+    mask = slots < loop_counts[:, None]
+
+    if reverse:
+        order = loop_counts[:, None] - 1 - slots
+    else:
+        order = np.broadcast_to(slots, mask.shape)
+
+    flat = np.arange(len(loop_counts))[:, None] * slot_count + order
+    return flat[mask]
+
+
+def get_valid_faces(face_indices, loop_counts):
+    """Return a mask of faces that can be created, dropping degenerate faces and duplicates of earlier faces"""
+    face_count, slot_count = face_indices.shape
+    if face_count == 0:
+        return np.zeros(0, dtype=bool)
+
+    # unused slots get distinct negative values so they never match a vertex, or each other
+    slots = np.arange(slot_count)
+    padded = np.where(slots < loop_counts[:, None], face_indices.astype(np.int64), -1 - slots)
+    padded.sort(axis=1)
+
+    degenerate = (padded[:, 1:] == padded[:, :-1]).any(axis=1)
+
+    # bmesh refuses a face made of the same verts as an existing one
+    first_seen = np.unique(padded, axis=0, return_index=True)[1]
+    valid = np.zeros(face_count, dtype=bool)
+    valid[first_seen] = True
+
+    return valid & ~degenerate
+
+
+def compact_vertices(face_indices, loop_counts):
+    """Return (used vertex indices in first use order, face indices remapped to them)"""
+    used = face_indices.ravel()[get_loop_slots(loop_counts, face_indices.shape[1])]
+    unique, first_use = np.unique(used, return_index=True)
+    order = np.argsort(first_use, kind='stable')
+
+    remap = np.empty(len(unique), dtype=np.int64)
+    remap[order] = np.arange(len(unique))
+
+    # padding slots may hold anything, keep them in range
+    lookup = np.clip(np.searchsorted(unique, face_indices), 0, max(0, len(unique) - 1))
+    remapped = remap[lookup] if len(unique) > 0 else np.zeros_like(face_indices, dtype=np.int64)
+
+    return (unique[order], remapped)
+
+######################################################
+# BUILD
+######################################################
+def mesh_from_arrays(me, vertices, loop_vertices, loop_totals, material_indices = None, smooth = True, uv_layers = (), color_layers = (), face_maps = None, face_int_layers = ()):
+    """Fill an empty Mesh datablock from flat arrays. uv, color and int layers are lists of (name, array)"""
+    face_count = len(loop_totals)
+    loop_totals = np.asarray(loop_totals, dtype=np.int32)
+    loop_starts = np.zeros(face_count, dtype=np.int32)
+    if face_count > 1:
+        np.cumsum(loop_totals[:-1], out=loop_starts[1:])
+
+    # geometry
+    me.vertices.add(len(vertices))
+    me.vertices.foreach_set("co", np.ascontiguousarray(vertices, dtype=np.float32).ravel())
+
+    me.loops.add(len(loop_vertices))
+    me.loops.foreach_set("vertex_index", np.ascontiguousarray(loop_vertices, dtype=np.int32))
+
+    me.polygons.add(face_count)
+    me.polygons.foreach_set("loop_start", loop_starts)
+    me.polygons.foreach_set("loop_total", loop_totals)
+    me.polygons.foreach_set("use_smooth", np.full(face_count, smooth, dtype=bool))
+    if material_indices is not None:
+        me.polygons.foreach_set("material_index", np.ascontiguousarray(material_indices, dtype=np.int32))
+
+    # layers
+    for name, uvs in uv_layers:
+        uv_layer = me.uv_layers.new(name=name)
+        uv_layer.data.foreach_set("uv", np.ascontiguousarray(uvs, dtype=np.float32).ravel())
+
+    for name, colors in color_layers:
+        vc_layer = me.vertex_colors.new(name=name)
+        vc_layer.data.foreach_set("color", np.ascontiguousarray(colors, dtype=np.float32).ravel())
+
+    for name, values in face_int_layers:
+        int_layer = me.polygon_layers_int.new(name=name)
+        int_layer.data.foreach_set("value", np.ascontiguousarray(values, dtype=np.int32))
+
+    if face_maps is not None:
+        fm_layer = me.face_maps.new()
+        fm_layer.data.foreach_set("value", np.ascontiguousarray(face_maps, dtype=np.int32))
+
+    me.update(calc_edges=True)
+    return me
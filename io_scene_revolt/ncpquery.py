@@ -0,0 +1,290 @@
+# batched queries against exported collision, doesn't depend on bpy
+# everything here works in Re-Volt space, where y points down
+import math
+import numpy as np
+
+import io_scene_revolt.rvcodec as rvcodec
+
+# tolerance for points right on a polyhedron edge
+PLANE_EPSILON = 0.01
+
+# rays looked up at once, keeps the ray / face pairs in memory bounded
+RAY_CHUNK_SIZE = 4096
+
+# faces steeper than this aren't sampled as floor
+FLOOR_MAX_ANGLE = math.radians(60)
+
+######################################################
+# HELPERS
+######################################################
+def get_pair_ranges(starts, ends):
+    """Expand per row [start, end) ranges into (row, value) pairs"""
+    counts = np.maximum(ends - starts, 0)
+    rows = np.repeat(np.arange(len(starts)), counts)
+    values = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts) + starts[rows]
+    return (rows, values)
+
+
+def get_first_hits(rows, distances, faces, row_count):
+    """Closest hit per row, (distances, faces) with inf / -1 for rows without one"""
+    hit_distances = np.full(row_count, np.inf)
+    hit_faces = np.full(row_count, -1, dtype=np.int64)
+    if len(rows) == 0:
+        return (hit_distances, hit_faces)
+
+    order = np.lexsort((distances, rows))
+    rows = rows[order]
+    first = np.append(True, rows[1:] != rows[:-1])
+    hit_distances[rows[first]] = distances[order][first]
+    hit_faces[rows[first]] = faces[order][first]
+    return (hit_distances, hit_faces)
+
+######################################################
+# CLASSES
+######################################################
+class NCPQuery:
+    """Polyhedra and grid of a .ncp file as arrays, with batched lookups that use the grid like the game does"""
+    def __init__(self):
+        self.polys = np.zeros(0, dtype=rvcodec.NCP_POLY_DTYPE)
+
+        # grid, cell_offsets is None when the file doesn't have one
+        self.grid_origin = (0.0, 0.0)
+        self.grid_width = 0
+        self.grid_depth = 0
+        self.grid_size = 0.0
+        self.cell_offsets = None
+        self.cell_faces = np.zeros(0, dtype=np.int64)
+        
+        # cell entries pointing past the last polyhedron, dropped on load
+        self.invalid_indices = 0
+
+    def load(self, filepath):
+        with open(filepath, 'rb') as file:
+            poly_count = rvcodec.read_record(file, rvcodec.U16_STRUCT)[0]
+            self.polys = rvcodec.read_array(file, rvcodec.NCP_POLY_DTYPE, poly_count)
+
+            header = file.read(rvcodec.NCP_GRID_HEADER_STRUCT.size)
+            if len(header) == rvcodec.NCP_GRID_HEADER_STRUCT.size:
+                x0, z0, width, depth, size = rvcodec.unpack_from(rvcodec.NCP_GRID_HEADER_STRUCT, header)
+                self.grid_origin = (x0, z0)
+                self.grid_width = int(width)
+                self.grid_depth = int(depth)
+                self.grid_size = size
+                self.read_cells(np.frombuffer(file.read(), dtype="<u4"))
+
+        self.prepare()
+        return self
+
+    def read_cells(self, data):
+        """Split the cell data into offsets and face indices, each cell is a face count followed by the faces"""
+        cell_count = self.grid_width * self.grid_depth
+        count_positions = np.zeros(cell_count, dtype=np.int64)
+
+        position = 0
+        for cell in range(cell_count):
+            if position >= len(data):
+                raise Exception("Collision grid is cut short at cell %d of %d" % (cell, cell_count))
+            count_positions[cell] = position
+            position += int(data[position]) + 1
+
+        is_face = np.zeros(len(data), dtype=bool)
+        is_face[:position] = True
+        is_face[count_positions] = False
+        cell_faces = data[is_face].astype(np.int64)
+        face_cells = np.repeat(np.arange(cell_count), data[count_positions].astype(np.int64))
+
+        # broken indices would crash every lookup, count them for get_grid_stats instead
+        valid = cell_faces < len(self.polys)
+        self.invalid_indices = int((~valid).sum())
+        self.cell_faces = cell_faces[valid]
+        self.cell_offsets = np.zeros(cell_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(face_cells[valid], minlength=cell_count), out=self.cell_offsets[1:])
+
+    def prepare(self):
+        """Split the polyhedra into plain arrays"""
+        planes = self.polys["planes"].astype(np.float64)
+        self.normals = planes[:, 0, :3]
+        self.distances = planes[:, 0, 3]
+        self.edge_normals = planes[:, 1:, :3]
+        self.edge_distances = planes[:, 1:, 3]
+        self.edge_counts = np.where(self.polys["type"] & 1, 4, 3)
+
+        bounds = self.polys["bounds"].astype(np.float64)
+        self.bounds_min = bounds[:, [0, 2, 4]]
+        self.bounds_max = bounds[:, [1, 3, 5]]
+
+    def has_grid(self):
+        return self.cell_offsets is not None
+
+    def get_cells(self, points):
+        """Grid cell of each point, -1 outside the grid. Cells are counted from the grid origin in grid size steps"""
+        points = np.asarray(points, dtype=np.float64)
+        x = np.floor((points[:, 0] - self.grid_origin[0]) / self.grid_size).astype(np.int64)
+        z = np.floor((points[:, 2] - self.grid_origin[1]) / self.grid_size).astype(np.int64)
+        inside = (x >= 0) & (x < self.grid_width) & (z >= 0) & (z < self.grid_depth)
+        return np.where(inside, z * self.grid_width + x, -1)
+
+    def lookup_points(self, points):
+        """Faces the game tests at each point, as (offsets, faces). Without a grid that's every face"""
+        points = np.asarray(points, dtype=np.float64)
+        if not self.has_grid():
+            offsets = np.arange(len(points) + 1, dtype=np.int64) * len(self.polys)
+            return (offsets, np.tile(np.arange(len(self.polys)), len(points)))
+
+        cells = self.get_cells(points)
+        safe_cells = np.maximum(cells, 0)
+        starts = np.where(cells >= 0, self.cell_offsets[safe_cells], 0)
+        ends = np.where(cells >= 0, self.cell_offsets[safe_cells + 1], 0)
+
+        rows, positions = get_pair_ranges(starts, ends)
+        offsets = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(points)), out=offsets[1:])
+        return (offsets, self.cell_faces[positions])
+
+    def get_segment_candidates(self, starts, ends):
+        """(segment, face) pairs for faces in every cell the segment's x/z bounds touch"""
+        if not self.has_grid():
+            return get_pair_ranges(np.zeros(len(starts), dtype=np.int64), np.full(len(starts), len(self.polys), dtype=np.int64))
+
+        # cell ranges, clamped to the grid
+        lo = np.minimum(starts, ends)
+        hi = np.maximum(starts, ends)
+        x_lo = np.clip(np.floor((lo[:, 0] - self.grid_origin[0]) / self.grid_size), 0, self.grid_width).astype(np.int64)
+        x_hi = np.clip(np.floor((hi[:, 0] - self.grid_origin[0]) / self.grid_size) + 1, 0, self.grid_width).astype(np.int64)
+        z_lo = np.clip(np.floor((lo[:, 2] - self.grid_origin[1]) / self.grid_size), 0, self.grid_depth).astype(np.int64)
+        z_hi = np.clip(np.floor((hi[:, 2] - self.grid_origin[1]) / self.grid_size) + 1, 0, self.grid_depth).astype(np.int64)
+
+        # one row per (segment, cell row), then per (segment, cell)
+        z_segments, z = get_pair_ranges(z_lo, z_hi)
+        z_rows, x = get_pair_ranges(x_lo[z_segments], x_hi[z_segments])
+        cell_segments = z_segments[z_rows]
+        cells = z[z_rows] * self.grid_width + x
+
+        face_rows, positions = get_pair_ranges(self.cell_offsets[cells], self.cell_offsets[cells + 1])
+        segments = cell_segments[face_rows]
+        faces = self.cell_faces[positions]
+
+        # merged cells share faces, keep each pair once for segments that touch more than one cell
+        multi = ((x_hi - x_lo) * (z_hi - z_lo) > 1)[segments]
+        if not multi.any():
+            return (segments, faces)
+        keys = np.unique(segments[multi] * len(self.polys) + faces[multi])
+        return (np.concatenate((segments[~multi], keys // len(self.polys))), np.concatenate((faces[~multi], keys % len(self.polys))))
+
+    def points_inside(self, points, faces, tolerance = PLANE_EPSILON):
+        """Is each point within the edge planes of its face. Inside an edge plane is negative"""
+        values = np.einsum("ijk,ik->ij", self.edge_normals[faces], points) + self.edge_distances[faces]
+        if np.ndim(tolerance) > 0:
+            tolerance = np.reshape(tolerance, (-1, 1))
+        used = np.arange(4) < self.edge_counts[faces, None]
+        return np.all((values <= tolerance) | ~used, axis=1)
+
+    def raycast(self, origins, directions, max_distance = np.inf, two_sided = False):
+        """Closest face hit by each ray, as (distances, faces) with inf / -1 for misses.
+           Only front faces are hit unless two_sided is set"""
+        origins = np.asarray(origins, dtype=np.float64).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+        lengths = np.linalg.norm(directions, axis=1, keepdims=True)
+        directions = np.divide(directions, lengths, out=np.zeros_like(directions), where=lengths > 0)
+
+        # rays only look through the grid as far as the collision bounds reach
+        reach = np.full(len(origins), max_distance, dtype=np.float64)
+        if len(self.polys) > 0:
+            center = (self.bounds_min.min(axis=0) + self.bounds_max.max(axis=0)) / 2
+            radius = np.linalg.norm(self.bounds_max.max(axis=0) - center)
+            reach = np.minimum(reach, np.linalg.norm(origins - center, axis=1) + radius)
+
+        ends = origins + directions * reach[:, None]
+        segment_min = np.minimum(origins, ends) - PLANE_EPSILON
+        segment_max = np.maximum(origins, ends) + PLANE_EPSILON
+
+        hit_rays = []
+        hit_distances = []
+        hit_faces = []
+        for start in range(0, len(origins), RAY_CHUNK_SIZE):
+            rays, faces = self.get_segment_candidates(origins[start:start + RAY_CHUNK_SIZE], ends[start:start + RAY_CHUNK_SIZE])
+            rays += start
+
+            # cheap bounds test first
+            near = np.all((self.bounds_min[faces] <= segment_max[rays]) & (self.bounds_max[faces] >= segment_min[rays]), axis=1)
+            rays = rays[near]
+            faces = faces[near]
+
+            o = origins[rays]
+            d = directions[rays]
+            n = self.normals[faces]
+
+            facing = np.einsum("ij,ij->i", n, d)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t = -(np.einsum("ij,ij->i", n, o) + self.distances[faces]) / facing
+            valid = (np.abs(facing) > 1e-9) & (t >= 0) & (t <= max_distance)
+            if not two_sided:
+                valid &= facing < 0
+
+            valid[valid] = self.points_inside(o[valid] + d[valid] * t[valid, None], faces[valid])
+            hit_rays.append(rays[valid])
+            hit_distances.append(t[valid])
+            hit_faces.append(faces[valid])
+
+        if len(hit_rays) == 0:
+            return get_first_hits(np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64), len(origins))
+        return get_first_hits(np.concatenate(hit_rays), np.concatenate(hit_distances), np.concatenate(hit_faces), len(origins))
+
+    def overlap_spheres(self, centers, radii):
+        """Faces each sphere touches, as (offsets, faces). Candidates come from the cell of the center, like the
+           game. The test is the plane slab one the game uses, so it's generous around polyhedron corners"""
+        centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(centers),))
+
+        offsets, faces = self.lookup_points(centers)
+        spheres = np.repeat(np.arange(len(centers)), np.diff(offsets))
+        c = centers[spheres]
+        r = radii[spheres]
+
+        keep = np.all((c + r[:, None] >= self.bounds_min[faces]) & (c - r[:, None] <= self.bounds_max[faces]), axis=1)
+        keep &= np.abs(np.einsum("ij,ij->i", self.normals[faces], c) + self.distances[faces]) <= r
+        keep &= self.points_inside(c, faces, r)
+
+        spheres = spheres[keep]
+        overlap_offsets = np.zeros(len(centers) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(spheres, minlength=len(centers)), out=overlap_offsets[1:])
+        return (overlap_offsets, faces[keep])
+
+    def sample_floor_points(self, samples_per_face = 1, max_angle = FLOOR_MAX_ANGLE, seed = 0):
+        """Random points on every face a car can stand on, returns (points, faces)"""
+        # up is -y
+        floor_faces = np.flatnonzero(-self.normals[:, 1] >= math.cos(max_angle))
+        faces = np.repeat(floor_faces, samples_per_face)
+
+        # random points in the face bounds, pulled onto the main plane and kept if inside the edges
+        rng = np.random.default_rng(seed)
+        points = self.bounds_min[faces] + rng.random((len(faces), 3)) * (self.bounds_max[faces] - self.bounds_min[faces])
+        points[:, 1] = -(self.normals[faces, 0] * points[:, 0] + self.normals[faces, 2] * points[:, 2] + self.distances[faces]) / self.normals[faces, 1]
+        inside = self.points_inside(points, faces, 0)
+        return (points[inside], faces[inside])
+
+    def find_floor_holes(self, points, drop_height = 50, max_drop = 100):
+        """Drop a ray from drop_height above each point, returns a mask of points where it falls through"""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        origins = points - (0, drop_height, 0)
+        distances, faces = self.raycast(origins, np.tile((0.0, 1.0, 0.0), (len(points), 1)), drop_height + max_drop)
+        return faces < 0
+
+    def get_grid_stats(self):
+        """Return a dict with cell and face counts, faces per cell and faces that no cell references"""
+        stats = {"faces": len(self.polys)}
+        if not self.has_grid():
+            return stats
+
+        counts = np.diff(self.cell_offsets)
+        referenced = np.zeros(len(self.polys), dtype=bool)
+        referenced[self.cell_faces] = True
+
+        stats["cells"] = len(counts)
+        stats["empty_cells"] = int((counts == 0).sum())
+        stats["average_faces"] = float(counts[counts > 0].mean()) if (counts > 0).any() else 0.0
+        stats["max_faces"] = int(counts.max()) if len(counts) > 0 else 0
+        stats["indices"] = len(self.cell_faces)
+        stats["unreferenced_faces"] = int((~referenced).sum())
+        stats["invalid_indices"] = self.invalid_indices
+        return stats
@@ -0,0 +1,220 @@
+# this module is also imported by worker processes running outside of Blender,
+# so it must not import bpy or any other addon module
+import struct
+import numpy as np
+
+######################################################
+# RECORD LAYOUTS
+######################################################
+# PC polygon, 60 bytes
+PRM_POLY_DTYPE = np.dtype([("type",    "<u2"),
+                           ("texnum",  "<i2"),
+                           ("indices", "<u2", (4,)),
+                           ("colors",  "u1",  (4, 4)),
+                           ("uvs",     "<f4", (4, 2))])
+
+# PSX polygon, 36 bytes
+PSM_POLY_DTYPE = np.dtype([("type",    "<u2"),
+                           ("texnum",  "<i2"),
+                           ("indices", "<u2", (4,)),
+                           ("colors",  "u1",  (4, 4)),
+                           ("uvs",     "u1",  (4, 2))])
+
+# PC vertex, 24 bytes
+PRM_VERTEX_DTYPE = np.dtype([("position", "<f4", (3,)),
+                             ("normal",   "<f4", (3,))])
+
+# PSX vertex, 12 bytes
+PSM_VERTEX_DTYPE = np.dtype([("position", "<i2", (3,)),
+                             ("normal",   "<i2", (3,))])
+
+# mesh header, the polygon and vertex counts
+MESH_HEADER_DTYPE = np.dtype([("poly_count",   "<u2"),
+                              ("vertex_count", "<u2")])
+
+# world mesh header, bounding info followed by the polygon and vertex counts
+WORLD_MESH_HEADER_DTYPE = np.dtype([("center",       "<f4", (3,)),
+                                    ("radius",       "<f4"),
+                                    ("bounds",       "<f4", (6,)),
+                                    ("poly_count",   "<u2"),
+                                    ("vertex_count", "<u2")])
+
+# PSX bounding info is kept packed
+WORLD_MESH_HEADER_PSX_DTYPE = np.dtype([("bounds",       "u1", (8,)),
+                                        ("poly_count",   "<u2"),
+                                        ("vertex_count", "<u2")])
+
+BIGCUBE_HEADER_DTYPE = np.dtype([("center",     "<f4", (3,)),
+                                 ("radius",     "<f4"),
+                                 ("mesh_count", "<u4")])
+
+BIGCUBE_HEADER_PSX_DTYPE = np.dtype([("bounds",     "u1", (8,)),
+                                     ("mesh_count", "<u2")])
+
+TEXANIM_FRAME_DTYPE = np.dtype([("texture", "<i4"),
+                                ("delay",   "<f4"),
+                                ("uvs",     "<f4", (4, 2))])
+
+# collision polyhedron, 112 bytes
+# planes are (normal, distance), the main plane first. bounds are xmin, xmax, ymin, ymax, zmin, zmax
+NCP_POLY_DTYPE = np.dtype([("type",     "<u4"),
+                           ("material", "<i4"),
+                           ("planes",   "<f4", (5, 4)),
+                           ("bounds",   "<f4", (6,))])
+
+######################################################
+# STRUCT RECORDS
+######################################################
+# precompiled counterparts of the layouts above, for record at a time access.
+# polygon, vertex and collision polyhedron tables are only ever read and written whole,
+# so those layouts are defined once, as the dtypes above
+U8X4_STRUCT = struct.Struct("<4B")
+U16_STRUCT = struct.Struct("<H")
+U32_STRUCT = struct.Struct("<L")
+VEC3_STRUCT = struct.Struct("<3f")
+VEC3_PSX_STRUCT = struct.Struct("<3l")
+
+# poly count, vertex count
+MESH_COUNTS_STRUCT = struct.Struct("<HH")
+
+# center, radius, xmin, xmax, ymin, ymax, zmin, zmax
+WORLD_BOUNDS_STRUCT = struct.Struct("<3ff6f")
+
+# center, radius, mesh count
+BIGCUBE_HEADER_STRUCT = struct.Struct("<3ffL")
+
+# texture, delay, 4 uvs
+TEXANIM_FRAME_STRUCT = struct.Struct("<lf8f")
+
+# x and z origin, width and depth in cells, cell size
+NCP_GRID_HEADER_STRUCT = struct.Struct("<5f")
+
+# vertex, edge and face counts, xmin, xmax, ymin, ymax, zmin, zmax, center
+HULL_HEADER_STRUCT = struct.Struct("<3H6f3f")
+HULL_HEADER_PSX_STRUCT = struct.Struct("<3H6l3l")
+HULL_EDGE_STRUCT = struct.Struct("<HH")
+HULL_PLANE_STRUCT = struct.Struct("<4f")
+
+# center, radius
+HULL_SPHERE_STRUCT = struct.Struct("<3ff")
+HULL_SPHERE_PSX_STRUCT = struct.Struct("<3ll")
+
+# flags, plane (normal, distance), xmin, xmax, ymin, ymax, zmin, zmax, 4 vertices
+MIRROR_PLANE_STRUCT = struct.Struct("<L4f6f12f")
+
+
+def get_poly_dtype(psx):
+    return PSM_POLY_DTYPE if psx else PRM_POLY_DTYPE
+
+
+def get_vertex_dtype(psx):
+    return PSM_VERTEX_DTYPE if psx else PRM_VERTEX_DTYPE
+
+
+def get_world_mesh_header_dtype(psx):
+    return WORLD_MESH_HEADER_PSX_DTYPE if psx else WORLD_MESH_HEADER_DTYPE
+
+
+def get_bigcube_header_dtype(psx):
+    return BIGCUBE_HEADER_PSX_DTYPE if psx else BIGCUBE_HEADER_DTYPE
+
+######################################################
+# STRUCT HELPERS
+######################################################
+def new_buffer(record, count = 1):
+    """Allocate a zeroed buffer for count records"""
+    return bytearray(record.size * count)
+
+
+def pack_into(record, buffer, offset, *values):
+    """Pack one record into buffer at offset. Returns the offset past it"""
+    record.pack_into(buffer, offset, *values)
+    return offset + record.size
+
+
+def unpack_from(record, buffer, offset = 0):
+    return record.unpack_from(buffer, offset)
+
+
+def iter_unpack(record, buffer, offset = 0, count = None):
+    """Iterate count records in buffer starting at offset, or every record until the end"""
+    view = memoryview(buffer)[offset:]
+    if count is not None:
+        view = view[:record.size * count]
+    return record.iter_unpack(view)
+
+
+def read_record(file, record):
+    return unpack_from(record, file.read(record.size))
+
+
+def read_records(file, record, count):
+    """Read count records in one call. Returns a list of tuples"""
+    return list(iter_unpack(record, file.read(record.size * count)))
+
+######################################################
+# READING
+######################################################
+def read_array(file, dtype, count):
+    # counts often come from small unsigned header fields, keep the size math in python ints
+    count = int(count)
+    data = file.read(dtype.itemsize * count)
+    return np.frombuffer(data, dtype=dtype, count=count)
+
+
+def read_mesh(file, psx=False, is_world=False, read_vertices=True, vertex_divisor=1.0):
+    """Decode a PRM/PSM mesh into whole columns. Returns a dict of arrays in Blender space"""
+    header_dtype = get_world_mesh_header_dtype(psx) if is_world else MESH_HEADER_DTYPE
+    header = read_array(file, header_dtype, 1)[0]
+    poly_count, vertex_count = int(header["poly_count"]), int(header["vertex_count"])
+    polys = read_array(file, get_poly_dtype(psx), poly_count)
+
+    vertices = None
+    if read_vertices:
+        vertex_records = read_array(file, get_vertex_dtype(psx), vertex_count)
+        vertices = vec3_array_to_blender(vertex_records["position"].astype(np.float64) / vertex_divisor)
+
+    # uvs
+    uvs = polys["uvs"].astype(np.float64)
+    if psx:
+        uvs /= 255.0
+
+    return {"types": polys["type"].copy(),
+            "texnums": polys["texnum"].copy(),
+            "indices": polys["indices"].copy(),
+            "colors": colors_array_from_rv(polys["colors"], psx),
+            "uvs": vec2_array_to_blender(uvs),
+            "vertices": vertices}
+
+def read_mesh_range(filepath, offset, psx=False, read_vertices=True, vertex_divisor=1.0):
+    """Decode the world mesh at offset, used by worker processes"""
+    with open(filepath, 'rb') as file:
+        file.seek(offset)
+        return read_mesh(file, psx, True, read_vertices, vertex_divisor)
+
+######################################################
+# CONVERSION
+######################################################
+def vec3_array_to_blender(co):
+    return np.stack((co[..., 0], co[..., 2], co[..., 1] * -1), axis=-1)
+
+
+def vec3_array_to_revolt(co):
+    return np.stack((co[..., 0], co[..., 2] * -1, co[..., 1]), axis=-1)
+
+
+def vec2_array_to_blender(co):
+    return np.stack((co[..., 0], 1 - co[..., 1]), axis=-1)
+
+
+def vec2_array_to_revolt(co):
+    # symmetric operation
+    return vec2_array_to_blender(co)
+
+
+def colors_array_from_rv(colors, psx=False):
+    colors = colors.astype(np.float64) / 255
+    if psx:
+        return colors
+    # BGRA -> RGBA
+    return colors[..., [2, 1, 0, 3]]
@@ -1,13 +1,32 @@
 import bpy
 import io_scene_revolt.common_helpers as common
 
+######################################################
+# HELPERS
+######################################################
+def index_material_nodes(mat):
+    """Map node type to the first node of that type, in one pass over the node tree"""
+    nodes = {}
+    if mat is None or mat.node_tree is None:
+        return nodes
+        
+    for node in mat.node_tree.nodes:
+        if not node.type in nodes:
+            nodes[node.type] = node
+    return nodes
+
+######################################################
+# MATERIAL INFO
+######################################################
 class RVExportMaterialInfo:
     def __init__(self, mat, is_world):
+        nodes = index_material_nodes(mat)
+        
         self.alpha = 1.0
         self.is_env = not is_world
         self.env_color = (1,1,1,1)
         self.flags = 0
-        self.texnum = common.get_texnum_from_material(mat)
+        self.texnum = common.get_texnum_from_image(nodes["TEX_IMAGE"].image) if "TEX_IMAGE" in nodes else -1
         self.mul_vertex_color = False
         
         if mat is not None:
@@ -25,7 +44,7 @@ class RVExportMaterialInfo:
                     self.texnum = anim_slot
                     self.flags |= common.POLY_FLAG_ANIMATED
 
-        add_node = common.get_material_node_of_type(mat, 'ADD_SHADER')
+        add_node = nodes.get('ADD_SHADER')
         if add_node is not None:
             # check if the add node is connected to the output
             # and has a transparent input. if those are true we can
@@ -36,7 +55,7 @@ class RVExportMaterialInfo:
                  self.flags |= common.POLY_FLAG_ADDITIVE
                 
         
-        principled = common.get_material_node_of_type(mat, 'BSDF_PRINCIPLED')
+        principled = nodes.get('BSDF_PRINCIPLED')
         if principled is not None:
             # env flag
             spec_input = principled.inputs["Specular"]
@@ -0,0 +1,147 @@
+# vertex cache optimization on flat index arrays, doesn't depend on bpy
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 16
+
+######################################################
+# HELPERS
+######################################################
+def get_triangle_stream(face_indices, face_sizes):
+    """Flat index stream as rendered, quads (a, b, c, d) become (a, b, c) and (a, c, d)"""
+    face_indices = np.asarray(face_indices)
+    tris = face_indices[:, [0, 1, 2]]
+    quads = face_indices[face_sizes == 4][:, [0, 2, 3]]
+
+    # keep the second half of each quad right after the first
+    stream = np.empty((len(tris) + len(quads), 3), dtype=np.int64)
+    quad_rows = np.flatnonzero(face_sizes == 4) + np.arange(len(quads)) + 1
+    tri_rows = np.setdiff1d(np.arange(len(stream)), quad_rows)
+    stream[tri_rows] = tris
+    stream[quad_rows] = quads
+    return stream.ravel()
+
+
+def get_cache_misses(face_indices, face_sizes, cache_size = DEFAULT_CACHE_SIZE):
+    """Return (vertex transforms, rendered triangles) with a FIFO cache"""
+    stream = get_triangle_stream(face_indices, face_sizes)
+
+    cache_time = {}
+    time = cache_size + 1
+    misses = 0
+    for v in stream.tolist():
+        if time - cache_time.get(v, -cache_size - 1) > cache_size:
+            cache_time[v] = time
+            time += 1
+            misses += 1
+
+    return (misses, len(stream) // 3)
+
+
+def get_acmr(face_indices, face_sizes, cache_size = DEFAULT_CACHE_SIZE):
+    """Average cache miss ratio, vertex transforms per rendered triangle"""
+    misses, triangles = get_cache_misses(face_indices, face_sizes, cache_size)
+    return misses / triangles if triangles > 0 else 0.0
+
+
+def get_vertex_faces(face_indices, face_sizes, vertex_count):
+    """CSR vertex -> face adjacency, (offsets, faces)"""
+    slots = np.arange(face_indices.shape[1])
+    mask = slots < face_sizes[:, None]
+    verts = face_indices[mask]
+    faces = np.broadcast_to(np.arange(len(face_indices))[:, None], face_indices.shape)[mask]
+
+    order = np.argsort(verts, kind='stable')
+    offsets = np.zeros(vertex_count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(verts, minlength=vertex_count), out=offsets[1:])
+    return (offsets, faces[order])
+
+######################################################
+# OPTIMIZE
+######################################################
+def tipsify(face_indices, face_sizes, vertex_count, cache_size = DEFAULT_CACHE_SIZE):
+    """Return a face order with better vertex cache use (Sander et al. 2007), works on triangles and quads"""
+    face_indices = np.asarray(face_indices, dtype=np.int64)
+    face_sizes = np.asarray(face_sizes, dtype=np.int64)
+    face_count = len(face_indices)
+    if face_count == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    offsets, adjacency = get_vertex_faces(face_indices, face_sizes, vertex_count)
+    offsets = offsets.tolist()
+    adjacency = adjacency.tolist()
+    faces = [row[:size] for row, size in zip(face_indices.tolist(), face_sizes.tolist())]
+
+    live = np.diff(np.array(offsets)).tolist()
+    cache_time = [0] * vertex_count
+    emitted = [False] * face_count
+    dead_end = []
+    order = []
+
+    time = cache_size + 1
+    cursor = 0
+    fanning = int(face_indices[0, 0])
+
+    while fanning >= 0:
+        candidates = []
+
+        # emit every face around the fanning vertex
+        for face in adjacency[offsets[fanning]:offsets[fanning + 1]]:
+            if emitted[face]:
+                continue
+            emitted[face] = True
+            order.append(face)
+
+            for v in faces[face]:
+                dead_end.append(v)
+                candidates.append(v)
+                live[v] -= 1
+                if time - cache_time[v] > cache_size:
+                    cache_time[v] = time
+                    time += 1
+
+        # next fanning vertex, prefer one still in cache that has faces left
+        fanning = -1
+        best_priority = -1
+        for v in candidates:
+            if live[v] <= 0:
+                continue
+            priority = 0
+            if time - cache_time[v] + 2 * live[v] <= cache_size:
+                priority = time - cache_time[v]
+            if priority > best_priority:
+                best_priority = priority
+                fanning = v
+
+        if fanning < 0:
+            # dead end, walk back through recently used vertices
+            while len(dead_end) > 0:
+                v = dead_end.pop()
+                if live[v] > 0:
+                    fanning = v
+                    break
+
+        if fanning < 0:
+            # nothing nearby, continue in input order
+            while cursor < vertex_count:
+                if live[cursor] > 0:
+                    fanning = cursor
+                    break
+                cursor += 1
+
+    return np.array(order, dtype=np.int64)
+
+
+def get_first_use_order(face_indices, face_sizes, vertex_count):
+    """Return (new vertex order, old -> new remap), vertices are renumbered in order of first use"""
+    slots = np.arange(face_indices.shape[1])
+    used = face_indices[slots < face_sizes[:, None]]
+
+    unique, first_use = np.unique(used, return_index=True)
+    vertex_order = unique[np.argsort(first_use, kind='stable')]
+
+    # unused vertices go last, in their original order
+    vertex_order = np.concatenate((vertex_order, np.setdiff1d(np.arange(vertex_count), vertex_order)))
+
+    remap = np.empty(vertex_count, dtype=np.int64)
+    remap[vertex_order] = np.arange(vertex_count)
+    return (vertex_order, remap)
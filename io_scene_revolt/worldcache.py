@@ -0,0 +1,141 @@
+# on disk cache of serialized world meshes, keyed by everything that goes into them
+import bpy
+import hashlib, os
+import numpy as np
+
+import io_scene_revolt.common_helpers as common
+from io_scene_revolt.materialcache import get_material_info
+
+# bump when the mesh writer output changes
+CACHE_VERSION = 1
+
+class WorldCacheEntry:
+    def __init__(self, data, mesh_info, env_colors):
+        self.data = data
+        self.mesh_info = mesh_info
+        self.env_colors = env_colors
+
+######################################################
+# HELPERS
+######################################################
+def get_cache_dir(filepath):
+    return filepath + ".cache"
+
+
+def get_entry_path(cache_dir, key):
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def hash_array(hasher, array):
+    hasher.update(str(array.shape).encode())
+    hasher.update(array.tobytes())
+
+
+def hash_mesh(hasher, me):
+    """Hash the mesh data export_mesh and the splitters read"""
+    vert_count = len(me.vertices)
+    loop_count = len(me.loops)
+    face_count = len(me.polygons)
+
+    co = np.empty(vert_count * 3, dtype=np.float32)
+    me.vertices.foreach_get("co", co)
+    hash_array(hasher, co)
+
+    loop_verts = np.empty(loop_count, dtype=np.int32)
+    me.loops.foreach_get("vertex_index", loop_verts)
+    hash_array(hasher, loop_verts)
+
+    for key, dtype in (("loop_start", np.int32), ("loop_total", np.int32), ("material_index", np.int32), ("use_smooth", bool)):
+        values = np.empty(face_count, dtype=dtype)
+        me.polygons.foreach_get(key, values)
+        hash_array(hasher, values)
+
+    for uv_layer in me.uv_layers:
+        uvs = np.empty(loop_count * 2, dtype=np.float32)
+        uv_layer.data.foreach_get("uv", uvs)
+        hasher.update(uv_layer.name.encode())
+        hash_array(hasher, uvs)
+
+    for vc_layer in me.vertex_colors:
+        colors = np.empty(loop_count * 4, dtype=np.float32)
+        vc_layer.data.foreach_get("color", colors)
+        hasher.update(vc_layer.name.encode())
+        hash_array(hasher, colors)
+
+    # includes the mesh index layer of merged world imports
+    for int_layer in me.polygon_layers_int:
+        values = np.empty(face_count, dtype=np.int32)
+        int_layer.data.foreach_get("value", values)
+        hasher.update(int_layer.name.encode())
+        hash_array(hasher, values)
+
+
+def get_object_key(ob, settings, apply_modifiers = False):
+    """Content hash of an object's evaluated geometry, materials, transform and the export settings"""
+    hasher = hashlib.sha1()
+    hasher.update(repr((CACHE_VERSION, settings, common.RV_SCALE)).encode())
+    hasher.update(np.array(ob.matrix_world, dtype=np.float64).tobytes())
+
+    for slot in ob.material_slots:
+        material_info = get_material_info(slot.material, True)
+        hasher.update(repr((material_info.flags, material_info.texnum, material_info.alpha, material_info.mul_vertex_color,
+                            material_info.is_env, tuple(material_info.env_color))).encode())
+
+    eval_ob = ob.evaluated_get(bpy.context.evaluated_depsgraph_get()) if apply_modifiers else ob
+    me = eval_ob.to_mesh()
+    hash_mesh(hasher, me)
+    eval_ob.to_mesh_clear()
+
+    return hasher.hexdigest()
+
+######################################################
+# LOAD / SAVE
+######################################################
+def load_entry(cache_dir, key):
+    """Return the cached entry for key, or None if it's missing or unreadable"""
+    path = get_entry_path(cache_dir, key)
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            data = npz["data"].tobytes()
+            mesh_min = npz["mesh_min"].tolist()
+            mesh_max = npz["mesh_max"].tolist()
+            mesh_polys = npz["mesh_polys"].tolist()
+            env_colors = [tuple(color) for color in npz["env_colors"].tolist()]
+    except Exception as e:
+        print("failed to read cache entry %s: %s" % (path, str(e)))
+        return None
+
+    return WorldCacheEntry(data, list(zip(mesh_min, mesh_max, mesh_polys)), env_colors)
+
+
+def save_entry(cache_dir, key, data, mesh_info, env_colors):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = get_entry_path(cache_dir, key)
+
+    # write to a temp file first, so an interrupted export never leaves a broken entry
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as file:
+        np.savez(file,
+                 data = np.frombuffer(data, dtype=np.uint8),
+                 mesh_min = np.array([x[0] for x in mesh_info], dtype=np.float64).reshape(-1, 3),
+                 mesh_max = np.array([x[1] for x in mesh_info], dtype=np.float64).reshape(-1, 3),
+                 mesh_polys = np.array([x[2] for x in mesh_info], dtype=np.int64),
+                 env_colors = np.array(env_colors, dtype=np.float64).reshape(-1, 4))
+    os.replace(temp_path, path)
+
+
+def prune(cache_dir, used_keys):
+    """Remove entries that weren't used by this export, returns the number removed"""
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    removed = 0
+    for file_name in os.listdir(cache_dir):
+        key, ext = os.path.splitext(file_name)
+        if ext == ".npz" and not key in used_keys:
+            os.remove(os.path.join(cache_dir, file_name))
+            removed += 1
+    return removed
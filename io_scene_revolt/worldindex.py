@@ -0,0 +1,152 @@
+import numpy as np
+
+import io_scene_revolt.rvcodec as rvcodec
+
+######################################################
+# CLASSES
+######################################################
+class WorldIndexMesh:
+    def __init__(self, offset, size, poly_count, vertex_count, center = None, radius = None, bounds = None):
+        # offset points at the start of the mesh, including its bounding info
+        self.offset = offset
+        self.size = size
+        self.poly_count = poly_count
+        self.vertex_count = vertex_count
+
+        # polygons using the env list, None until get_env_offsets reads them
+        self.env_count = None
+
+        # sphere and box in Re-Volt space, None for PSX
+        self.center = center
+        self.radius = radius
+        self.bounds = bounds
+
+
+class WorldIndexBigCube:
+    def __init__(self, center, radius, mesh_indices):
+        # sphere in Re-Volt space, None for PSX
+        self.center = center
+        self.radius = radius
+        self.mesh_indices = mesh_indices
+
+
+class WorldIndex:
+    """Offsets and headers of every section in a .w/.psw file, gathered in one pass"""
+    def __init__(self, psx = False):
+        self.psx = psx
+        self.file_size = 0
+        self.meshes = []
+        self.bigcubes = []
+
+        # -1 when the file doesn't have the section
+        self.texanim_offset = -1
+        self.env_offset = -1
+        self.env_count = 0
+
+        # PSX global vertex list
+        self.vertex_offset = -1
+        self.vertex_count = 0
+
+    def build(self, file):
+        file.seek(0, 2)
+        self.file_size = file.tell()
+        file.seek(0, 0)
+
+        self.meshes = []
+        self.bigcubes = []
+
+        poly_size = rvcodec.get_poly_dtype(self.psx).itemsize
+        vert_size = rvcodec.get_vertex_dtype(self.psx).itemsize
+        header_dtype = rvcodec.get_world_mesh_header_dtype(self.psx)
+
+        # meshes
+        mesh_count = int(rvcodec.read_array(file, np.dtype("<u4"), 1)[0])
+        for x in range(mesh_count):
+            offset = file.tell()
+            header = rvcodec.read_array(file, header_dtype, 1)[0]
+            poly_count = int(header["poly_count"])
+            vertex_count = int(header["vertex_count"])
+
+            # PSX meshes index the global vertex list
+            data_size = poly_count * poly_size
+            if not self.psx:
+                data_size += vertex_count * vert_size
+            file.seek(data_size, 1)
+
+            mesh = WorldIndexMesh(offset, header_dtype.itemsize + data_size, poly_count, vertex_count)
+            if not self.psx:
+                bounds = header["bounds"]
+                mesh.center = tuple(header["center"].tolist())
+                mesh.radius = float(header["radius"])
+                mesh.bounds = ((float(bounds[0]), float(bounds[2]), float(bounds[4])), (float(bounds[1]), float(bounds[3]), float(bounds[5])))
+            self.meshes.append(mesh)
+
+        # bigcubes
+        bcube_count = int(rvcodec.read_array(file, np.dtype("<u2" if self.psx else "<u4"), 1)[0])
+        bcube_dtype = rvcodec.get_bigcube_header_dtype(self.psx)
+        index_dtype = np.dtype("<u2" if self.psx else "<u4")
+
+        for x in range(bcube_count):
+            header = rvcodec.read_array(file, bcube_dtype, 1)[0]
+            mesh_indices = rvcodec.read_array(file, index_dtype, int(header["mesh_count"])).tolist()
+
+            if self.psx:
+                self.bigcubes.append(WorldIndexBigCube(None, None, mesh_indices))
+            else:
+                self.bigcubes.append(WorldIndexBigCube(tuple(header["center"].tolist()), float(header["radius"]), mesh_indices))
+
+        # texanims and env list on PC, vertices on PSX
+        if self.psx:
+            self.vertex_count = int(rvcodec.read_array(file, np.dtype("<u4"), 1)[0])
+            self.vertex_offset = file.tell()
+        elif file.tell() < self.file_size:
+            # some files just end here
+            self.texanim_offset = file.tell()
+
+            anim_count = int(rvcodec.read_array(file, np.dtype("<u4"), 1)[0])
+            for x in range(anim_count):
+                frame_count = int(rvcodec.read_array(file, np.dtype("<u4"), 1)[0])
+                file.seek(frame_count * rvcodec.TEXANIM_FRAME_DTYPE.itemsize, 1)
+
+            self.env_offset = file.tell()
+            self.env_count = (self.file_size - self.env_offset) // 4
+
+        return self
+
+    def get_env_offsets(self, file, env_flag, mesh_indices = None):
+        """Return where each mesh starts in the env list, plus the end of the last one, up to the last of mesh_indices.
+           Only the polygon types of meshes up to there are read, once per index"""
+        last_mesh = len(self.meshes) - 1 if mesh_indices is None else max(mesh_indices, default = -1)
+        if self.psx or self.env_count == 0:
+            return [0] * (last_mesh + 2)
+
+        # polygon type is the first field, read it in place without decoding the records
+        poly_size = rvcodec.get_poly_dtype(self.psx).itemsize
+        header_size = rvcodec.get_world_mesh_header_dtype(self.psx).itemsize
+
+        offsets = [0]
+        for mesh in self.meshes[:last_mesh + 1]:
+            if mesh.env_count is None:
+                file.seek(mesh.offset + header_size)
+                data = file.read(mesh.poly_count * poly_size)
+                types = np.ndarray((mesh.poly_count,), dtype="<u2", buffer=data, strides=(poly_size,))
+                mesh.env_count = int(np.count_nonzero(types & env_flag))
+            offsets.append(offsets[-1] + mesh.env_count)
+
+        return offsets
+
+    def read_env_colors(self, file):
+        """Return raw (N, 4) env colors"""
+        if self.env_offset < 0:
+            return np.zeros((0, 4), dtype=np.uint8)
+
+        file.seek(self.env_offset)
+        return rvcodec.read_array(file, np.dtype("u1"), self.env_count * 4).reshape(-1, 4)
+
+    def read_vertices(self, file):
+        """Return raw PSX global vertex records"""
+        if self.vertex_offset < 0:
+            return rvcodec.read_array(file, rvcodec.PSM_VERTEX_DTYPE, 0)
+
+        file.seek(self.vertex_offset)
+        return rvcodec.read_array(file, rvcodec.PSM_VERTEX_DTYPE, self.vertex_count)
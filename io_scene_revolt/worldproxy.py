@@ -0,0 +1,204 @@
+import bpy
+import ast, collections
+import numpy as np
+from mathutils import Vector
+
+from bpy.types import Operator
+from bpy.props import (BoolProperty,
+                       FloatProperty)
+
+# common_helpers reads addon preferences when imported, so it's imported where used instead,
+# this module is loaded when the addon registers
+import io_scene_revolt.rvcodec as rvcodec
+
+PROXY_PATH_PROP = "rv_world_path"
+PROXY_MESH_INDEX_PROP = "rv_mesh_index"
+PROXY_MESH_OFFSET_PROP = "rv_mesh_offset"
+PROXY_ENV_OFFSET_PROP = "rv_env_offset"
+PROXY_ENV_START_PROP = "rv_env_start"
+PROXY_ENV_COUNT_PROP = "rv_env_count"
+PROXY_LOADED_PROP = "rv_loaded_object"
+
+# materials made by proxy loads keep their world path and material hash,
+# so later loads find them in bpy.data instead of holding on to references
+PROXY_MATERIAL_PROP = "rv_material_hash"
+
+######################################################
+# HELPERS
+######################################################
+def is_proxy(ob):
+    return ob is not None and ob.type == 'EMPTY' and PROXY_MESH_OFFSET_PROP in ob
+
+
+def get_loaded_object(proxy):
+    name = proxy.get(PROXY_LOADED_PROP, "")
+    return bpy.data.objects.get(name) if name != "" else None
+
+
+def get_proxy_materials(filepath):
+    """Material hash dict of the materials earlier loads made for this world"""
+    from io_scene_revolt.rvfacehash import RV_FaceMaterialHash
+    matdict = {}
+    for mat in bpy.data.materials:
+        if mat.get(PROXY_PATH_PROP) != filepath or not PROXY_MATERIAL_PROP in mat:
+            continue
+
+        texnum, flags, alpha, env_color = ast.literal_eval(mat[PROXY_MATERIAL_PROP])
+        poly_hash = RV_FaceMaterialHash(texnum, flags, True)
+        poly_hash.set_alpha(alpha)
+        if env_color is not None:
+            poly_hash.set_env_color(env_color)
+        matdict.setdefault(poly_hash, mat)
+    return matdict
+
+
+def tag_proxy_materials(filepath, matdict):
+    for poly_hash, mat in matdict.items():
+        mat[PROXY_PATH_PROP] = filepath
+        mat[PROXY_MATERIAL_PROP] = repr((poly_hash.texnum, poly_hash.flags, poly_hash.alpha, poly_hash.env_color))
+
+
+def create_proxies(filepath, file, index, mesh_indices):
+    """Create a bounding box empty for each mesh, tagged with where to find it in the file"""
+    import io_scene_revolt.common_helpers as common
+    if index.psx:
+        raise Exception("Proxy import needs mesh bounds, which PSX worlds don't store in a usable form")
+
+    scn = bpy.context.scene
+    env_offsets = index.get_env_offsets(file, common.POLY_FLAG_ENABLEENV, mesh_indices)
+
+    for mesh_index in mesh_indices:
+        mesh = index.meshes[mesh_index]
+        bnds_min = Vector(common.vec3_to_blender(mesh.bounds[0])) / common.RV_SCALE
+        bnds_max = Vector(common.vec3_to_blender(mesh.bounds[1])) / common.RV_SCALE
+
+        ob = bpy.data.objects.new("Proxy_%d" % mesh_index, None)
+        ob.empty_display_type = 'CUBE'
+        ob.location = (bnds_min + bnds_max) / 2
+        ob.scale = [max(abs(bnds_max[x] - bnds_min[x]) / 2, 0.001) for x in range(3)]
+
+        ob[PROXY_PATH_PROP] = filepath
+        ob[PROXY_MESH_INDEX_PROP] = mesh_index
+        ob[PROXY_MESH_OFFSET_PROP] = mesh.offset
+        ob[PROXY_ENV_OFFSET_PROP] = index.env_offset
+        ob[PROXY_ENV_START_PROP] = env_offsets[mesh_index]
+        ob[PROXY_ENV_COUNT_PROP] = env_offsets[mesh_index + 1] - env_offsets[mesh_index]
+        ob[PROXY_LOADED_PROP] = ""
+
+        scn.collection.objects.link(ob)
+
+
+def load_proxies(proxies):
+    """Create real geometry for each proxy that isn't loaded yet. Returns the number loaded"""
+    import io_scene_revolt.import_mesh as import_mesh
+    import io_scene_revolt.import_world as import_world
+
+    by_path = collections.defaultdict(list)
+    for proxy in proxies:
+        if get_loaded_object(proxy) is None:
+            by_path[proxy[PROXY_PATH_PROP]].append(proxy)
+
+    load_count = 0
+    for filepath, path_proxies in by_path.items():
+        matdict = get_proxy_materials(filepath)
+        known_materials = set(matdict.values())
+
+        loaded = []
+        try:
+            with open(filepath, 'rb') as file:
+                for proxy in sorted(path_proxies, key = lambda x: x[PROXY_MESH_OFFSET_PROP]):
+                    # env colors of this mesh only
+                    env_queue = collections.deque()
+                    env_count = proxy[PROXY_ENV_COUNT_PROP]
+                    if env_count > 0 and proxy[PROXY_ENV_OFFSET_PROP] >= 0:
+                        file.seek(proxy[PROXY_ENV_OFFSET_PROP] + proxy[PROXY_ENV_START_PROP] * 4)
+                        env_raw = rvcodec.read_array(file, np.dtype("u1"), env_count * 4).reshape(-1, 4)
+                        env_queue.extend(tuple(color) for color in rvcodec.colors_array_from_rv(env_raw).tolist())
+
+                    file.seek(proxy[PROXY_MESH_OFFSET_PROP])
+                    ob = import_mesh.load_mesh(file, is_world = True, env_queue = env_queue, matdict = matdict)
+                    ob.name = "Mesh_%d" % proxy[PROXY_MESH_INDEX_PROP]
+                    proxy[PROXY_LOADED_PROP] = ob.name
+                    loaded.append(proxy)
+        except Exception:
+            # don't leave part of this world marked as loaded
+            unload_proxies(loaded)
+            raise
+        load_count += len(loaded)
+
+        # load textures for new materials
+        new_materials = set(matdict.values()) - known_materials
+        import_world.finalize_world_materials(filepath, new_materials)
+        tag_proxy_materials(filepath, matdict)
+
+    return load_count
+
+
+def unload_proxies(proxies):
+    """Remove the geometry loaded for each proxy. Returns the number unloaded"""
+    unload_count = 0
+    for proxy in proxies:
+        ob = get_loaded_object(proxy)
+        proxy[PROXY_LOADED_PROP] = ""
+        if ob is None:
+            continue
+
+        me = ob.data
+        bpy.data.objects.remove(ob)
+        if me is not None and me.users == 0:
+            bpy.data.meshes.remove(me)
+        unload_count += 1
+
+    return unload_count
+
+
+def get_target_proxies(context, use_region, radius):
+    if not use_region:
+        return [ob for ob in context.selected_objects if is_proxy(ob)]
+
+    # every proxy touching a sphere around the 3d cursor
+    cursor = context.scene.cursor.location
+    proxies = []
+    for ob in context.scene.objects:
+        if not is_proxy(ob):
+            continue
+        proxy_radius = Vector(ob.scale).length
+        if (ob.location - cursor).length <= radius + proxy_radius:
+            proxies.append(ob)
+    return proxies
+
+######################################################
+# OPERATORS
+######################################################
+class RVWorldProxyLoad(Operator):
+    """Load geometry for the selected world proxies, or every proxy around the 3D cursor"""
+    bl_idname = "rv.worldproxy_load"
+    bl_label = "Load World Proxies"
+
+    bl_options = {'REGISTER', 'UNDO'}
+
+    use_region: BoolProperty(name="Around 3D Cursor", default=False)
+    radius: FloatProperty(name="Radius", default=50, min=0)
+
+    def execute(self, context):
+        proxies = get_target_proxies(context, self.use_region, self.radius)
+        load_count = load_proxies(proxies)
+        self.report({'INFO'}, "Loaded %d meshes" % load_count)
+        return {'FINISHED'}
+
+
+class RVWorldProxyUnload(Operator):
+    """Remove loaded geometry for the selected world proxies, or every proxy around the 3D cursor"""
+    bl_idname = "rv.worldproxy_unload"
+    bl_label = "Unload World Proxies"
+
+    bl_options = {'REGISTER', 'UNDO'}
+
+    use_region: BoolProperty(name="Around 3D Cursor", default=False)
+    radius: FloatProperty(name="Radius", default=50, min=0)
+
+    def execute(self, context):
+        proxies = get_target_proxies(context, self.use_region, self.radius)
+        unload_count = unload_proxies(proxies)
+        self.report({'INFO'}, "Unloaded %d meshes" % unload_count)
+        return {'FINISHED'}
@@ -0,0 +1,35 @@
+# the addon package imports bpy, so these only run inside Blender's python
+import numpy as np
+import pytest
+
+pytest.importorskip("bpy")
+import io_scene_revolt.collisiongrid as collisiongrid
+
+
+def make_quad_floor(count, size):
+    """count x count flat quads of size units, as (corners, face sizes)"""
+    xs, ys = np.meshgrid(np.arange(count) * size, np.arange(count) * size)
+    origins = np.stack((xs.ravel(), ys.ravel(), np.zeros(count * count)), axis=1)
+    corners = np.stack((origins, origins + (size, 0, 0), origins + (size, size, 0), origins + (0, size, 0)), axis=1)
+    return (corners, np.full(count * count, 4))
+
+
+def test_candidates_start_at_operator_minimum():
+    # ExportCollision.grid_size allows 128 and up
+    assert min(collisiongrid.GRID_SIZE_CANDIDATES) == 128
+
+
+def test_auto_grid_picks_cheapest_candidate():
+    grid, table = collisiongrid.make_auto_grid(*make_quad_floor(8, 1000))
+    costs = {size: cost for size, stats, cost in table}
+    assert grid.size == min(costs, key=costs.get)
+
+
+def test_auto_grid_large_faces_use_larger_cells():
+    grid, table = collisiongrid.make_auto_grid(*make_quad_floor(8, 1000))
+    assert grid.size > min(collisiongrid.GRID_SIZE_CANDIDATES)
+
+
+def test_auto_grid_small_faces_use_smallest_cells():
+    grid, table = collisiongrid.make_auto_grid(*make_quad_floor(40, 100))
+    assert grid.size == min(collisiongrid.GRID_SIZE_CANDIDATES)